@@ -12,7 +12,8 @@ version = '1.2.1'
 entry_points = {
     'console_scripts' :
         ['snap_init = snap_control.snap_init:cmd_tool',
-         'snap_plot = snap_control.snap_plot:cmd_tool'
+         'snap_plot = snap_control.snap_plot:cmd_tool',
+         'snap_sim = snap_control.snap_sim:cmd_tool'
      ]
     }
 
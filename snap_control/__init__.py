@@ -1,5 +1,13 @@
-from .snap_board import SnapBoard
 from .snap_adc import SnapAdc
 from .snap_plot import demux_data
-from .snap_manager import SnapManager
 
+# Talking to boards needs casperfpga; the analysis modules work without it
+try:
+    import casperfpga
+    HAS_CASPERFPGA = True
+except ImportError:
+    HAS_CASPERFPGA = False
+
+if HAS_CASPERFPGA:
+    from .snap_board import SnapBoard
+    from .snap_manager import SnapManager
@@ -0,0 +1,424 @@
+"""
+# katcp_async.py
+
+asyncio KATCP client, and an asyncio version of SnapManager (Python 3 only).
+
+FpgaClient runs a callback thread per board, and SnapManager starts another
+thread per board for every call. Here every board connection lives in one
+event loop. Requests to a board are pipelined using KATCP message ids, so a
+whole fleet can be driven from a single thread:
+
+    ```
+    async def main():
+        mgr = AsyncSnapManager(['snap01', 'snap02'])
+        await mgr.connect()
+        await mgr.program('adc16_test.bof', gain=1, demux_mode=1)
+        print(await mgr.check_rms())
+        await mgr.close()
+
+    asyncio.run(main())
+    ```
+
+Register access is asynchronous. ADC setup and SERDES calibration (SnapAdc)
+are long sequential register walks, so program() and recalibrate() run them
+in a bounded pool of worker threads. Their register reads and writes are
+forwarded to the event loop.
+
+This module is not imported by snap_control/__init__.py, as the rest of the
+package still supports Python 2.
+"""
+
+import asyncio
+import logging
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .katcp_codec import katcp_escape, parse_message
+from .snap_adc import SnapAdc
+from .snap_board import SnapBoard
+
+# Longest KATCP line accepted, e.g. a read reply carrying a whole snapshot
+# block (asyncio's default is 64 KiB)
+READ_LIMIT = 2**26
+
+
+class AsyncKatcpClient(object):
+    """ asyncio client for the KATCP register interface of a CASPER board
+
+    Args:
+        host (str): hostname or IP address of the board
+        port (int): KATCP port
+        timeout (float): seconds to wait for each reply
+        window (int): max. number of requests in flight at once
+    """
+    def __init__(self, host, port=7147, timeout=10.0, window=64):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.window = window
+        self.logger = logging.getLogger('AsyncKatcpClient')
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._slots = None
+        self._pending = {}
+        self._next_id = 0
+
+    def __repr__(self):
+        return "<AsyncKatcpClient host: %s port: %s>" % (self.host, self.port)
+
+    def is_connected(self):
+        return self._writer is not None
+
+    async def connect(self):
+        """ Open the connection and start dispatching replies """
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, limit=READ_LIMIT), self.timeout)
+        self._slots = asyncio.Semaphore(self.window)
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+    async def close(self):
+        """ Close the connection, failing any outstanding requests """
+        if self._read_task is None:
+            return
+        self._read_task.cancel()
+        try:
+            await self._read_task
+        except asyncio.CancelledError:
+            pass
+        self._read_task = None
+
+    async def _read_loop(self):
+        """ Dispatch replies until the connection closes, then fail outstanding requests
+
+        The writer is closed on the way out too, so later requests raise
+        RuntimeError rather than waiting for replies that can't arrive.
+        """
+        try:
+            while True:
+                try:
+                    line = await self._reader.readline()
+                except ValueError as e:
+                    # Longer than READ_LIMIT: the line is discarded, and its
+                    # request will time out
+                    self.logger.error("%s: skipping over-long line: %s" % (self.host, e))
+                    continue
+                if not line:
+                    break
+                self._dispatch(line)
+        except (ConnectionError, OSError) as e:
+            self.logger.error("%s: connection lost: %s" % (self.host, e))
+        finally:
+            self._writer.close()
+            self._writer = None
+            err = RuntimeError("Connection to %s closed" % self.host)
+            for future, informs in self._pending.values():
+                if not future.done():
+                    future.set_exception(err)
+            self._pending.clear()
+
+    def _dispatch(self, line):
+        try:
+            msg = parse_message(line)
+        except RuntimeError as e:
+            self.logger.error("%s: %s" % (self.host, e))
+            return
+        if msg is None:
+            return
+        mtype, name, mid, args = msg
+        if mid is None or mid not in self._pending:
+            if name == 'log':
+                self.logger.debug("%s: %s" % (self.host, b' '.join(args)))
+            return
+        future, informs = self._pending[mid]
+        if mtype == '#':
+            informs.append(args)
+        elif mtype == '!':
+            del self._pending[mid]
+            if not future.done():
+                future.set_result((args, informs))
+
+    async def _send(self, name, *args):
+        """ Wait for a window slot and send a request, returning the future of its reply """
+        if self._writer is None:
+            raise RuntimeError("Not connected to %s" % self.host)
+        await self._slots.acquire()
+        if self._writer is None:
+            # The connection closed while waiting for a slot
+            self._slots.release()
+            raise RuntimeError("Not connected to %s" % self.host)
+        self._next_id += 1
+        mid = str(self._next_id)
+        future = asyncio.get_event_loop().create_future()
+        future.add_done_callback(lambda f: self._slots.release())
+        self._pending[mid] = (future, [])
+        header = ('?%s[%s]' % (name, mid)).encode('utf-8')
+        self._writer.write(b' '.join([header] + [katcp_escape(a) for a in args]) + b'\n')
+        await self._writer.drain()
+        return mid, future
+
+    async def _wait(self, name, args, mid, future, timeout=None):
+        """ Wait for the reply to a request sent with _send, raising RuntimeError on failure """
+        try:
+            reply, informs = await asyncio.wait_for(future, timeout or self.timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError("Timed out waiting for reply to %s from %s." % (name, self.host))
+        finally:
+            self._pending.pop(mid, None)
+        if not reply or reply[0] != b'ok':
+            err = "Request %s failed.\n  Request: %s %s\n  Reply: %s." % (name, name, args[:2], reply)
+            self.logger.error(err)
+            raise RuntimeError(err)
+        return reply, informs
+
+    async def request(self, name, *args, **kwargs):
+        """ Send a request and wait for the reply
+
+        Args:
+            name (str): request name
+            args: request arguments (bytes, str or int)
+            timeout (float): optional, overrides self.timeout
+
+        Returns:
+            (reply, informs): reply arguments, and the arguments of each inform,
+            as lists of bytes
+        """
+        mid, future = await self._send(name, *args)
+        return await self._wait(name, args, mid, future, kwargs.get('timeout'))
+
+    async def request_burst(self, requests):
+        """ Send a list of (name, args) requests in order, then wait for all replies
+
+        Requests are sent back-to-back, with at most self.window in flight.
+        Raises RuntimeError on the first request that failed or timed out.
+        """
+        sent = []
+        for name, args in requests:
+            mid, future = await self._send(name, *args)
+            sent.append((name, args, mid, future))
+        results = await asyncio.gather(*[self._wait(*s) for s in sent], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    async def listdev(self):
+        """ Return a list of register / device names """
+        reply, informs = await self.request('listdev')
+        return [i[0].decode() for i in informs]
+
+    async def listbof(self):
+        """ Return a list of bof files stored on the board """
+        reply, informs = await self.request('listbof')
+        return [i[0].decode() for i in informs]
+
+    async def progdev(self, boffile, timeout=30.0):
+        """ Program the FPGA with a bof file stored on the board """
+        await self.request('progdev', boffile, timeout=timeout)
+
+    async def read(self, device_name, size, offset=0):
+        """ Return size bytes read from a device """
+        reply, informs = await self.request('read', device_name, offset, size)
+        return reply[1]
+
+    async def bulkread(self, device_name, size, offset=0):
+        """ Return size bytes read from a device, with the data sent as informs """
+        reply, informs = await self.request('bulkread', device_name, offset, size)
+        return b''.join(i[0] for i in informs)
+
+    async def blindwrite(self, device_name, data, offset=0):
+        """ Unchecked data write """
+        assert isinstance(data, bytes), 'You need to supply binary packed string data!'
+        assert (len(data) % 4) == 0, 'You must write 32bit-bounded words!'
+        assert (offset % 4) == 0, 'You must write 32bit-bounded words!'
+        await self.request('write', device_name, offset, data)
+
+    async def write(self, device_name, data, offset=0):
+        """ Write data, then read it back and raise RuntimeError if it does not match """
+        await self.blindwrite(device_name, data, offset)
+        new_data = await self.read(device_name, len(data), offset)
+        if new_data != data:
+            err = "Verification of write to %s at offset %d failed." % (device_name, offset)
+            self.logger.error(err)
+            raise RuntimeError(err)
+
+    async def read_int(self, device_name, word_offset=0):
+        """ Read a signed 32-bit integer """
+        data = await self.read(device_name, 4, word_offset * 4)
+        return struct.unpack('>i', data)[0]
+
+    async def read_uint(self, device_name, word_offset=0):
+        """ Read an unsigned 32-bit integer """
+        data = await self.read(device_name, 4, word_offset * 4)
+        return struct.unpack('>I', data)[0]
+
+    async def write_int(self, device_name, integer, blindwrite=False, word_offset=0):
+        """ Write a 32-bit integer, verified unless blindwrite is set """
+        data = struct.pack('>i' if integer < 0 else '>I', integer)
+        if blindwrite:
+            await self.blindwrite(device_name, data, word_offset * 4)
+        else:
+            await self.write(device_name, data, word_offset * 4)
+
+    async def write_int_burst(self, device_name, writes):
+        """ Blindwrite a list of (integer, word_offset) tuples, in order, as one burst """
+        await self.request_burst([('write', (device_name, word_offset * 4,
+                                             struct.pack('>i' if integer < 0 else '>I', integer)))
+                                  for integer, word_offset in writes])
+
+    async def read_burst(self, device_names, size, offset=0):
+        """ Read the same byte range from several devices as one burst """
+        replies = await self.request_burst([('read', (device_name, offset, size))
+                                            for device_name in device_names])
+        return [reply[1] for reply, informs in replies]
+
+    async def estimate_fpga_clock(self, interval=2.0):
+        """ Estimate the FPGA clock in MHz from sys_clkcounter """
+        c0 = await self.read_uint('sys_clkcounter')
+        await asyncio.sleep(interval)
+        c1 = await self.read_uint('sys_clkcounter')
+        return ((c1 - c0) % 2**32) / interval / 1e6
+
+
+class _AdcHost(object):
+    """ Blocking view of an AsyncKatcpClient, for running SnapAdc in a worker thread
+
+    Every register access is handed to the event loop and waited for, so
+    SnapAdc code runs unchanged while the connection stays in the loop.
+    ADC setup is shared with SnapBoard.
+    """
+    def __init__(self, client, loop):
+        self.client = client
+        self.loop = loop
+        self.host = client.host
+        self.uses_adc = True
+        self.adc = None
+        self.logger = logging.getLogger(client.host)
+
+    @property
+    def _adc(self):
+        # SnapBoard._setup_adc checks the (lazily attached) ADC as self._adc
+        return self.adc
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def listdev(self):
+        return self._call(self.client.listdev())
+
+    def read(self, device_name, size, offset=0):
+        return self._call(self.client.read(device_name, size, offset))
+
+    def read_int(self, device_name, word_offset=0):
+        return self._call(self.client.read_int(device_name, word_offset))
+
+    def write_int(self, device_name, integer, blindwrite=False, word_offset=0):
+        return self._call(self.client.write_int(device_name, integer, blindwrite, word_offset))
+
+    def write_int_burst(self, device_name, writes):
+        return self._call(self.client.write_int_burst(device_name, writes))
+
+    def read_burst(self, device_names, size, offset=0):
+        return self._call(self.client.read_burst(device_names, size, offset))
+
+    def est_brd_clk(self):
+        return self._call(self.client.estimate_fpga_clock())
+
+    is_adc16_based = SnapBoard.is_adc16_based
+    fpga_set_demux = SnapBoard.fpga_set_demux
+    _setup_adc     = SnapBoard._setup_adc
+
+
+class AsyncSnapManager(object):
+    """ Issue commands to many SNAP boards concurrently from one event loop
+
+    Args:
+        board_list (list): hostnames of the boards
+        katcp_port (int): KATCP port
+        timeout (float): seconds to wait for each reply
+        window (int): max. requests in flight per board
+        max_workers (int): max. boards running ADC setup / calibration at once
+    """
+    def __init__(self, board_list, katcp_port=7147, timeout=10.0, window=64, max_workers=32):
+        self.clients = [AsyncKatcpClient(host, katcp_port, timeout, window) for host in board_list]
+        self.adc_hosts = {}
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.logger = logging.getLogger('AsyncSnapManager')
+
+    async def _run_on_all(self, fn_to_run, *args, **kwargs):
+        """ Run coroutine function fn_to_run(client, *args, **kwargs) for every board at once
+
+        Returns a dict of results keyed by host. Raises RuntimeError naming the
+        boards that failed, once all boards have finished.
+        """
+        results = await asyncio.gather(*[fn_to_run(c, *args, **kwargs) for c in self.clients],
+                                       return_exceptions=True)
+        outdict = {}
+        failed = []
+        for client, result in zip(self.clients, results):
+            if isinstance(result, Exception):
+                self.logger.error("%s: %s" % (client.host, result))
+                failed.append(client.host)
+            else:
+                outdict[client.host] = result
+        if failed:
+            raise RuntimeError("%s failed on %s" % (fn_to_run.__name__, ', '.join(failed)))
+        return outdict
+
+    def _adc_host(self, client):
+        if client not in self.adc_hosts:
+            self.adc_hosts[client] = _AdcHost(client, asyncio.get_event_loop())
+        return self.adc_hosts[client]
+
+    async def _in_worker(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, fn, *args)
+
+    async def connect(self):
+        async def connect(client):
+            await client.connect()
+        await self._run_on_all(connect)
+
+    async def close(self):
+        for client in self.clients:
+            await client.close()
+        self.executor.shutdown(wait=False)
+
+    async def program(self, boffile, gain=1, demux_mode=1, chips=('a', 'b', 'c'), cal_cache=None):
+        """ Program every board, then initialize and calibrate its ADCs (see SnapBoard.program) """
+        async def program(client):
+            await client.progdev(boffile)
+            host = self._adc_host(client)
+            await self._in_worker(host._setup_adc, boffile, gain, demux_mode, chips, cal_cache)
+        await self._run_on_all(program)
+
+    async def recalibrate(self):
+        """ Rerun SERDES calibration on every board """
+        async def recalibrate(client):
+            host = self._adc_host(client)
+            if host.adc is None:
+                host.adc = SnapAdc(host)
+            await self._in_worker(host.adc.calibrate)
+        await self._run_on_all(recalibrate)
+
+    async def _capture(self, client, chip_nums=(0, 1, 2), n_samples=1024):
+        """ Trigger one snapshot on a board and read it back, as SnapAdc.capture does """
+        SNAP_REQ = 0x00010000
+        await client.write_int_burst('adc16_controller', [(0, 1), (SNAP_REQ, 1)])
+        snapshots = await client.read_burst(['adc16_wb_ram{0}'.format(cn) for cn in chip_nums], n_samples)
+        return np.frombuffer(b''.join(snapshots), dtype='int8').reshape(len(chip_nums), n_samples)
+
+    async def grab_adc_snapshot(self):
+        """ Return a snapshot of every chip on every board, keyed by 'host-chip' """
+        snapshots = await self._run_on_all(self._capture)
+        d = {}
+        for host, data in snapshots.items():
+            for chip_id, snapshot in enumerate(data):
+                d["%s-%i" % (host, chip_id)] = snapshot
+        return d
+
+    async def check_rms(self):
+        """ Return the RMS of a snapshot of every chip on every board, keyed by 'host-chip' """
+        d = await self.grab_adc_snapshot()
+        return dict((k, np.std(v)) for k, v in d.items())
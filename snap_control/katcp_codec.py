@@ -0,0 +1,61 @@
+"""
+# katcp_codec.py
+
+Encoding and decoding of KATCP message lines, shared by the asyncio client
+(katcp_async) and the simulated board (snap_sim). Works on Python 2 and 3.
+"""
+
+import re
+
+_ESCAPES = {b'\\': b'\\\\', b' ': b'\\_', b'\0': b'\\0', b'\n': b'\\n',
+            b'\r': b'\\r', b'\x1b': b'\\e', b'\t': b'\\t'}
+_UNESCAPES = dict((v[1:2], k) for k, v in _ESCAPES.items())
+_UNESCAPES[b'@'] = b''
+
+_ESCAPE_RE = re.compile(b'[\\\\ \0\n\r\x1b\t]')
+_UNESCAPE_RE = re.compile(b'\\\\(.)', re.DOTALL)
+_SPLIT_RE = re.compile(b'[ \t]+')
+_HEADER_RE = re.compile(b'^([?!#])([A-Za-z][A-Za-z0-9-]*)(?:\\[([0-9]+)\\])?$')
+
+
+def katcp_escape(arg):
+    """ Escape a request argument (bytes, str or int) for the wire """
+    if not isinstance(arg, (bytes, type(u''))):
+        arg = str(arg)
+    if not isinstance(arg, bytes):
+        arg = arg.encode('utf-8')
+    if not arg:
+        return b'\\@'
+    return _ESCAPE_RE.sub(lambda m: _ESCAPES[m.group(0)], arg)
+
+
+def katcp_unescape(arg):
+    """ Undo katcp_escape """
+    return _UNESCAPE_RE.sub(lambda m: _UNESCAPES.get(m.group(1), m.group(1)), arg)
+
+
+def parse_message(line):
+    """ Split a KATCP line into (type, name, message id or None, [args as bytes]) """
+    # Only space and tab separate arguments; other whitespace bytes may be data
+    parts = [p for p in _SPLIT_RE.split(line.rstrip(b'\r\n')) if p]
+    if not parts:
+        return None
+    m = _HEADER_RE.match(parts[0])
+    if m is None:
+        raise RuntimeError("Malformed KATCP message: %r" % line)
+    mtype, name, mid = m.groups()
+    return (str(mtype.decode()), str(name.decode()), str(mid.decode()) if mid else None,
+            [katcp_unescape(p) for p in parts[1:]])
+
+
+def format_message(mtype, name, args=(), mid=None):
+    """ Build a KATCP line (bytes, newline terminated)
+
+    Args:
+        mtype (str): '?', '!' or '#'
+        name (str): message name
+        args (list): arguments (bytes, str or int), escaped here
+        mid (str): message id, or None
+    """
+    header = '%s%s' % (mtype, name) if mid is None else '%s%s[%s]' % (mtype, name, mid)
+    return b' '.join([header.encode('utf-8')] + [katcp_escape(a) for a in args]) + b'\n'
@@ -0,0 +1,206 @@
+"""
+# katcp_pipeline.py
+
+Windowed pipelining of KATCP requests, shared by FpgaClient (katcp_wrapper)
+and SnapBoard's register bursts.
+
+Requests are sent through a katcp CallbackClient-style callback_request
+function without waiting for their replies, with at most `window` of them in
+flight; a barrier then waits for the replies:
+
+    ```
+    window = RequestWindow(client.callback_request, window=64, timeout=10.0)
+    replies = window.burst([Message.request('read', dev, '0', '4') for dev in devices])
+    ```
+
+Nothing here imports katcp, so it works with any client and message objects
+that have the same interface. Works on Python 2 and 3.
+"""
+
+import logging
+import threading
+import time
+
+
+class FpgaRequestFuture(object):
+    """ The pending result of a pipelined KATCP request
+
+    Args:
+        host (str): board the request was sent to
+        request (str): request name
+        args (list): request arguments
+        timeout (float): seconds to wait for the reply, from now
+        parse: optional function(reply, informs) applied by result()
+
+    Notes:
+        Call result() to wait for the reply.
+    """
+    def __init__(self, host, request, args, timeout, parse=None):
+        self.host = host
+        self.request = request
+        self.args = args
+        self.time_tx = time.time()
+        self.deadline = self.time_tx + timeout
+        self.reply = None
+        self.informs = []
+        self.error = None
+        self.released = False
+        self._parse = parse
+        self._done = threading.Event()
+
+    def __str__(self):
+        return '%s@(%10.5f) - reply%s - informs(%i)' % (self.request, self.time_tx, str(self.reply), len(self.informs))
+
+    def done(self):
+        return self._done.is_set()
+
+    def set_reply(self, reply_message):
+        self.reply = reply_message
+        if not reply_message.reply_ok():
+            self.error = "Request %s failed.\n  Request: %s %s\n  Reply: %s." % (
+                self.request, self.request, self.args[:2], reply_message)
+        self._done.set()
+
+    def set_error(self, error_string):
+        self.error = error_string
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """ Wait for the reply, by default until the request deadline. Returns True if it arrived """
+        if timeout is None:
+            timeout = max(self.deadline - time.time(), 0)
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        """ Wait for the reply and return it (parsed, if a parse function was given)
+
+        Raises RuntimeError if the request failed or timed out.
+        """
+        if not self.wait(timeout):
+            raise RuntimeError('Timed out waiting for reply to %s from %s.' % (self.request, self.host))
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        if self._parse is not None:
+            return self._parse(self.reply, self.informs)
+        return self.reply, self.informs
+
+
+class RequestWindow(object):
+    """ Send KATCP requests without waiting for their replies, at most `window` in flight
+
+    Args:
+        callback_request: function(msg, reply_cb, inform_cb, user_data, timeout),
+                          e.g. katcp.CallbackClient.callback_request
+        window (int): max. requests in flight; send() blocks beyond that
+        timeout (float): seconds to wait for each reply, and for a free slot
+        host (str): board name, for error messages
+        logger (logging.Logger): logs failed requests
+
+    Notes:
+        Replies arrive on the client's thread, while requests are sent and
+        waited for on the caller's, so all shared state is guarded by one
+        condition variable. A reply that arrives after its request timed out
+        is dropped.
+    """
+    def __init__(self, callback_request, window=64, timeout=10.0, host='', logger=None):
+        self.callback_request = callback_request
+        self.window = window
+        self.timeout = timeout
+        self.host = host
+        self.logger = logger or logging.getLogger('RequestWindow')
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._pending = []
+
+    def __repr__(self):
+        return "<RequestWindow %s: %i of %i in flight>" % (self.host, self._in_flight, self.window)
+
+    def _release(self, future):
+        """ Free the window slot of a future, once, whether it got a reply or gave up """
+        with self._cond:
+            if future.released:
+                return False
+            future.released = True
+            self._in_flight -= 1
+            self._cond.notify()
+            return True
+
+    def _reply_cb(self, msg, future):
+        if self._release(future):
+            future.set_reply(msg)
+
+    def _inform_cb(self, msg, future):
+        future.informs.append(msg)
+
+    def _send(self, msg, parse=None):
+        deadline = time.time() + self.timeout
+        with self._cond:
+            while self._in_flight >= self.window:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError('Timed out waiting for a free pipeline slot on %s.' % self.host)
+                self._cond.wait(remaining)
+            self._in_flight += 1
+
+        future = FpgaRequestFuture(self.host, msg.name, msg.arguments, self.timeout, parse)
+        try:
+            self.callback_request(msg, reply_cb=self._reply_cb, inform_cb=self._inform_cb,
+                                  user_data=(future,), timeout=self.timeout)
+        except Exception as e:
+            self._release(future)
+            future.set_error('Could not send %s to %s: %s' % (msg.name, self.host, e))
+            raise
+        return future
+
+    def _wait_all(self, futures):
+        """ Wait for every future, failing those past their deadline; raise on the first error """
+        for future in futures:
+            if not future.wait() and self._release(future):
+                future.set_error('Timed out waiting for reply to %s from %s.' % (future.request, self.host))
+        for future in futures:
+            if future.error is not None:
+                self.logger.error(future.error)
+                raise RuntimeError(future.error)
+
+    def send(self, msg, parse=None):
+        """ Send a request message without waiting for its reply
+
+        Blocks while the window is full. Call flush() to wait for the replies.
+
+        Args:
+            msg (katcp.Message): request
+            parse: optional function(reply, informs) applied by future.result()
+
+        Returns:
+            FpgaRequestFuture
+        """
+        future = self._send(msg, parse)
+        with self._cond:
+            self._pending.append(future)
+        return future
+
+    def flush(self):
+        """ Wait for the replies to all requests sent since the last flush
+
+        Raises RuntimeError on the first request (in the order they were sent)
+        that failed or timed out.
+        """
+        with self._cond:
+            pending, self._pending = self._pending, []
+        self._wait_all(pending)
+
+    def burst(self, msgs):
+        """ Send a list of request messages back-to-back, and wait for all their replies
+
+        Only this burst's replies are waited for, not those of requests sent
+        with send().
+
+        Returns:
+            replies (list): (reply, informs) for each request, in order
+
+        Notes:
+            Raises RuntimeError on the first request that failed or timed out.
+        """
+        futures = [self._send(msg) for msg in msgs]
+        self._wait_all(futures)
+        return [(f.reply, f.informs) for f in futures]
@@ -8,34 +8,48 @@
    @Revised 2009/12/01 to include print 10gbe core details.
    """
 
+from __future__ import print_function
+
 import struct, threading, socket, logging, time, os
+from collections import OrderedDict
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 from katcp import *
+
+from .katcp_pipeline import FpgaRequestFuture, RequestWindow
+from .snap_cache import bitstream_hash, board_fingerprint
+from .snap_upload import send_file, UploadStats
+
 log = logging.getLogger("katcp")
 
-class FpgaAsyncRequest:
+class FpgaAsyncRequest(FpgaRequestFuture):
     """A class to hold information about a specific KATCP request made by a Fpga.
+       It is also a future: wait() or result() block until the reply arrives.
        """
-    def __init__(self, host, request, request_id, inform_cb = None, reply_cb = None):
-        self.host = host
-        self.request = request
+    def __init__(self, host, request, request_id, inform_cb = None, reply_cb = None, timeout = 10.0, args = ()):
+        FpgaRequestFuture.__init__(self, host, request, args, timeout)
         self.request_id = request_id
-        self.time_tx = time.time()
-        self.informs = []
         self.inform_times = []
-        self.reply = None
         self.reply_time = -1
         self.reply_cb = reply_cb
         self.inform_cb = inform_cb
     def __str__(self):
         return '%s(%s)@(%10.5f) - reply%s - informs(%i)' % (self.request, self.request_id, self.time_tx, str(self.reply), len(self.informs))
+    def expired(self, now = None):
+        """Has the deadline passed without a reply?
+           """
+        return not self.done() and (now or time.time()) > self.deadline
     def got_reply(self, reply_message):
         if not (reply_message.name == self.request):
             error_string = 'rx reply(%s) does not match request(%s)' % (reply_message.name, self.request)
-            print error_string
+            print(error_string)
             raise RuntimeError(error_string)
-        self.reply = reply_message
         self.reply_time = time.time()
+        self.set_reply(reply_message)
         if self.reply_cb != None:
             self.reply_cb(self.host, self.request_id)
     def got_inform(self, inform_message):
@@ -43,7 +57,7 @@ class FpgaAsyncRequest:
             raise RuntimeError('Received inform for message(%s,%s) after reply. Invalid?' % (self.request, self.request_id))
         if not (inform_message.name == self.request):
             error_string = 'rx inform(%s) does not match request(%s)' % (inform_message.name, self.request)
-            print error_string
+            print(error_string)
             raise RuntimeError(error_string)
         self.informs.append(inform_message)
         self.inform_times.append(time.time())
@@ -89,47 +103,72 @@ class FpgaClient(CallbackClient):
         self._nb_request_id_lock = threading.Lock()
         self._nb_request_id = 0
         self._nb_requests_lock = threading.Lock()
-        self._nb_requests = {}
-        self._nb_max_requests = 100
+        self._nb_requests = OrderedDict()
+        self._nb_finished = OrderedDict()
+        self._nb_max_requests = 4096
+
+        # pipelined requests
+        self._pipeline = RequestWindow(self.callback_request, 64, timeout, host, self._logger)
 
     """**********************************************************************************"""
     """**********************************************************************************"""
 
     def _nb_get_request_by_id(self, request_id):
-        try:
-            return self._nb_requests[request_id]
-        except KeyError:
-            return None
+        with self._nb_requests_lock:
+            return self._nb_requests.get(request_id)
 
     def _nb_pop_request_by_id(self, request_id):
-        try:
-            self._nb_requests_lock.acquire()
-            r = self._nb_requests.pop(request_id)
-            self._nb_requests_lock.release()
-            return r
-        except KeyError:
-            return None
+        with self._nb_requests_lock:
+            return self._nb_requests.pop(request_id, None)
 
     def _nb_pop_oldest_request(self):
-        req = self._nb_requests[self._nb_requests.keys()[0]]
-        for k, v in self._nb_requests.iteritems():
-            if v.time_tx < req.time_tx:
-                req = v
-        self._nb_requests_lock.acquire()
-        r = self._nb_pop_request_by_id(req.request_id)
-        self._nb_requests_lock.release()
-        return r
+        """Remove and return the oldest request (requests are kept in the order they were sent).
+           """
+        with self._nb_requests_lock:
+            if not self._nb_requests:
+                return None
+            return self._nb_requests.popitem(last = False)[1]
+
+    def _nb_expire_requests(self):
+        """Move requests whose deadline has passed from the front of the table, failing any
+           that never got a reply. Deadlines grow with insertion order, so this stops at the
+           first request that is still live. Requests that did get a reply are kept in
+           _nb_finished (up to _nb_max_requests of them) until their result is read.
+           """
+        now = time.time()
+        expired = []
+        with self._nb_requests_lock:
+            while self._nb_requests:
+                request_id = next(iter(self._nb_requests))
+                if now <= self._nb_requests[request_id].deadline:
+                    break
+                req = self._nb_requests.pop(request_id)
+                if req.done():
+                    self._nb_finished[request_id] = req
+                    if len(self._nb_finished) > self._nb_max_requests:
+                        self._nb_finished.popitem(last = False)
+                else:
+                    expired.append(req)
+        for req in expired:
+            req.set_error('Timed out waiting for reply to %s(%s) from %s.' % (req.request, req.request_id, self.host))
+        return expired
 
     def _nb_get_request_result(self, request_id):
-        req = self._nb_get_request_by_id(request_id)
+        """Return (reply, informs) of a request, which may have finished before its deadline passed.
+           """
+        with self._nb_requests_lock:
+            req = self._nb_requests.get(request_id) or self._nb_finished.pop(request_id, None)
+        if req is None:
+            raise RuntimeError('No request with id(%s): it expired without a reply, or was evicted.' % request_id)
         return req.reply, req.informs
 
-    def _nb_add_request(self, request_name, request_id, inform_cb, reply_cb):
-        if self._nb_requests.has_key(request_id):
-            raise RuntimeError('Trying to add request with id(%s) but it already exists.' % request_id)
-        self._nb_requests_lock.acquire()
-        self._nb_requests[request_id] = FpgaAsyncRequest(self.host, request_name, request_id, inform_cb, reply_cb)
-        self._nb_requests_lock.release()
+    def _nb_add_request(self, request_name, request_id, inform_cb, reply_cb, args = ()):
+        req = FpgaAsyncRequest(self.host, request_name, request_id, inform_cb, reply_cb, self._timeout, args)
+        with self._nb_requests_lock:
+            if request_id in self._nb_requests:
+                raise RuntimeError('Trying to add request with id(%s) but it already exists.' % request_id)
+            self._nb_requests[request_id] = req
+        return req
 
     def _nb_get_next_request_id(self):
         self._nb_request_id_lock.acquire()
@@ -139,37 +178,156 @@ class FpgaClient(CallbackClient):
         return str(reqid)
 
     def _nb_replycb(self, msg, *userdata):
-        """The callback for request replies. Check that the ID exists and call that request's got_reply function.
+        """The callback for request replies. Look up the request by ID and call its got_reply function.
+           Replies to requests that already expired or were evicted are dropped.
            """
-        request_id = ''.join(userdata)
-        if not self._nb_requests.has_key(request_id):
-            raise RuntimeError('Recieved reply for request_id(%s), but no such stored request.' % request_id)
-        self._nb_requests[request_id].got_reply(msg.copy())
+        request_id = userdata[0]
+        req = self._nb_get_request_by_id(request_id)
+        if req is None or req.done():
+            self._logger.debug('Dropping late reply for request_id(%s).' % request_id)
+            return
+        req.got_reply(msg.copy())
 
     def _nb_informcb(self, msg, *userdata):
-        """The callback for request informs. Check that the ID exists and call that request's got_inform function.
+        """The callback for request informs. Look up the request by ID and call its got_inform function.
            """
-        request_id = ''.join(userdata)
-        if not self._nb_requests.has_key(request_id):
-            raise RuntimeError('Recieved inform for request_id(%s), but no such stored request.' % request_id)
-        self._nb_requests[request_id].got_inform(msg.copy())
+        request_id = userdata[0]
+        req = self._nb_get_request_by_id(request_id)
+        if req is None or req.done():
+            self._logger.debug('Dropping late inform for request_id(%s).' % request_id)
+            return
+        req.got_inform(msg.copy())
 
     def _nb_request(self, request, inform_cb = None, reply_cb = None, *args):
         """Make a non-blocking request.
            @param self      This object.
            @param request   The request string.
            @param inform_cb An optional callback function, called upon receipt of every inform to the request.
-           @param inform_cb An optional callback function, called upon receipt of the reply to the request.
+           @param reply_cb  An optional callback function, called upon receipt of the reply to the request.
            @param args      Arguments to the katcp.Message object.
+           @return  Dict with the host, request name, request id and the FpgaAsyncRequest ('future')
+                    to wait on. Requests are dropped from the table once past their deadline, or
+                    when more than _nb_max_requests are outstanding, oldest first.
            """
-        if len(self._nb_requests) == self._nb_max_requests:
+        self._nb_expire_requests()
+        while len(self._nb_requests) >= self._nb_max_requests:
             oldreq = self._nb_pop_oldest_request()
-            self._logger.info("Request list full, removing oldest one(%s,%s)." % (oldreq.request, oldreq.request_id))
-            print "Request list full, removing oldest one(%s,%s)." % (oldreq.request, oldreq.request_id)
+            if oldreq is None:
+                break
+            if not oldreq.done():
+                self._logger.warning("Request list full, removing oldest one(%s,%s)." % (oldreq.request, oldreq.request_id))
+                oldreq.set_error('Request %s(%s) evicted from full request list.' % (oldreq.request, oldreq.request_id))
         request_id = self._nb_get_next_request_id()
-        self._nb_add_request(request, request_id, inform_cb, reply_cb)
-        self.callback_request(msg = Message.request(request, *args), reply_cb = self._nb_replycb, inform_cb = self._nb_informcb, user_data = request_id)
-        return {'host': self.host, 'request': request, 'id': request_id}
+        req = self._nb_add_request(request, request_id, inform_cb, reply_cb, args)
+        self.callback_request(msg = Message.request(request, *args), reply_cb = self._nb_replycb, inform_cb = self._nb_informcb,
+                              user_data = (request_id,), timeout = self._timeout)
+        return {'host': self.host, 'request': request, 'id': request_id, 'future': req}
+
+    """**********************************************************************************"""
+    """**********************************************************************************"""
+
+    @property
+    def pipeline_window(self):
+        """Max. number of pipelined requests in flight at once.
+           """
+        return self._pipeline.window
+
+    @pipeline_window.setter
+    def pipeline_window(self, window):
+        self._pipeline.window = window
+
+    def pipelined_request(self, name, *args, **kwargs):
+        """Send a request without waiting for its reply.
+
+           At most self.pipeline_window requests are in flight at once; beyond that
+           this blocks until a reply frees a slot. Replies are collected through the
+           returned future; call flush() to wait for all of them.
+
+           @see katcp_pipeline.RequestWindow
+           @param self  This object.
+           @param name  String: name of the request message to send.
+           @param args  List of strings: request arguments.
+           @param parse Optional function(reply, informs) applied by future.result().
+           @return  FpgaRequestFuture.
+           """
+        return self._pipeline.send(Message.request(name, *args), kwargs.pop('parse', None))
+
+    def flush(self):
+        """Wait for the replies to all pipelined requests sent since the last flush.
+
+           Raise RuntimeError on the first request (in the order they were sent)
+           that failed or timed out.
+           @param self  This object.
+           """
+        self._pipeline.flush()
+
+    def blindwrite_nb(self, device_name, data, offset=0):
+        """Pipelined, unchecked data write. Call flush() to wait for the reply.
+
+           @see blindwrite
+           @param self  This object.
+           @param device_name  String: name of device / register to write to.
+           @param data  Byte string: data to write.
+           @param offset  Integer: offset to write data to (in bytes)
+           @return  FpgaRequestFuture.
+           """
+        assert isinstance(data, bytes) , 'You need to supply binary packed string data!'
+        assert (len(data)%4) ==0 , 'You must write 32bit-bounded words!'
+        assert ((offset%4) ==0) , 'You must write 32bit-bounded words!'
+        return self.pipelined_request("write", device_name, str(offset), data)
+
+    def write_int_nb(self, device_name, integer, offset=0):
+        """Pipelined blindwrite of an integer packed into 4 bytes.
+
+           @see write_int
+           @param self  This object.
+           @param device_name  String: name of device / register to write to.
+           @param integer  Integer: value to write.
+           @param offset  Integer: position in 32-bit words where to write data.
+           @return  FpgaRequestFuture.
+           """
+        if integer < 0:
+            data = struct.pack(">i", integer)
+        else:
+            data = struct.pack(">I", integer)
+        return self.blindwrite_nb(device_name, data, offset*4)
+
+    def read_nb(self, device_name, size, offset=0):
+        """Pipelined read. future.result() returns the binary data read.
+
+           @see read
+           @param self  This object.
+           @param device_name  String: name of device / register to read from.
+           @param size  Integer: amount of data to read (in bytes).
+           @param offset  Integer: offset to read data from (in bytes).
+           @return  FpgaRequestFuture.
+           """
+        return self.pipelined_request("read", device_name, str(offset), str(size),
+                                      parse = lambda reply, informs: reply.arguments[1])
+
+    def write_int_burst(self, device_name, writes):
+        """Blindwrite a sequence of integers to a register, pipelined, then flush.
+
+           @param self  This object.
+           @param device_name  String: name of register to write to.
+           @param writes  List of (integer, word_offset) tuples, written in order.
+           """
+        for integer, offset in writes:
+            self.write_int_nb(device_name, integer, offset)
+        self.flush()
+
+    def read_burst(self, device_names, size, offset=0):
+        """Read the same byte range from several devices, pipelined.
+
+           @param self  This object.
+           @param device_names  List of device names to read from.
+           @param size  Integer: amount of data to read from each (in bytes).
+           @param offset  Integer: offset to read data from (in bytes).
+           @return  List of binary strings, one per device.
+           """
+        futures = [self.read_nb(device_name, size, offset) for device_name in device_names]
+        self.flush()
+        return [f.result() for f in futures]
 
     """**********************************************************************************"""
     """**********************************************************************************"""
@@ -395,20 +553,26 @@ class FpgaClient(CallbackClient):
         if reply.arguments[0]=='ok': return
         else: raise RuntimeError("Failure stopping tap device %s." % (tap_dev))
 
-    def upload_program_bof(self, bof_file, port, timeout = 30):
+    def upload_program_bof(self, bof_file, port, timeout = 30, bitstream_cache = None, force = False):
         """Upload a BORPH file to the ROACH board for execution.
            @param self  This object.
            @param bof_file  The path and/or filename of the bof file to upload.
            @param port  The port to use for uploading.
            @param timeout  The timeout to use for uploading.
-           @return
+           @param bitstream_cache  Optional BitstreamCache. If the board is still
+                                   running bof_file, the upload is skipped.
+           @param force  Upload even if the cache says the board is running bof_file.
+           @return  UploadStats of the upload, or None if it was skipped.
         """
         # does the bof file exist on the local filesystem?
-        try:
-            os.path.getsize(bof_file)
-        except:
+        if not os.path.isfile(bof_file):
             raise IOError('BOF file not found.')
-        import time, Queue
+        bof_hash = bitstream_hash(bof_file)
+        if bitstream_cache is not None:
+            if not force and bitstream_cache.is_running(self, self.host, bof_hash):
+                self._logger.info("%s is already running %s, skipping upload" % (self.host, bof_file))
+                return None
+            bitstream_cache.invalidate(self.host)
         def makerequest(result_queue):
             try:
                 result = self._request('upload', timeout, port)
@@ -416,45 +580,44 @@ class FpgaClient(CallbackClient):
                     result_queue.put('OK')
                 else:
                     result_queue.put('Request to client returned, but not Message.OK.')
-            except:
-                result_queue.put('Request to client failed.')
+            except Exception as err:
+                result_queue.put('Request to client failed: %s' % err)
         def uploadbof(filename, result_queue):
-            upload_socket = socket.socket()
+            upload_socket = None
             stime = time.time()
-            connected = False
-            while (not connected) and (time.time() < (stime + 2)):
+            while (upload_socket is None) and (time.time() < (stime + 2)):
                 try:
-                    upload_socket = socket.socket()
-                    upload_socket.connect((self.host, port))
-                    connected = True
-                except:
+                    upload_socket = socket.create_connection((self.host, port))
+                except socket.error:
                     time.sleep(0.1)
-            if not connected:
+            if upload_socket is None:
                 result_queue.put('Could not connect to upload port.')
+                return
             try:
-                upload_socket.send(open(filename).read())
-            except:
-                result_queue.put('Could not send file to upload port.')
-            result_queue.put('OK')
+                result_queue.put(send_file(upload_socket, filename))
+            except (socket.error, RuntimeError) as err:
+                result_queue.put('Could not send file to upload port: %s' % err)
+            finally:
+                upload_socket.close()
         # request thread
-        request_queue = Queue.Queue()
+        request_queue = queue.Queue()
         request_thread = threading.Thread(target = makerequest, args = (request_queue,))
         # upload thread
-        upload_queue = Queue.Queue()
+        upload_queue = queue.Queue()
         upload_thread = threading.Thread(target = uploadbof, args = (bof_file, upload_queue,))
         # start the threads and join
         old_timeout = self._timeout
         self._timeout = timeout
         request_thread.start()
         upload_thread.start()
+        upload_thread.join()
         request_thread.join()
         self._timeout = old_timeout
         request_result = request_queue.get()
         upload_result = upload_queue.get()
-        if (request_result != 'OK') or (upload_result != 'OK'):
-            raise Exception('Error: request(%s), upload(%s)' %(request_result, upload_result))
-        debugstr = "Bof file upload for '%s': request (%s), upload (%s)" % (bof_file, request_result, upload_result)
-        self._logger.info(debugstr)
+        if (request_result != 'OK') or not isinstance(upload_result, UploadStats):
+            raise RuntimeError('Error: request(%s), upload(%s)' %(request_result, upload_result))
+        self._logger.info("Bof file upload for '%s': %s" % (bof_file, upload_result))
         stime = time.time()
         done = False
         while (not done) and (time.time() < stime + 15):
@@ -466,6 +629,10 @@ class FpgaClient(CallbackClient):
                 time.sleep(0.1)
         if not done:
             raise RuntimeError('BOF file seemed to upload, but is not running?')
+        if bitstream_cache is not None:
+            bitstream_cache.put(self.host, bof_hash, os.path.basename(bof_file), board_fingerprint(self))
+            bitstream_cache.save()
+        return upload_result
 
     def status(self):
         """Return the status of the FPGA.
@@ -541,14 +708,14 @@ class FpgaClient(CallbackClient):
 
         dram_indirect_page_size=(64*1024*1024)
         #read_chunk_size=(1024*1024)
-        if verbose: print 'Reading a total of %8i bytes from offset %8i...'%(size,offset)
+        if verbose: print('Reading a total of %8i bytes from offset %8i...'%(size,offset))
 
         while n_reads < size:
             dram_page=(offset+n_reads)/dram_indirect_page_size
             local_offset = (offset+n_reads)%(dram_indirect_page_size)
             #local_reads = min(read_chunk_size,size-n_reads,dram_indirect_page_size-(offset%dram_indirect_page_size))
             local_reads = min(size-n_reads,dram_indirect_page_size-(offset%dram_indirect_page_size))
-            if verbose: print 'Reading %8i bytes from indirect address %4i at local offset %8i...'%(local_reads,dram_page,local_offset)
+            if verbose: print('Reading %8i bytes from indirect address %4i at local offset %8i...'%(local_reads,dram_page,local_offset))
             if last_dram_page != dram_page:
                 self.write_int('dram_controller',dram_page)
                 last_dram_page = dram_page
@@ -574,13 +741,13 @@ class FpgaClient(CallbackClient):
 
         dram_indirect_page_size=(64*1024*1024)
         write_chunk_size=(1024*512)
-        if verbose: print 'writing a total of %8i bytes from offset %8i...'%(size,offset)
+        if verbose: print('writing a total of %8i bytes from offset %8i...'%(size,offset))
 
         while n_writes < size:
             dram_page=(offset+n_writes)/dram_indirect_page_size
             local_offset = (offset+n_writes)%(dram_indirect_page_size)
             local_writes = min(write_chunk_size,size-n_writes,dram_indirect_page_size-(offset%dram_indirect_page_size))
-            if verbose: print 'Writing %8i bytes from indirect address %4i at local offset %8i...'%(local_writes,dram_page,local_offset)
+            if verbose: print('Writing %8i bytes from indirect address %4i at local offset %8i...'%(local_writes,dram_page,local_offset))
             if last_dram_page != dram_page:
                 self.write_int('dram_controller',dram_page)
                 last_dram_page = dram_page
@@ -622,7 +789,7 @@ class FpgaClient(CallbackClient):
            @param data  Byte string: data to write.
            @param offset  Integer: offset to write data to (in bytes)
            """
-        assert (type(data)==str) , 'You need to supply binary packed string data!'
+        assert isinstance(data, bytes) , 'You need to supply binary packed string data!'
         assert (len(data)%4) ==0 , 'You must write 32bit-bounded words!'
         assert ((offset%4) ==0) , 'You must write 32bit-bounded words!'
         self._request("write", self._timeout, device_name, str(offset), data)
@@ -718,7 +885,7 @@ class FpgaClient(CallbackClient):
         #ip_prefix = '%3d.%3d.%3d.'%(port_dump[0x10],port_dump[0x11],port_dump[0x12])
 
         rv={}
-        mymac=((port_dump[02]<<40) + (port_dump[03]<<32) + (port_dump[04]<<24) + (port_dump[05]<<16) + (port_dump[06]<<8) + port_dump[07])
+        mymac=((port_dump[2]<<40) + (port_dump[3]<<32) + (port_dump[4]<<24) + (port_dump[5]<<16) + (port_dump[6]<<8) + port_dump[7])
         rv['mymac']=mymac
 
         gateway=((port_dump[0x0c]<<24) + (port_dump[0x0d]<<16) + (port_dump[0x0e]<<8) + (port_dump[0x0f]))
@@ -783,75 +950,75 @@ class FpgaClient(CallbackClient):
         port_dump=list(struct.unpack('>16384B',self.read(dev_name,16384)))
         ip_prefix= '%3d.%3d.%3d.'%(port_dump[0x10],port_dump[0x11],port_dump[0x12])
 
-        print '------------------------'
-        print 'GBE0 Configuration...'
-        print 'My MAC: ',
-        for m in port_dump[02:02+6]:
-            print '%02X'%m,
-        print ''
+        print('------------------------')
+        print('GBE0 Configuration...')
+        print('My MAC: ', end=' ')
+        for m in port_dump[2:2+6]:
+            print('%02X'%m, end=' ')
+        print('')
 
-        print 'Gateway: ',
+        print('Gateway: ', end=' ')
         for g in port_dump[0x0c:0x0c+4]:
-            print '%3d'%g,
-        print ''
+            print('%3d'%g, end=' ')
+        print('')
 
-        print 'This IP: ',
+        print('This IP: ', end=' ')
         for i in port_dump[0x10:0x10+4]:
-            print '%3d'%i,
-        print ''
+            print('%3d'%i, end=' ')
+        print('')
 
-        print 'Subnet Mask: ',
+        print('Subnet Mask: ', end=' ')
         for i in port_dump[0x38:0x38+4]:
-            print '%3d'%i,
-        print ''
+            print('%3d'%i, end=' ')
+        print('')
 
-        print 'Gateware Port: ',
-        print '%5d'%(port_dump[0x22]*(2**8)+port_dump[0x23])
+        print('Gateware Port: ', end=' ')
+        print('%5d'%(port_dump[0x22]*(2**8)+port_dump[0x23]))
 
-        print 'Fabric interface is currently: ',
-        if port_dump[0x21]&1: print 'Enabled'
-        else: print 'Disabled'
+        print('Fabric interface is currently: ', end=' ')
+        if port_dump[0x21]&1: print('Enabled')
+        else: print('Disabled')
 
 
-        print 'XAUI Status: ',
-        print '%02X%02X%02X%02X'%(port_dump[0x24],port_dump[0x25],port_dump[0x26],port_dump[0x27])
-        print '\t lane sync 0: %i'%bool(port_dump[0x27]&4)
-        print '\t lane sync 1: %i'%bool(port_dump[0x27]&8)
-        print '\t lane sync 2: %i'%bool(port_dump[0x27]&16)
-        print '\t lane sync 3: %i'%bool(port_dump[0x27]&32)
-        print '\t Channel bond: %i'%bool(port_dump[0x27]&64)
+        print('XAUI Status: ', end=' ')
+        print('%02X%02X%02X%02X'%(port_dump[0x24],port_dump[0x25],port_dump[0x26],port_dump[0x27]))
+        print('\t lane sync 0: %i'%bool(port_dump[0x27]&4))
+        print('\t lane sync 1: %i'%bool(port_dump[0x27]&8))
+        print('\t lane sync 2: %i'%bool(port_dump[0x27]&16))
+        print('\t lane sync 3: %i'%bool(port_dump[0x27]&32))
+        print('\t Channel bond: %i'%bool(port_dump[0x27]&64))
 
-        print 'XAUI PHY config: '
-        print '\tRX_eq_mix: %2X'%port_dump[0x28]
-        print '\tRX_eq_pol: %2X'%port_dump[0x29]
-        print '\tTX_pre-emph: %2X'%port_dump[0x2a]
-        print '\tTX_diff_ctrl: %2X'%port_dump[0x2b]
+        print('XAUI PHY config: ')
+        print('\tRX_eq_mix: %2X'%port_dump[0x28])
+        print('\tRX_eq_pol: %2X'%port_dump[0x29])
+        print('\tTX_pre-emph: %2X'%port_dump[0x2a])
+        print('\tTX_diff_ctrl: %2X'%port_dump[0x2b])
 
         if arp:
-            print 'ARP Table: '
+            print('ARP Table: ')
             for i in range(256):
-                print 'IP: %s%3d: MAC:'%(ip_prefix,i),
+                print('IP: %s%3d: MAC:'%(ip_prefix,i), end=' ')
                 for m in port_dump[0x3000+i*8+2:0x3000+i*8+8]:
-                    print '%02X'%m,
-                print ''
+                    print('%02X'%m, end=' ')
+                print('')
 
         if cpu:
-            print 'CPU TX Interface (at offset 4096bytes):'
-            print 'Byte offset:  Contents (Hex)'
+            print('CPU TX Interface (at offset 4096bytes):')
+            print('Byte offset:  Contents (Hex)')
             for i in range(4096/8):
-                print '%04i:        '%(i*8),
-                for l in range(8): print '%02x'%port_dump[4096+8*i+l],
-                print ''
-            print '------------------------'
-
-            print 'CPU RX Interface (at offset 8192bytes):'
-            print 'CPU packet RX buffer unacknowledged data: %i'%port_dump[6*4+3]
-            print 'Byte offset:  Contents (Hex)'
+                print('%04i:        '%(i*8), end=' ')
+                for l in range(8): print('%02x'%port_dump[4096+8*i+l], end=' ')
+                print('')
+            print('------------------------')
+
+            print('CPU RX Interface (at offset 8192bytes):')
+            print('CPU packet RX buffer unacknowledged data: %i'%port_dump[6*4+3])
+            print('Byte offset:  Contents (Hex)')
             for i in range(port_dump[6*4+3]+8):
-                print '%04i:        '%(i*8),
-                for l in range(8): print '%02x'%port_dump[8192+8*i+l],
-                print ''
-        print '------------------------'
+                print('%04i:        '%(i*8), end=' ')
+                for l in range(8): print('%02x'%port_dump[8192+8*i+l], end=' ')
+                print('')
+        print('------------------------')
 
     def est_brd_clk(self):
         """Returns the approximate clock rate of the FPGA in MHz."""
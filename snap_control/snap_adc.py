@@ -79,13 +79,20 @@ https://casper.berkeley.edu/wiki/images/0/05/Hittite_hmcad1511.pdf
 
 
 import logging
-import struct
 import time
+from contextlib import contextmanager
 
 import numpy as np
 from pkg_resources import resource_filename
 
 from .snap_plot import demux_data
+from .snap_cal import count_lane_errors, sync_bitslips, find_eyes, pattern_fraction
+from .snap_cal import LANE_IDS, N_TAPS, N_LANES, DESKEW_VAL, SYNC_VAL
+from .snap_stream import CaptureStream
+from .snap_profile import NULL_PROFILER, profiled_phase
+
+# Test patterns that wait_for_pattern knows how to recognize
+PATTERN_CHECKS = ('ramp', 'deskew', 'sync')
 
 # Notes:
 # Load ADC MAP (Table 5 in HMCAD1511 spec sheet)
@@ -105,8 +112,17 @@ INPUT_MAP  = {1: 0b00010,
               3: 0b01000,
               4: 0b10000}
 
+_ADC_MAP_CACHE = {}
+
 def generate_adc_map():
-    """ Generate ADC map from text file """
+    """ Generate ADC map from text file
+
+    Notes:
+        The file is only parsed once; later calls return the same map, which
+        is treated as read-only.
+    """
+    if ADC_MAP_TXT in _ADC_MAP_CACHE:
+        return _ADC_MAP_CACHE[ADC_MAP_TXT]
     d = np.genfromtxt(ADC_MAP_TXT, delimiter='|', skip_header=2, dtype='str')
     ADC_MAP = {}
 
@@ -136,8 +152,71 @@ def generate_adc_map():
     for name, hex_addr, width, offset, description in d:
         ADC_MAP[name.strip()] = AdcRegister(name, hex_addr, width, offset, description)
 
+    _ADC_MAP_CACHE[ADC_MAP_TXT] = ADC_MAP
     return ADC_MAP
 
+class AdcRegisterFile(object):
+    """ Shadow copy of the 16-bit HMCAD1511 registers of a single chip
+
+    Built from ADC_MAP. Keeps the last word written to each hex address, so
+    that single fields can be updated with read-modify-write and writes that
+    would not change the register word can be skipped.
+
+    Args:
+        adc_map (dict): ADC register map, as returned by generate_adc_map()
+
+    Notes:
+        Words start out unknown: the first write to each address is always
+        sent. The contents are forgotten again when the chip is reset.
+    """
+    # Self-clearing registers (rst) are never shadowed
+    VOLATILE_ADDRS = (0x00,)
+
+    def __init__(self, adc_map):
+        self.adc_map = adc_map
+        self.addrs = sorted(set(r.addr for r in adc_map.values()))
+        self.reset()
+
+    def __repr__(self):
+        return "<AdcRegisterFile: %i/%i words known>" % (len(self.known), len(self.addrs))
+
+    def reset(self):
+        """ Forget all register contents, e.g. after a chip reset """
+        self.words = dict((addr, 0) for addr in self.addrs)
+        self.known = set()
+
+    def merge(self, regdict):
+        """ Return the word resulting from merging register values into the shadow
+
+        Args:
+            regdict (dict): Dictionary of register_name : value pairs, all
+                            residing within the same hex address
+        """
+        word = None
+        for regname, regvalue in regdict.items():
+            r = self.adc_map[regname]
+            if word is None:
+                word = self.words.get(r.addr, 0)
+            mask = (2**r.width - 1) << r.offset
+            word = (word & ~mask) | ((regvalue << r.offset) & mask)
+        return word
+
+    def is_current(self, addr, word):
+        """ Check if word is already known to be in the register at addr """
+        if addr in self.VOLATILE_ADDRS:
+            return False
+        return addr in self.known and self.words[addr] == word
+
+    def update(self, addr, word):
+        """ Record that word has been written to the register at addr """
+        if addr in self.VOLATILE_ADDRS:
+            if word & 1:
+                self.reset()
+            return
+        self.words[addr] = word & 0xffff
+        self.known.add(addr)
+
+
 class GenericAdc(object):
     """ Stand-in for generic ADCs """
     def __repr__(self):
@@ -171,8 +250,21 @@ class SnapAdc(object):
         self.chips = {'a': 0, 'b': 1, 'c': 2}
         self.ADC_MAP = generate_adc_map()
         self.INPUT_MAP = INPUT_MAP
+        # Shadow copy of the HMCAD1511 registers, one per chip
+        self.registers = dict((chip_num, AdcRegisterFile(self.ADC_MAP)) for chip_num in (0, 1, 2))
         self.control_register = 'adc16_controller'
 
+        # Delay taps and eye margins chosen by walk_taps, per chip number
+        self.cal_state = {}
+        # Bitslips applied to each lane since the FPGA was programmed
+        self.bitslips = dict((chip_num, np.zeros(N_LANES, dtype='int32')) for chip_num in (0, 1, 2))
+
+        # Queued 3-wire states for the current spi_transaction(), and the
+        # chip select mask of the chips they write to
+        self._spi_depth    = 0
+        self._spi_pending  = []
+        self._spi_chips    = 0
+
         self.logger = logging.getLogger('SnapAdc')
 
     def set_chip_select(self, chips):
@@ -205,82 +297,166 @@ class SnapAdc(object):
                 self.chips = {'a': 0, 'b': 1, 'c': 2}
             else:
                 self.chips = {}
-                chip_a, chip_b, chip_c = 0, 0, 0
                 if 'a' in chips:
-                    chip_a = 1
                     self.chips['a'] = 0
                 if 'b' in chips:
-                    chip_b = 1
                     self.chips['b'] = 1
                 if 'c' in chips:
-                    chip_c = 1
                     self.chips['c'] = 2
-                self.chip_select = int('0b%i%i%i' % (chip_a, chip_b, chip_c), 2)
+                # Chip n is bit n, as for the string options and the shadow registers
+                self.chip_select = 0
+                for chip_num in self.chips.values():
+                    self.chip_select |= 1 << chip_num
+
+    @property
+    def profiler(self):
+        """ The host's Profiler while it is being profiled (see SnapBoard.profile) """
+        return getattr(self.host, 'profiler', NULL_PROFILER)
 
     def _write(self, value, word_offset=0, blindwrite=True):
         """ Write value to control register """
+        t0 = time.time()
         self.host.write_int(self.control_register, value,
                             word_offset=word_offset, blindwrite=blindwrite)
+        self.profiler.record('adc.write', time.time() - t0, 4)
+
+    def _write_burst(self, writes):
+        """ Write a sequence of values to the control register in one burst
 
-    def write(self, addr, data):
+        Args:
+            writes (list): list of (value, word_offset) tuples, written in order
+
+        Notes:
+            Uses the host's pipelined write_int_burst where available, so the
+            whole sequence costs a single round-trip. Falls back to one
+            blindwrite per value otherwise.
         """
-        # write_adc is used for writing specific ADC registers.
-        # ADC controller can only write to adc one bit at a time at rising clock edge
+        t0 = time.time()
+        if hasattr(self.host, 'write_int_burst'):
+            self.host.write_int_burst(self.control_register, writes)
+        else:
+            for value, word_offset in writes:
+                self.host.write_int(self.control_register, value,
+                                    word_offset=word_offset, blindwrite=True)
+        self.profiler.record('adc.write_burst', time.time() - t0, 4 * len(writes), len(writes))
+
+    @contextmanager
+    def spi_transaction(self):
+        """ Batch ADC register writes into a single SPI burst
+
+        Any calls to write() made inside the context are queued, and the
+        complete 3-wire word sequence is sent as one burst when the context
+        exits. Nested transactions are merged into the outermost one.
+
+        Example:
+            with s.adc.spi_transaction():
+                s.adc.write_register('channel_num', 4)
+                s.adc.set_input1(1, 2, 3, 4)
+
+        Notes:
+            If the transaction is aborted, by an exception inside the context
+            or a failed burst, the queued writes are dropped and the shadow
+            register files of the chips they were for are reset, since it is
+            unknown which writes reached the chips.
         """
-        self.logger.debug("WRITING ADDR: %s VAL: %s" % (hex(addr), hex(data)))
+        outermost = self._spi_depth == 0
+        self._spi_depth += 1
+        completed = False
+        try:
+            yield
+            if outermost and self._spi_pending:
+                self._write_burst([(state, 0) for state in self._spi_pending])
+            completed = True
+        finally:
+            self._spi_depth -= 1
+            if outermost:
+                if not completed:
+                    for chip_num, regfile in self.registers.items():
+                        if (self._spi_chips >> chip_num) & 1:
+                            regfile.reset()
+                self._spi_pending = []
+                self._spi_chips = 0
+
+    def _spi_states(self, addr, data, chip_select):
+        """ Build the adc16_controller word 0 sequence for one 3-wire write
+
+        Args:
+            addr (int): 8-bit ADC register address
+            data (int): 16-bit register value
+            chip_select (int): chip select bitmask
 
+        Returns:
+            states (list): 50 words -- idle, then each of the 24 address and
+            data bits with SCLK low then high, then idle.
+        """
         SCLK = 0x200
-        CS = self.chip_select
+        CS = chip_select
         IDLE = SCLK
         SDA_SHIFT = 8
-        self._write(IDLE, word_offset=0)
-        for i in range(8):
-            addr_bit = (addr >> (8 - i - 1)) & 1
-            state = (addr_bit << SDA_SHIFT) | CS
-            self._write(state, word_offset=0)
-            #self.logger.debug("Printing address state written to adc16_controller, word_offset=0, clock low")
-            #self.logger.debug(np.binary_repr(state, width=32))
-            state = (addr_bit << SDA_SHIFT) | CS | SCLK
-            self._write(state, word_offset=0)
-            #self.logger.debug("Printing address state written to adc16_controller, word_offset=0, clock high")
-            #self.logger.debug(np.binary_repr(state, width=32))
-
-        for j in range(16):
-            data_bit = (data >> (16 - j - 1)) & 1
-            state = (data_bit << SDA_SHIFT) | CS
-            self._write(state, word_offset=0, blindwrite=True)
-            #self.logger.debug("Printing data state written to adc16_controller, word_offset=0, clock low")
-            #self.logger.debug(np.binary_repr(state, width=32))
-            state = (data_bit << SDA_SHIFT) | CS | SCLK
-            self._write(state, word_offset=0, blindwrite=True)
-            #self.logger.debug("Printing data address state written to adc16_controller, word_offset=0, clock high")
-            #self.logger.debug(np.binary_repr(state, width=32))
-
-        self._write(IDLE, word_offset=0, blindwrite=True)
-
-    def write_register(self, register, value):
+
+        word = ((addr & 0xff) << 16) | (data & 0xffff)
+        states = [IDLE]
+        for i in range(24):
+            bit = (word >> (24 - i - 1)) & 1
+            state = (bit << SDA_SHIFT) | CS
+            states.append(state)
+            states.append(state | SCLK)
+        states.append(IDLE)
+        return states
+
+    def write(self, addr, data, chip_select=None):
+        """
+        # write_adc is used for writing specific ADC registers.
+        # ADC controller can only write to adc one bit at a time at rising clock edge
+
+        Args:
+            addr (int): 8-bit ADC register address
+            data (int): 16-bit register value
+            chip_select (int): chip select bitmask, defaults to self.chip_select
+
+        Notes:
+            The clock/data/chip-select sequence is built up front and sent as
+            a single burst. Inside a spi_transaction() the sequence is queued
+            and sent together with the other writes of the transaction.
+            The shadow register file of each selected chip is updated, so
+            later writes in the transaction merge with this one (see
+            spi_transaction for what happens if the transaction fails).
+        """
+        self.logger.debug("WRITING ADDR: %s VAL: %s" % (hex(addr), hex(data)))
+
+        if chip_select is None:
+            chip_select = self.chip_select
+        states = self._spi_states(addr, data, chip_select)
+        if self._spi_depth:
+            # Back-to-back transactions only need a single idle word between them
+            if self._spi_pending and self._spi_pending[-1] == states[0]:
+                states = states[1:]
+            self._spi_pending.extend(states)
+            self._spi_chips |= chip_select
+        else:
+            self._write_burst([(state, 0) for state in states])
+
+        for chip_num, regfile in self.registers.items():
+            if (chip_select >> chip_num) & 1:
+                regfile.update(addr, data)
+
+    def write_register(self, register, value, force=False):
         """ Write register with value
 
         Looks up the hex address and offset of the register, then
-        writes the value with appropriate offsets.
+        merges the value into the shadow copy of that hex address.
 
         Args:
             register (str): register name
             value (int/bin/hex): Value to write to register
+            force (bool): Send the SPI write even if the register word is unchanged
 
         Notes:
-            This will override any other register that shares the hex address.
+            Other registers that share the hex address keep their shadowed value.
         """
-        r = self.ADC_MAP[register]
-        try:
-            assert value <= (2**r.width - 1)
-        except AssertionError:
-            raise RuntimeError("Value %i is wider than address width of %i" % (value, r.width))
-
-        r_val = value << r.offset
-        self.write(r.addr, r_val)
+        self.write_shared_registers({register: value}, force=force)
 
-    def write_shared_registers(self, regdict):
+    def write_shared_registers(self, regdict, force=False):
         """ Write multiple registers to one hex address at once.
 
         As with write_register, but takes dictionary for multiple registers
@@ -288,9 +464,14 @@ class SnapAdc(object):
 
         Args:
             regdict (dict): Dictionary of register_name : value pairs
+            force (bool): Send the SPI write even if the register word is unchanged
+
+        Notes:
+            The new word is computed per chip with read-modify-write on the
+            shadow register file. Chips whose word would not change are skipped,
+            and chips that end up with the same word share one SPI write.
         """
         hex_addr = None
-        shared_val = 0
         for regname, regvalue in regdict.items():
             r = self.ADC_MAP[regname]
             if hex_addr is None:
@@ -304,43 +485,98 @@ class SnapAdc(object):
                 assert regvalue <= (2**r.width - 1)
             except AssertionError:
                 raise RuntimeError("Value %i is wider than address width of %i" % (regvalue, r.width))
-            r_val = regvalue << r.offset
-            shared_val += r_val     # As they're all offset you can just add 'em together
 
-        self.write(r.addr, shared_val)
+        # Group the selected chips by the word they need written
+        chip_groups = {}
+        for chip_num, regfile in self.registers.items():
+            if not (self.chip_select >> chip_num) & 1:
+                continue
+            word = regfile.merge(regdict)
+            if force or not regfile.is_current(hex_addr, word):
+                chip_groups[word] = chip_groups.get(word, 0) | (1 << chip_num)
+
+        if not chip_groups:
+            self.logger.debug("Skipping write to ADDR: %s, value unchanged" % hex(hex_addr))
+        for word, chip_select in sorted(chip_groups.items()):
+            self.write(hex_addr, word, chip_select=chip_select)
+
+    def snap_request(self):
+        """ Trigger a new snapshot into all adc16_wb_ram devices at once """
+        SNAP_REQ = 0x00010000
+        self._write_burst([(0, 1), (SNAP_REQ, 1)])
 
     def read_ram(self, device):
-        SNAP_REQ = 0x00010000
-        self._write(0, word_offset=1, blindwrite=True)
-        self._write(SNAP_REQ, word_offset=1, blindwrite=True)
-        # Read the device that is passed to the read_ram method,1024 elements at a time,
-        # snapshot is a binary string that needs to get unpacked
-        # Part of the read request is the size parameter,1024, which specifies the
-        # amount of bytes to read form the device
-        snapshot = self.host.read(device, 1024, offset=0)
-
-        # struct unpack returns a tuple of signed int values.
-        # Since we're requesting to read adc16_wb_ram at a size of 1024 bytes, we are unpacking
-        # 1024 bytes each of which is a signed char(in C, python only knows ints). Unpacking as
-        # a signed char is for mapping purposes:
+        """ Trigger a snapshot and read it back from a single adc16_wb_ram device """
+        self.snap_request()
+        return self._read_snapshots([device])[0]
+
+    def capture(self, chip_nums=None, n_samples=1024):
+        """ Trigger a single snapshot and read it back from several chips
+
+        All adc16_wb_ram devices are armed by the same snap request, so the data
+        from the different chips is captured simultaneously.
+
+        Args:
+            chip_nums (list): chip numbers to read, defaults to all enabled chips
+            n_samples (int): number of samples (bytes) to read per chip
+
+        Returns:
+            data (np.array): int8 array of shape (len(chip_nums), n_samples)
+        """
+        if chip_nums is None:
+            chip_nums = sorted(self.chips.values())
+        self.snap_request()
+        return self._read_snapshots(['adc16_wb_ram{0}'.format(cn) for cn in chip_nums], n_samples)
+
+    def stream(self, chip_nums=None, n_samples=1024, batch_size=1, queue_size=2,
+               drop=False, max_batches=None):
+        """ Capture snapshots continuously, prefetching on a background thread
+
+        Args:
+            chip_nums (list): chip numbers to read, defaults to all enabled chips
+            n_samples (int): number of samples (bytes) to read per chip
+            batch_size (int): snapshots per yielded batch
+            queue_size (int): max. batches waiting to be consumed
+            drop (bool): drop the oldest batch, rather than pausing capture,
+                         when the consumer falls behind
+            max_batches (int): number of batches to capture, default no limit
+
+        Returns:
+            CaptureStream, iterating over (timestamps, data) batches with data
+            of shape (batch_size, len(chip_nums), n_samples). Use it as a
+            context manager, or call stop() when done.
+        """
+        return CaptureStream(self, chip_nums, n_samples, batch_size, queue_size,
+                             drop, max_batches)
+
+    def _read_snapshots(self, devices, n_samples=1024):
+        """ Read back the last triggered snapshot from adc16_wb_ram devices
+
+        Returns an int8 array of shape (len(devices), n_samples)
+        """
+        # Read the devices that are passed in, n_samples bytes each, as one
+        # pipelined burst where the host supports it.
+        t0 = time.time()
+        if hasattr(self.host, 'read_burst'):
+            snapshots = self.host.read_burst(devices, n_samples, offset=0)
+        else:
+            snapshots = [self.host.read(device, n_samples, offset=0) for device in devices]
+        self.profiler.record('adc.read_snapshot', time.time() - t0,
+                             n_samples * len(devices), len(devices))
 
         # ADC returns values from 0 to 255 (since it's an 8 bit ADC), the voltage going into ADC
         # varies from -1V to 1V, we want 0 to mean 0, not -1 volts so we need to remap the output
         # of the ADC to something more sensible, like -128 to 127. That way 0 volts corresponds to
-        # a 0 value in the unpacked data.
-        string_data = struct.unpack('>1024b', snapshot)
-        # Converting the tuple into a vector of 1024 elements
-        array_data = np.array(string_data)
-        #		for i in range(array_data.shape[0]):
-        #			print('{:08b}'.format(array_data[i]))
-        # print(array_data)
-        return array_data
+        # a 0 value in the data, so each byte is interpreted as a signed char (int8).
+        buf = bytearray(b''.join(snapshots))
+        return np.frombuffer(buf, dtype='int8').reshape(len(devices), n_samples)
 
     def power_cycle(self):
         """ Power cycle the ADC """
         logging.info('Power cycling the ADC')
-        self.power_off()
-        self.power_on()
+        with self.spi_transaction():
+            self.power_off()
+            self.power_on()
 
     def power_off(self):
         """ Turn power to ADC off """
@@ -356,6 +592,7 @@ class SnapAdc(object):
         """ Reset the ADC """
         self.write_register('rst', 1)
 
+    @profiled_phase('initialize')
     def initialize(self, chips='all', demux_mode=1, gain=1):
         """ Initialize the ADC
 
@@ -366,10 +603,11 @@ class SnapAdc(object):
         """
         self.logger.info('Initializing ADC')
         self.set_chip_select(chips)
-        self.reset()
-        self.set_demux(demux_mode)
-        self.set_gain(gain)
-        self.power_cycle()
+        with self.spi_transaction():
+            self.reset()
+            self.set_demux(demux_mode)
+            self.set_gain(gain)
+            self.power_cycle()
 
 
     def set_demux(self, demux_mode):
@@ -383,26 +621,27 @@ class SnapAdc(object):
             demux_mode (int): Set demulitplexing to 1 (no interleave), 2 or 4 (interleave all)
 
         """
-        self.demux_mode = demux_mode
-        if self.demux_mode == 1:
-            self.logger.info('Routing all four inputs to corresponding ADC channels')
-            self.write_register('channel_num', 4)
-            self.set_input1(1, 2, 3, 4)
-
-        elif self.demux_mode == 2:
-            self.logger.info('Setting ADC to interleave inputs 1 (ADC0) and 3 (ADC2)')
-            self.write_register('channel_num', 2)
-            self.set_input2(1, 3)
-
-        elif self.demux_mode == 4:
-            self.logger.info('Setting ADC to interleave input (ADC0)')
-            self.write_register('channel_num', 1)
-            self.set_input4(1)
-
-        else:
+        if demux_mode not in (1, 2, 4):
             self.logger.error('demux_mode variable not assigned. Weird.')
             raise RuntimeError('Demux mode variable not assigned. Weird.')
 
+        self.demux_mode = demux_mode
+        with self.spi_transaction():
+            if self.demux_mode == 1:
+                self.logger.info('Routing all four inputs to corresponding ADC channels')
+                self.write_register('channel_num', 4)
+                self.set_input1(1, 2, 3, 4)
+
+            elif self.demux_mode == 2:
+                self.logger.info('Setting ADC to interleave inputs 1 (ADC0) and 3 (ADC2)')
+                self.write_register('channel_num', 2)
+                self.set_input2(1, 3)
+
+            elif self.demux_mode == 4:
+                self.logger.info('Setting ADC to interleave input (ADC0)')
+                self.write_register('channel_num', 1)
+                self.set_input4(1)
+
     def set_input4(self, input_id):
         """ Set input for demux mode 4 """
         ip = self.INPUT_MAP[input_id]
@@ -444,21 +683,28 @@ class SnapAdc(object):
         Example:
             set_adc_inputs(3,2,1,4)
         """
-        if len(args) == 1:
-            self.set_input4(args[0])
-        elif len(args) == 2:
-            self.set_input2(args[0], args[1])
-        elif len(args) == 4:
-            self.set_input1(args[0], args[1], args[2], args[3])
-        else:
+        if len(args) not in (1, 2, 4):
             raise RuntimeError("Num. inputs (%i) must be 1, 2, or 4." % (len(args)))
-
-    def enable_pattern(self, pattern):
+        with self.spi_transaction():
+            if len(args) == 1:
+                self.set_input4(args[0])
+            elif len(args) == 2:
+                self.set_input2(args[0], args[1])
+            elif len(args) == 4:
+                self.set_input1(args[0], args[1], args[2], args[3])
+
+    @profiled_phase('enable_pattern')
+    def enable_pattern(self, pattern, wait='poll', timeout=1.0):
         """
 
         Args:
             pattern (str): select a test pattern (ramp, deskew, sync, none, ...).
                            see list in notes for more details
+            wait (str): How to wait for the pattern to reach the snapshot RAMs.
+                        'poll' (default) takes snapshots until the pattern shows
+                        up or timeout expires, 'sleep' waits a fixed timeout
+                        seconds, and None returns immediately.
+            timeout (float): Maximum time to wait, in seconds.
 
         Notes
              Selects a test pattern or sampled data for all ADCs selected by
@@ -490,23 +736,56 @@ class SnapAdc(object):
         | pat_sync          | X   0  |
         ------------------------------
         """
-        self.write_register('en_ramp',    0b000)
-        self.write_register('pat_deskew', 0b000)
-        if pattern == 'ramp':
-            self.write_register('en_ramp', 0b100)
-        elif pattern == 'deskew':
-            self.write_register('pat_deskew', 0b01)
-        elif pattern == 'sync':
-            self.write_register('pat_sync', 0b10)
-        else:
+        if pattern not in ('ramp', 'deskew', 'sync'):
             self.logger.error('Invalid test pattern selected')
             raise RuntimeError('Invalid test pattern selected')
-        time.sleep(1)
+        with self.spi_transaction():
+            self.write_register('en_ramp',    0b000)
+            self.write_register('pat_deskew', 0b000)
+            if pattern == 'ramp':
+                self.write_register('en_ramp', 0b100)
+            elif pattern == 'deskew':
+                self.write_register('pat_deskew', 0b01)
+            elif pattern == 'sync':
+                self.write_register('pat_sync', 0b10)
+
+        if wait == 'poll' and pattern in PATTERN_CHECKS:
+            if not self.wait_for_pattern(pattern, timeout=timeout):
+                self.logger.warning('Timed out waiting for %s pattern' % pattern)
+        elif wait is not None:
+            # No way to recognize this pattern, fall back to a fixed delay
+            time.sleep(timeout)
+
+    def wait_for_pattern(self, pattern, timeout=1.0, threshold=0.5, poll_interval=0.01):
+        """ Poll snapshots until a test pattern shows up in the ADC data
+
+        Args:
+            pattern (str): 'deskew', 'sync' or 'ramp'
+            timeout (float): Give up after this many seconds
+            threshold (float): Fraction of samples that must match the pattern.
+                               Lanes at the edge of their eye read noise, so
+                               this is less than 1 before calibration.
+            poll_interval (float): Seconds to wait between snapshots
+
+        Returns:
+            True if the pattern was seen within timeout, False otherwise
+        """
+        t0 = time.time()
+        while True:
+            frac = pattern_fraction(self.capture(), pattern)
+            if frac >= threshold:
+                self.logger.debug('%s pattern settled after %2.3f s (%2.2f match)'
+                                  % (pattern, time.time() - t0, frac))
+                return True
+            if time.time() - t0 > timeout:
+                return False
+            time.sleep(poll_interval)
 
     def clear_pattern(self):
         """ Clears test pattern from ADCs """
-        self.write_register('en_ramp',   0b000)
-        self.write_register('pat_deskew', 0b00)
+        with self.spi_transaction():
+            self.write_register('en_ramp',   0b000)
+            self.write_register('pat_deskew', 0b00)
 
 
 
@@ -515,25 +794,46 @@ class SnapAdc(object):
         locked_bit = self.host.read_int(self.control_register, word_offset=0) >> 24
         if locked_bit & 3:
             self.logger.info('ADC clock is locked.')
-            self.logger.info('Board clock: %2.4f MHz' % self.host.est_brd_clk())
+            self.log_fpga_clock()
             return True
         else:
             self.logger.info('ADC clock not locked. Check clock and/or demux mode.')
             return False
 
+    def log_fpga_clock(self):
+        """ Sample the FPGA clock counter and log the resulting estimate
+
+        Notes:
+            Takes a single sys_clkcounter reading rather than measuring the
+            clock, which takes seconds. The estimate comes from this reading
+            and an earlier one (see ClockEstimator), so nothing is logged on
+            the first call.
+        """
+        if not hasattr(self.host, 'fpga_clock_estimate'):
+            return
+        mhz, age = self.host.fpga_clock_estimate(sample=True)
+        if mhz is not None:
+            self.logger.info('Board clock: %2.4f MHz (estimated %2.1fs ago)' % (mhz, age))
+
     def check_rms(self):
-        """ Calculate RMS of ADC snapshot and print to screen """
+        """ Calculate RMS of ADC snapshot and print to screen
+
+        Also samples the FPGA clock counter, so that regular health checks
+        keep the board's clock estimate up to date.
+        """
+        if hasattr(self.host, 'fpga_clock_estimate'):
+            self.host.fpga_clock_estimate(sample=True)
         rms_vals = {}
-        for chip_id in (0, 1, 2):
-            snapshot = self.read_ram('adc16_wb_ram{0}'.format(chip_id))
+        data = self.capture((0, 1, 2))
+        for chip_id, snapshot in enumerate(data):
             rms = np.std(snapshot)
             rms_vals["%s-%i" % (self.host.host, chip_id)] = rms
         return rms_vals
 
     def grab_adc_snapshot(self):
         d = {}
-        for chip_id in (0, 1, 2):
-            snapshot = self.read_ram('adc16_wb_ram{0}'.format(chip_id))
+        data = self.capture((0, 1, 2))
+        for chip_id, snapshot in enumerate(data):
             d["%s-%i" % (self.host.host, chip_id)] = snapshot
         return d
 
@@ -555,28 +855,94 @@ class SnapAdc(object):
             self.logger.error(err)
             raise RuntimeError(err)
 
+    def _chip_list(self, chip_num):
+        """ Return chip_num (int or list of ints) as a sorted list of chip numbers """
+        if isinstance(chip_num, (list, tuple, set)):
+            return sorted(chip_num)
+        return [chip_num]
+
+    def _chip_mask(self, chip_num):
+        """ Return a one-bit-per-chip mask for a chip number or list of chip numbers """
+        mask = 0
+        for cn in self._chip_list(chip_num):
+            mask |= 1 << cn
+        return mask
+
     def bitslip(self, chip_num, channel):
         """
         The ADC16 controller word (the offset in write_int method) 2 and 3 are for delaying taps of
         A and B lanes, respectively.
         Refer to the memory map word 2 and word 3 for clarification. The memory map was made for a
         ROACH design so it has chips A-H. SNAP 1 design has three chips
+
+        Notes:
+            chip_num may be a list of chip numbers, in which case the same channel
+            is bitslipped on all of them at once.
         """
+        self._write_burst(self._bitslip_writes(chip_num, channel))
+        for cn in self._chip_list(chip_num):
+            self.bitslips[cn][channel] += 1
+
+    def _bitslip_writes(self, chip_num, channel):
+        """ Return the word 1 writes that bitslip one channel on one or more chips """
         chan_shift = 5
         chan_select_bs = channel << chan_shift
-        state = 0
         chip_shift = 8
-        chip_select_bs = 1 << chip_shift + chip_num
+        chip_select_bs = self._chip_mask(chip_num) << chip_shift
         state = (chip_select_bs | chan_select_bs)
         #		print('Bitslip state written to word_offset=1:',bin(state))
-        self._write(0, word_offset=1, blindwrite=True)
-        self._write(state, word_offset=1, blindwrite=True)
-        self._write(0, word_offset=1, blindwrite=True)
+        return [(0, 1), (state, 1), (0, 1)]
+
+    def bitslip_lanes(self, chip_nums, n_slips):
+        """ Bitslip any number of lanes on several chips in a single burst
+
+        Args:
+            chip_nums (list): chip numbers
+            n_slips (np.array): number of bitslips per lane, shape (len(chip_nums), 8)
+
+        Notes:
+            Lanes are independent, so all bitslips are issued back-to-back,
+            sharing a write among chips that need a slip on the same lane.
+        """
+        n_slips = np.asarray(n_slips).reshape(len(chip_nums), N_LANES)
+        writes = []
+        for lane in range(N_LANES):
+            for ii in range(n_slips[:, lane].max() if len(chip_nums) else 0):
+                to_slip = [cn for cn, n in zip(chip_nums, n_slips[:, lane]) if n > ii]
+                writes += self._bitslip_writes(to_slip, lane)
+        if not writes:
+            return
+        self._write_burst(writes)
+        for cn, n in zip(chip_nums, n_slips):
+            self.bitslips[cn] += n.astype('int32')
 
     def delay_tap(self, tap, channel, chip_num):
+        """ Set the IDELAY tap of one or all channels of a chip
 
+        Args:
+            tap (int): delay tap, 0-31
+            channel (str): channel id of form '1a', '2b' etc, or 'all'
+            chip_num (int or list): chip number. With channel='all', a list of chip
+                                    numbers may be given to strobe all of them at once.
+        """
         delay_tap_mask = 0x1f
 
+        if channel == 'all':
+            # Strobe bits for all four channels of every chip
+            chan_select = 0
+            for cn in self._chip_list(chip_num):
+                chan_select |= (0xf << (cn * 4))
+            self._write_burst([(0, 2), (0, 3),
+                               # Set tap bits
+                               (delay_tap_mask & tap, 1),
+                               # Set strobe bits
+                               (chan_select, 2), (chan_select, 3),
+                               # Clear all bits
+                               (0, 1), (0, 2), (0, 3)])
+            # Note this return statement, after all channels have been bitslip it'll exit out of the function.
+            # the function is called again after figuring out the best tap with a single channel argument.
+            return
+
         CHAN_SEL_MAP = {'1': 0x1 << (chip_num * 4),
                         '2': 0x2 << (chip_num * 4),
                         '3': 0x4 << (chip_num * 4),
@@ -585,36 +951,170 @@ class SnapAdc(object):
         LANE_SEL_MAP = {'a': 2,
                         'b': 3}
 
-        if channel == 'all':
-            chan_select = (0xf << (chip_num * 4))
-            self._write(0, word_offset=2, blindwrite=True)
-            self._write(0, word_offset=3, blindwrite=True)
-            # Set tap bits
-            self._write(delay_tap_mask & tap, word_offset=1, blindwrite=True)
-            # Set strobe bits
-            self._write(chan_select, word_offset=2, blindwrite=True)
-            self._write(chan_select, word_offset=3, blindwrite=True)
-            # Clear all bits
-            for wo in (1, 2, 3):
-                self._write(0, word_offset=wo, blindwrite=True)
-            # Note this return statement, after all channels have been bitslip it'll exit out of the function.
-            # the function is called again after figuring out the best tap with a single channel argument.
-            return
+        # Channel should be of form '1a' or '2b' etc
+        chan_select = CHAN_SEL_MAP[channel[0]]
+        lane_offset = LANE_SEL_MAP[channel[1]]
 
-        else:
-            # Channel should be of form '1a' or '2b' etc
-            chan_select = CHAN_SEL_MAP[channel[0]]
-            lane_offset = LANE_SEL_MAP[channel[1]]
+        self._write_burst([(0, lane_offset),
+                           # Set tap bits
+                           (delay_tap_mask & tap, 1),
+                           # Set strobe bits
+                           (chan_select, lane_offset),
+                           # Clear all bits
+                           (0, 1), (0, 2), (0, 3)])
+
+    def delay_taps(self, chip_nums, taps):
+        """ Set an individual delay tap on every lane of several chips in one burst
 
-        self._write(0, word_offset=lane_offset, blindwrite=True)
-        # Set tap bits
-        self._write(delay_tap_mask & tap, word_offset=1, blindwrite=True)
-        # Set strobe bits
-        self._write(chan_select, word_offset=lane_offset, blindwrite=True)
-        # Clear all bits
-        for wo in (1, 2, 3):
-            self._write(0, word_offset=wo, blindwrite=True)
+        Args:
+            chip_nums (list): chip numbers
+            taps (np.array): taps to apply, shape (len(chip_nums), 8), lanes
+                             ordered 1a, 1b, 2a, 2b ... 4b
+        """
+        delay_tap_mask = 0x1f
+        taps = np.asarray(taps)
+
+        writes = []
+        for tap in np.unique(taps):
+            # Strobe bits of every lane that takes this tap value
+            strobe = {2: 0, 3: 0}
+            for ii, cn in enumerate(chip_nums):
+                for k in np.where(taps[ii] == tap)[0]:
+                    chan, lane_offset = divmod(int(k), 2)
+                    strobe[2 + lane_offset] |= 1 << (cn * 4 + chan)
+            writes += [(0, 2), (0, 3),
+                       # Set tap bits
+                       (delay_tap_mask & int(tap), 1),
+                       # Set strobe bits
+                       (strobe[2], 2), (strobe[3], 3),
+                       # Clear all bits
+                       (0, 1), (0, 2), (0, 3)]
+        self._write_burst(writes)
+
+    def test_lane_taps(self, chip_nums, taps):
+        """ Test a (possibly different) delay tap on every lane with a single snapshot
 
+        Args:
+            chip_nums (list): chip numbers to test together
+            taps (np.array): taps to test, shape (len(chip_nums), 8)
+
+        Returns:
+            errors (np.array): int32 deskew error counts, shape (len(chip_nums), 8)
+        """
+        self.delay_taps(chip_nums, taps)
+        data = self.capture(chip_nums)
+        return count_lane_errors(data, DESKEW_VAL)
+
+    def sweep_taps(self, chip_nums, search='coarse', step=4):
+        """ Sweep the 32 delay taps on several chips at once
+
+        Args:
+            chip_nums (list): chip numbers to sweep together
+            search (str): 'coarse' (default) to sample every step taps and then
+                          binary-search each lane's eye edges between the samples,
+                          or 'exhaustive' to test every tap.
+            step (int): coarse tap spacing. Eyes and gaps narrower than this may
+                        be missed by the coarse search.
+
+        Returns:
+            error_cube (np.array): int32 array of shape (chips, 32, 8) with the
+            deskew error count of every lane at every tap
+
+        Notes:
+            With search='coarse', taps that were not measured are filled in from
+            the nearest measured tap on the same side of the eye edge, so the
+            zero-error windows are the same as for an exhaustive sweep as long
+            as the eye and the gaps between eyes are wider than step.
+        """
+        n_chips = len(chip_nums)
+        error_cube = np.zeros((n_chips, N_TAPS, N_LANES), dtype='int32')
+
+        if search == 'exhaustive':
+            for tap in range(N_TAPS):
+                errors = self.test_taps(chip_nums, tap)
+                for ii, cn in enumerate(chip_nums):
+                    error_cube[ii, tap] = errors[cn]
+            return error_cube
+        elif search != 'coarse':
+            raise RuntimeError("Unknown tap search mode %s, use 'coarse' or 'exhaustive'." % search)
+
+        # Coarse pass: the same taps on every lane
+        coarse_taps = list(range(0, N_TAPS, step))
+        if coarse_taps[-1] != N_TAPS - 1:
+            coarse_taps.append(N_TAPS - 1)
+        for tap in coarse_taps:
+            errors = self.test_taps(chip_nums, tap)
+            for ii, cn in enumerate(chip_nums):
+                error_cube[ii, tap] = errors[cn]
+
+        # Every lane keeps a list of [lo, hi] tap intervals that contain an eye edge
+        edges = [[[] for k in range(N_LANES)] for ii in range(n_chips)]
+        for ii in range(n_chips):
+            for k in range(N_LANES):
+                for lo, hi in zip(coarse_taps[:-1], coarse_taps[1:]):
+                    if (error_cube[ii, lo, k] == 0) != (error_cube[ii, hi, k] == 0):
+                        edges[ii][k].append([lo, hi])
+                    else:
+                        error_cube[ii, lo+1:hi, k] = error_cube[ii, lo, k]
+
+        # Fine pass: binary search the open edge of every lane in parallel,
+        # each lane probing its own tap in the same snapshot
+        while any(edges[ii][k] for ii in range(n_chips) for k in range(N_LANES)):
+            taps = np.zeros((n_chips, N_LANES), dtype='int32')
+            for ii in range(n_chips):
+                for k in range(N_LANES):
+                    if edges[ii][k]:
+                        lo, hi = edges[ii][k][0]
+                        taps[ii, k] = (lo + hi) // 2
+                    else:
+                        # Nothing left to probe; stay on an already measured tap
+                        taps[ii, k] = coarse_taps[0]
+            errors = self.test_lane_taps(chip_nums, taps)
+
+            for ii in range(n_chips):
+                for k in range(N_LANES):
+                    if not edges[ii][k]:
+                        continue
+                    lo, hi = edges[ii][k][0]
+                    mid = taps[ii, k]
+                    error_cube[ii, mid, k] = errors[ii, k]
+                    if (errors[ii, k] == 0) == (error_cube[ii, lo, k] == 0):
+                        error_cube[ii, lo+1:mid, k] = error_cube[ii, lo, k]
+                        lo = mid
+                    else:
+                        error_cube[ii, mid+1:hi, k] = error_cube[ii, hi, k]
+                        hi = mid
+                    if hi - lo > 1:
+                        edges[ii][k][0] = [lo, hi]
+                    else:
+                        edges[ii][k].pop(0)
+        return error_cube
+
+    def test_taps(self, chip_nums, tap_id):
+        """ Test a delay tap on several chips with a single strobe and snapshot
+
+        Args:
+            chip_nums (list): chip numbers to test together
+            tap_id (int or str): tap to test, or 'all' to sweep all 32 taps
+
+        Returns:
+            error_counts (dict): chip_num: error count array, of shape (8,) for
+            a single tap or (32, 8) for 'all'.
+        """
+        if tap_id == 'all':
+            error_cube = self.sweep_taps(chip_nums, search='exhaustive')
+            return dict(zip(chip_nums, error_cube))
+
+        # Set the tap on every chip at once, then take one snapshot of all RAMs
+        self.delay_tap(tap_id, 'all', list(chip_nums))
+        data = self.capture(chip_nums)
+        self.logger.debug("TAP %s | %s" % (tap_id, data))
+        # each tap will return an error count for each channel and lane,
+        # so an array of 8 elements per chip with an error count for each
+        errors = count_lane_errors(data, DESKEW_VAL)
+        for cn, errs in zip(chip_nums, errors):
+            self.logger.debug('Chip {0} Error count for {1} tap: {2}'.format(cn, tap_id, errs))
+        return dict(zip(chip_nums, errors))
 
     def test_tap(self, chip_num, tap_id):
         """
@@ -624,62 +1124,51 @@ class SnapAdc(object):
         iterate through all 32 taps
         if it's an int it will only delay all channels by that particular tap value.
         """
-        # Form dicts for counting channel erros and offsets
-        chan_ids     = ['1a', '1b', '2a', '2b', '3a', '3b', '4a', '4b']
-        chan_offsets = dict(zip(chan_ids, range(8)))
-        zeros        = [0, 0, 0, 0, 0, 0, 0, 0]
-        chan_errs    = dict(zip(chan_ids, zeros))
-        
-        TEST_VAL = 0x2a  # pattern will yield 0x2a = 42 if good
+        return self.test_taps([chip_num], tap_id)[chip_num]
 
-        if tap_id == 'all':
-            # read_ram returns an array of data form a snapshot from ADC output
-            error_count = np.zeros((32, 8), dtype='int32')
-            for tap in range(32):
-                error_count[tap] = np.array(self.test_tap(chip_num, tap))
-            return error_count
-        else:
-            # read_ram reuturns an array of data form a sanpshot from ADC output
-            self.delay_tap(tap_id, 'all', chip_num)
-            data = self.read_ram('adc16_wb_ram{0}'.format(chip_num))
-            # each tap will return an error count for each channel and lane,
-            # so an array of 8 elements with an error count for each
-            self.logger.debug("TAP %s | %s" % (tap_id, data))
-            for i in range(0, 1024, 8):
-                for chan_id, chan_offset in chan_offsets.items():
-                    if data[i + chan_offset] != TEST_VAL:
-                        chan_errs[chan_id] += 1
-            
-            error_count = np.array([chan_errs[cid] for cid in chan_ids], dtype='int32')
-            
-            self.logger.debug('Chip {0} Error count for {1} tap: {2}'.format(chip_num, tap_id, error_count))
-            return error_count
-
-    def walk_taps(self):
-        """ Main SERDES calibration - walk through taps and find sweet spot """
+    @profiled_phase('walk_taps')
+    def walk_taps(self, parallel=True, search='coarse', chip_nums=None):
+        """ Main SERDES calibration - walk through taps and find sweet spot
+
+        Args:
+            chip_nums (list): chip numbers to calibrate, defaults to all enabled chips
+            parallel (bool): Sweep all enabled chips at once, with one strobe and
+                             one snapshot per tap (default). If False, chips are
+                             calibrated one after another.
+            search (str): Tap search strategy, 'coarse' (coarse-to-fine, default)
+                          or 'exhaustive' (test all 32 taps). See sweep_taps.
+        """
         # Set FPGA to demux 4 because it makes snap blocks easier to interpret
         self.host.fpga_set_demux(4)
 
-        for chip, chip_num in sorted(self.chips.items()):
-            self.logger.info('Calibrating chip %s...' % chip)
+        if chip_nums is None:
+            chip_nums = sorted(self.chips.values())
+        if parallel:
+            chip_groups = [chip_nums]
+        else:
+            chip_groups = [[cn] for cn in chip_nums]
+
+        chip_names = dict((cn, chip) for chip, cn in self.chips.items())
+        for group in chip_groups:
+            self.logger.info('Calibrating chip(s) %s...' % ', '.join(chip_names[cn] for cn in group))
             self.logger.debug('Setting deskew pattern...')
             self.enable_pattern('deskew')
-            self.logger.debug('Stuff in chip after enabling test mode\n')
-            self.logger.debug(self.read_ram('adc16_wb_ram{0}'.format(chip_num)))
-            self.logger.debug('Taps before bitslipping anything\n')
-            self.logger.debug(self.test_tap(chip_num, 'all'))
+            # This is a full sweep, so only run it when somebody is going to see it
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('Taps before bitslipping anything\n')
+                self.logger.debug(self.test_taps(group, 'all'))
 
             # check if either of the extreme tap setting returns zero errors in any one of the channels.
             # Bitslip if True. This is to make sure that the eye of the pattern is swept completely
-            error_counts_0  = self.test_tap(chip_num, 0)
-            error_counts_31 = self.test_tap(chip_num, 31)
+            error_counts_0  = self.test_taps(group, 0)
+            error_counts_31 = self.test_taps(group, 31)
 
-            for i in range(8):
-                if not (error_counts_0[i]) or not (error_counts_31[i]):
-                    self.logger.debug('Bitslipping chan %i' % i)
-                    self.bitslip(chip_num, i)
-                    error_counts_0  = self.test_tap(chip_num, 0)
-                    error_counts_31 = self.test_tap(chip_num, 31)
+            # Lanes are independent, so slip every offending lane at once
+            to_slip = np.array([[not error_counts_0[cn][i] or not error_counts_31[cn][i]
+                                 for i in range(N_LANES)] for cn in group], dtype='int32')
+            if to_slip.any():
+                self.logger.debug('Bitslipping lanes %s' % to_slip)
+                self.bitslip_lanes(group, to_slip)
 
             # error_list is a list of 32 'rows'(corresponding to the 32 taps) , each row containing
             # 8 elements,each element is the number of errors
@@ -690,89 +1179,257 @@ class SnapAdc(object):
             # tap 1: [ channel_1a channel_1b channel_2a channel_2b channel_3a channel_3b channel_4a channel_4b]
             # .....: [ channel_1a channel_1b channel_2a channel_2b channel_3a channel_3b channel_4a channel_4b]
             # tap 31:[ channel_1a channel_1b channel_2a channel_2b channel_3a channel_3b channel_4a channel_4b]
-            error_list = self.test_tap(chip_num, 'all')
-            good_tap_range = []
-            best_tap_range = []
-            self.logger.debug('Printing the list of errors, each row is a tap\n')
-            self.logger.debug(['chan1a', 'chan1b', 'chan2a', 'chan2b', 'chan3a', 'chan3b', 'chan4a', 'chan4b'])
-            self.logger.debug(np.array(error_list))
-
-            # This loop goes through error_list, finds the elements with a value of 0 and appends them
-            # to the good tap range list
-            # It also picks out the elements corresponding to different channels and groups them together.
-            # The error_list is a list where each 'row' is a different tap
-            # I wanted to find the elements in each channel that have zero errors,
-            # group the individual channels, and get the value of the tap in which they're in
-            # - which is the index of the row
-            for i in range(8):
-                good_tap_range.append([])
-                # j represents the tap value
-                for j in range(32):
-                    # i represents the channel/lane value
-                    if error_list[j][i] == 0:
-                        good_tap_range[i].append(j)
-                        #	find the min and max of each element of good tap range and call delay tap
-            self.logger.debug('Printing good tap values for each channel - each row is a different channel')
-
-            for i in range(len(good_tap_range)):
-                logging.debug('Channel {0}: {1}'.format(i + 1, good_tap_range[i]))
-
-            channels = ['1a', '1b', '2a', '2b', '3a', '3b', '4a', '4b']
-            for k in range(8):
-                min_tap = min(good_tap_range[k])
-                max_tap = max(good_tap_range[k])
-
-                best_tap = (min_tap + max_tap) // 2
-                self.delay_tap(best_tap, channels[k], chip_num)
-            self.logger.debug('Printing the calibrated data from ram{0}.....'.format(self.chips[chip]))
-            self.logger.debug(self.read_ram('adc16_wb_ram{0}'.format(self.chips[chip])))
+            error_cube = self.sweep_taps(group, search=search)
+
+            # Pick the centre of the widest zero-error window of every lane
+            best_taps, margins, widths = find_eyes(error_cube)
+
+            for ii, chip_num in enumerate(group):
+                self.logger.debug('Chip %s: printing the list of errors, each row is a tap\n' % chip_names[chip_num])
+                self.logger.debug(['chan1a', 'chan1b', 'chan2a', 'chan2b', 'chan3a', 'chan3b', 'chan4a', 'chan4b'])
+                self.logger.debug(error_cube[ii])
+                self.logger.debug('Chip %s: best taps %s, eye margins %s' % (chip_names[chip_num],
+                                                                             best_taps[ii], margins[ii]))
+
+                if np.any(widths[ii] == 0):
+                    bad_lanes = [LANE_IDS[k] for k in np.where(widths[ii] == 0)[0]]
+                    err = 'Chip %s: no good delay tap found for lanes %s' % (chip_names[chip_num], bad_lanes)
+                    self.logger.error(err)
+                    raise RuntimeError(err)
+
+                self.logger.info('Chip %s: minimum eye margin %i taps' % (chip_names[chip_num], margins[ii].min()))
+                self.cal_state[chip_num] = {'taps': best_taps[ii].copy(),
+                                            'margins': margins[ii].copy()}
+
+            self.delay_taps(group, best_taps)
 
             # Bitslip channels until the sync pattern is captured
-            self.sync_chips(chip_num)
+            self.sync_chips(group)
+            for chip_num in group:
+                self.cal_state[chip_num]['bitslips'] = self.bitslips[chip_num].copy()
 
         # Set FPGA back to acutal demux mode
         self.host.fpga_set_demux(self.demux_mode)
 
+    @profiled_phase('sync_chips')
     def sync_chips(self, chip_num):
-        """ Synchronize chips with bitslip """
+        """ Synchronize chips with bitslip
+
+        Args:
+            chip_num (int or list): chip number, or list of chip numbers to sync together
+
+        Notes:
+            The ISERDES rotates a lane's 8-bit word by one bit per bitslip, so
+            the number of bitslips every lane needs is read straight off a
+            single snapshot of the sync pattern. All lanes are then bitslipped
+            in one burst and checked with a second snapshot. Lanes that are
+            still not framed (e.g. the FPGA bitslips the other way) are
+            bitslipped one step at a time until they are.
+        """
+        chip_nums = self._chip_list(chip_num)
         self.enable_pattern('sync')
 
-        snap = self.read_ram('adc16_wb_ram{0}'.format(chip_num))
+        data = self.capture(chip_nums)
         self.logger.debug('Snapshot before bitslipping:\n')
-        self.logger.debug(snap[0:8])
-
-        for i in range(8):
-            loop_ctl = 0
-            while snap[i] != 0x70:
-                self.logger.debug('Bitslipping channel %i\n' % i)
-                self.bitslip(chip_num, i)
-                snap = self.read_ram('adc16_wb_ram{0}'.format(chip_num))
-                self.logger.debug('Snapshot after bitslipping:\n')
-                self.logger.debug(snap[0:8])
-                loop_ctl += 1
-                if loop_ctl > 10:
-                    err = "Bitslipping is not working. Are you using the latest Jasper libraries?"
-                    self.logger.error(err)
-                    raise RuntimeError(err)
+        self.logger.debug(data[:, 0:8])
+
+        n_slips = sync_bitslips(data)
+        self.bitslip_lanes(chip_nums, np.maximum(n_slips, 0))
+
+        for loop_ctl in range(11):
+            data = self.capture(chip_nums)
+            self.logger.debug('Snapshot after bitslipping:\n')
+            self.logger.debug(data[:, 0:8])
+            unsynced = count_lane_errors(data, SYNC_VAL) > 0
+            if not unsynced.any():
+                return
+            self.logger.debug('Bitslipping unsynced lanes %s' % unsynced.astype('int32'))
+            self.bitslip_lanes(chip_nums, unsynced.astype('int32'))
+
+        err = "Bitslipping is not working. Are you using the latest Jasper libraries?"
+        self.logger.error(err)
+        raise RuntimeError(err)
+
+    def reset_cal_state(self):
+        """ Forget applied delay taps and bitslips, e.g. after reprogramming the FPGA """
+        self.cal_state = {}
+        for chip_num in self.bitslips:
+            self.bitslips[chip_num][:] = 0
+
+    @profiled_phase('apply_cal_state')
+    def apply_cal_state(self, cal_state):
+        """ Reapply previously found delay taps and bitslips
+
+        Args:
+            cal_state (dict): chip_num: {'taps': [8 ints], 'bitslips': [8 ints]}
+
+        Notes:
+            Bitslips are counted from the last FPGA program, and the ISERDES
+            wraps around after 8 of them. Only the missing number of bitslips
+            (modulo 8) is applied to each lane.
+        """
+        chip_nums = sorted(cal_state.keys())
+        if not chip_nums:
+            return
+        n_slips = [(np.asarray(cal_state[cn]['bitslips']) - self.bitslips[cn]) % 8 for cn in chip_nums]
+        self.bitslip_lanes(chip_nums, n_slips)
+        self.delay_taps(chip_nums, [cal_state[cn]['taps'] for cn in chip_nums])
+        for cn in chip_nums:
+            self.cal_state[cn] = {'taps': np.array(cal_state[cn]['taps'], dtype='int32'),
+                                  'margins': np.array(cal_state[cn].get('margins', [-1] * N_LANES), dtype='int32'),
+                                  'bitslips': self.bitslips[cn].copy()}
+
+    @profiled_phase('verify_calibration')
+    def verify_calibration(self, chip_nums=None):
+        """ Check the applied calibration with one deskew and one sync snapshot
 
-    def calibrate(self):
-        """" Run SERDES calibration routines """
+        Args:
+            chip_nums (list): chip numbers to check, defaults to all enabled chips
+
+        Returns:
+            (deskew_failed, sync_failed): lists of chip numbers with any lane
+            reading the wrong deskew / sync pattern
+        """
+        if chip_nums is None:
+            chip_nums = sorted(self.chips.values())
+        self.host.fpga_set_demux(4)
+        self.enable_pattern('deskew')
+        deskew_errs = count_lane_errors(self.capture(chip_nums), DESKEW_VAL)
+        self.enable_pattern('sync')
+        sync_errs = count_lane_errors(self.capture(chip_nums), SYNC_VAL)
+        self.host.fpga_set_demux(self.demux_mode)
+
+        deskew_failed = [cn for cn, errs in zip(chip_nums, deskew_errs) if errs.any()]
+        sync_failed = [cn for cn, errs in zip(chip_nums, sync_errs) if errs.any()]
+        return deskew_failed, sync_failed
+
+    @profiled_phase('calibrate')
+    def calibrate(self, cal_state=None):
+        """" Run SERDES calibration routines
+
+        Args:
+            cal_state (dict): Optional calibration from an earlier run, as
+                chip_num: {'taps': [8 ints], 'bitslips': [8 ints]}. It is applied
+                and verified first; chips that fail the deskew check are swept
+                again, and chips that only fail the sync check are resynced.
+        """
         if self.clock_locked():
+            chip_nums = sorted(self.chips.values())
+            to_sweep, to_sync = chip_nums, []
+            if cal_state:
+                cached = [cn for cn in chip_nums if cn in cal_state]
+                self.apply_cal_state(dict((cn, cal_state[cn]) for cn in cached))
+                deskew_failed, sync_failed = self.verify_calibration(cached)
+                to_sweep = [cn for cn in chip_nums if cn not in cached or cn in deskew_failed]
+                to_sync = [cn for cn in sync_failed if cn not in deskew_failed]
+                self.logger.info('Cached calibration: %i chip(s) OK, %i to resync, %i to sweep'
+                                 % (len(cached) - len(to_sync) - len(deskew_failed), len(to_sync), len(to_sweep)))
+
             # Calibrate ADC by going through various tap values
-            self.walk_taps()
+            if to_sweep:
+                self.walk_taps(chip_nums=to_sweep)
+            if to_sync:
+                self.host.fpga_set_demux(4)
+                self.sync_chips(to_sync)
+                self.host.fpga_set_demux(self.demux_mode)
+                for chip_num in to_sync:
+                    self.cal_state[chip_num]['bitslips'] = self.bitslips[chip_num].copy()
             # Clear pattern setting registers so real data could be taken
             self.clear_pattern()
+            # Second clock counter reading: calibration took long enough for an estimate
+            self.log_fpga_clock()
         else:
             err = 'Could not calibrate, ADC clock not locked.'
             self.logger.error(err)
             raise RuntimeError(err)
 
+    @profiled_phase('recalibrate_lanes')
+    def recalibrate_lanes(self, window=4):
+        """ Recalibrate only the lanes that currently fail the deskew check
+
+        Failing lanes are found from a single deskew snapshot. Each of them is
+        swept over a narrow window of taps around its current tap (widening to
+        the full tap range if no eye is found there), while healthy lanes and
+        chips keep their settings. Lanes that are retuned are then resynced.
+
+        Args:
+            window (int): number of taps either side of the current tap to search
+
+        Returns:
+            retuned (dict): chip_num: list of lane ids (e.g. '1a') that were retuned
+
+        Notes:
+            Chips that have not been calibrated yet get a full walk_taps().
+        """
+        chip_nums = sorted(self.chips.values())
+        uncalibrated = [cn for cn in chip_nums if cn not in self.cal_state]
+        chip_nums = [cn for cn in chip_nums if cn in self.cal_state]
+        if uncalibrated:
+            self.walk_taps(chip_nums=uncalibrated)
+
+        retuned = {}
+        if not chip_nums:
+            return retuned
+
+        self.host.fpga_set_demux(4)
+        self.enable_pattern('deskew')
+        failing = count_lane_errors(self.capture(chip_nums), DESKEW_VAL) > 0
+        if not failing.any():
+            self.logger.info('All lanes pass the deskew check, nothing to recalibrate')
+        else:
+            taps = np.array([self.cal_state[cn]['taps'] for cn in chip_nums], dtype='int32')
+
+            for search_window in (window, N_TAPS):
+                # Taps to try for every lane, relative to its current tap
+                lo = np.clip(taps - search_window, 0, N_TAPS - 1)
+                hi = np.clip(taps + search_window, 0, N_TAPS - 1)
+
+                n_probe = int((hi - lo).max()) + 1
+                error_cube = np.ones((len(chip_nums), n_probe, N_LANES), dtype='int32')
+                for ii in range(n_probe):
+                    probe = np.where(failing, np.minimum(lo + ii, hi), taps)
+                    errors = self.test_lane_taps(chip_nums, probe)
+                    in_range = (lo + ii) <= hi
+                    error_cube[:, ii][in_range] = errors[in_range]
+
+                best, margins, widths = find_eyes(error_cube, cyclic=False)
+                found = failing & (widths > 0)
+                taps = np.where(found, lo + best, taps)
+                for ci, cn in enumerate(chip_nums):
+                    for k in np.where(found[ci])[0]:
+                        self.cal_state[cn]['taps'][k] = taps[ci, k]
+                        self.cal_state[cn]['margins'][k] = margins[ci, k]
+                        retuned.setdefault(cn, []).append(LANE_IDS[k])
+                failing = failing & ~found
+                # Put every lane back on its (possibly new) tap
+                self.delay_taps(chip_nums, taps)
+                if not failing.any():
+                    break
+
+            if failing.any():
+                bad = dict((cn, [LANE_IDS[k] for k in np.where(failing[ci])[0]])
+                           for ci, cn in enumerate(chip_nums) if failing[ci].any())
+                err = 'No eye found for lanes %s, run a full calibrate()' % bad
+                self.logger.error(err)
+                raise RuntimeError(err)
+
+            # Retuned lanes may have moved to a different bit, so check their framing
+            to_sync = sorted(retuned.keys())
+            self.sync_chips(to_sync)
+            for cn in to_sync:
+                self.cal_state[cn]['bitslips'] = self.bitslips[cn].copy()
+            self.logger.info('Retuned lanes: %s' % retuned)
+
+        self.clear_pattern()
+        self.host.fpga_set_demux(self.demux_mode)
+        return retuned
+
     def check_calibration(self):
         output = ""
-        for chip_id in (0,1,2):
-           self.enable_pattern('deskew')
-           snapshot = self.read_ram('adc16_wb_ram{0}'.format(chip_id))
-           self.clear_pattern()
+        self.enable_pattern('deskew')
+        data = self.capture((0, 1, 2))
+        self.clear_pattern()
+        for chip_id, snapshot in enumerate(data):
            d1 = demux_data(snapshot, 4)
            output += "%06s ADC %i: %s\n" % (self.host.host, chip_id, np.allclose(d1, 42))
-        return output
\ No newline at end of file
+        return output
@@ -0,0 +1,339 @@
+"""
+# snap_archive.py
+
+Chunked, append-only archive of ADC snapshots.
+
+An archive is a directory holding an index.json and a series of chunk files.
+Each record is one capture: a timestamp and an int8 snapshot for each
+stream, where a stream is one chip of one board. Records are buffered and
+written out chunk_size at a time, so an archive can grow indefinitely and be
+reopened for appending:
+
+    ```
+    with SnapshotArchiveWriter('rfi_scan', compress=True) as archive:
+        for ii in range(1000):
+            archive.append(manager.grab_adc_snapshot())
+
+    archive = SnapshotArchive('rfi_scan')
+    timestamps, data, streams = archive.read(host='snap01', chip=0,
+                                             t_start=t0, t_stop=t0 + 60)
+    ```
+
+Uncompressed chunks are plain .npy files that the reader memory-maps, so
+slicing a large archive only reads the chunks (and pages) it needs.
+Compressed chunks are .npz files, decompressed one chunk at a time.
+
+A record may lack some streams, e.g. when a board timed out and left its
+snapshot out of grab_adc_snapshot. Missing snapshots are stored as zeros,
+and a per-chunk mask of valid (record, stream) entries is kept alongside;
+read(..., with_valid=True) returns it.
+"""
+
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+INDEX_FILE = 'index.json'
+ARCHIVE_VERSION = 1
+
+
+def _stream_key(host, chip):
+    return '%s-%i' % (host, chip)
+
+
+def _parse_stream_key(key):
+    """ Split a 'host-chip' key, as used by SnapAdc.grab_adc_snapshot """
+    host, chip = key.rsplit('-', 1)
+    return host, int(chip)
+
+
+class SnapshotArchiveWriter(object):
+    """ Append snapshots to a chunked archive
+
+    Args:
+        path (str): archive directory; created if it does not exist, appended
+                    to if it does
+        streams (list): (host, chip) of each stream. Defaults to the keys of
+                        the first dict appended.
+        n_samples (int): samples per snapshot, defaults to the first append
+        chunk_size (int): records per chunk file
+        compress (bool): write compressed (.npz) chunks
+        metadata (dict): archive metadata, e.g. {'demux_mode': 1, 'gain': 1,
+                         'hosts': {'snap01': {...}}}. Merged into the existing
+                         metadata when appending.
+    """
+    def __init__(self, path, streams=None, n_samples=None, chunk_size=256,
+                 compress=False, metadata=None):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.logger = logging.getLogger('SnapshotArchiveWriter')
+        self._timestamps = []
+        self._records = []
+        self._valid = []
+
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as fh:
+                self.index = json.load(fh)
+            if streams is not None and [list(s) for s in streams] != self.index['streams']:
+                raise RuntimeError("Streams do not match existing archive %s" % path)
+            if n_samples is not None and n_samples != self.index['n_samples']:
+                raise RuntimeError("n_samples does not match existing archive %s" % path)
+        else:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self.index = {'version': ARCHIVE_VERSION,
+                          'created': time.time(),
+                          'streams': [list(s) for s in streams] if streams is not None else None,
+                          'n_samples': n_samples,
+                          'metadata': {},
+                          'chunks': []}
+        if metadata:
+            self.index['metadata'].update(metadata)
+
+    def __repr__(self):
+        return "<SnapshotArchiveWriter: %s (%i chunks)>" % (self.path, len(self.index['chunks']))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def streams(self):
+        return self.index['streams']
+
+    def append(self, data, timestamp=None, valid=None):
+        """ Append one record, or a batch of records
+
+        Args:
+            data: dict of 'host-chip': snapshot (as returned by
+                  grab_adc_snapshot), an array of shape (n_streams, n_samples),
+                  or a batch of shape (n_records, n_streams, n_samples)
+            timestamp (float or np.array): capture time(s), default now
+            valid (np.array): bool mask of shape (n_streams,) or (n_records,
+                              n_streams), for array data. Default all valid.
+
+        Notes:
+            Streams missing from a dict are stored as zeros and marked
+            invalid, rather than failing the append.
+        """
+        if isinstance(data, dict):
+            if self.streams is None:
+                self.index['streams'] = [list(_parse_stream_key(k)) for k in sorted(data.keys())]
+            keys = [_stream_key(host, chip) for host, chip in self.streams]
+            valid = np.array([k in data for k in keys])
+            if not valid.any():
+                raise RuntimeError("Record has none of the archive's streams")
+            n_samples = self.index['n_samples'] or len(data[keys[int(np.argmax(valid))]])
+            if not valid.all():
+                self.logger.warning("Record is missing %s, stored as zeros" %
+                                    ', '.join(k for k, v in zip(keys, valid) if not v))
+            data = np.stack([data[k] if k in data else np.zeros(n_samples, dtype='int8') for k in keys])
+
+        data = np.asarray(data)
+        if data.ndim == 2:
+            data = data[np.newaxis]
+        if self.index['n_samples'] is None:
+            self.index['n_samples'] = data.shape[-1]
+        if self.streams is None:
+            raise RuntimeError("Streams must be given when appending arrays")
+        if data.shape[1:] != (len(self.streams), self.index['n_samples']):
+            raise RuntimeError("Expected records of shape (%i, %i), got %s" % (
+                len(self.streams), self.index['n_samples'], data.shape[1:]))
+        if valid is None:
+            valid = np.ones(data.shape[:2], dtype='bool')
+        valid = np.broadcast_to(np.asarray(valid, dtype='bool'), data.shape[:2])
+
+        if timestamp is None:
+            timestamp = time.time()
+        timestamps = np.broadcast_to(np.asarray(timestamp, dtype='float64'), data.shape[:1])
+
+        self._records.append(data.astype('int8'))
+        self._timestamps.append(timestamps)
+        self._valid.append(valid)
+        if sum(len(t) for t in self._timestamps) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """ Write buffered records out as new chunk(s) and update the index """
+        if not self._records:
+            return
+        data = np.concatenate(self._records)
+        timestamps = np.concatenate(self._timestamps)
+        valid = np.concatenate(self._valid)
+        self._records = []
+        self._timestamps = []
+        self._valid = []
+
+        for start in range(0, len(data), self.chunk_size):
+            self._write_chunk(data[start:start + self.chunk_size],
+                              timestamps[start:start + self.chunk_size],
+                              valid[start:start + self.chunk_size])
+        self._write_index()
+
+    def _write_chunk(self, data, timestamps, valid):
+        name = 'chunk_%06i' % len(self.index['chunks'])
+        n_missing = int(valid.size - valid.sum())
+        arrays = {'data': data, 'timestamps': timestamps}
+        if n_missing:
+            arrays['valid'] = valid
+        if self.compress:
+            filename = name + '.npz'
+            tmp_path = os.path.join(self.path, name + '.tmp.npz')
+            np.savez_compressed(tmp_path, **arrays)
+            os.rename(tmp_path, os.path.join(self.path, filename))
+            ts_filename = None
+            valid_filename = None
+        else:
+            filename = name + '.npy'
+            ts_filename = name + '.ts.npy'
+            valid_filename = name + '.valid.npy' if n_missing else None
+            for fname, key in ((filename, 'data'), (ts_filename, 'timestamps'), (valid_filename, 'valid')):
+                if fname is None:
+                    continue
+                tmp_path = os.path.join(self.path, fname + '.tmp')
+                with open(tmp_path, 'wb') as fh:
+                    np.save(fh, np.ascontiguousarray(arrays[key]))
+                os.rename(tmp_path, os.path.join(self.path, fname))
+
+        self.index['chunks'].append({'file': filename,
+                                     'timestamps': ts_filename,
+                                     'valid': valid_filename,
+                                     'n_missing': n_missing,
+                                     'n_records': int(len(data)),
+                                     't_start': float(timestamps.min()),
+                                     't_stop': float(timestamps.max())})
+
+    def _write_index(self):
+        tmp_path = os.path.join(self.path, INDEX_FILE + '.tmp')
+        with open(tmp_path, 'w') as fh:
+            json.dump(self.index, fh, indent=1, sort_keys=True)
+        os.rename(tmp_path, os.path.join(self.path, INDEX_FILE))
+
+    def close(self):
+        """ Flush any buffered records """
+        self.flush()
+
+
+class SnapshotArchive(object):
+    """ Read a snapshot archive written by SnapshotArchiveWriter
+
+    Args:
+        path (str): archive directory
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE), 'r') as fh:
+            self.index = json.load(fh)
+        self.streams = [tuple(s) for s in self.index['streams'] or []]
+        self.n_samples = self.index['n_samples']
+        self.metadata = self.index['metadata']
+        self.chunks = self.index['chunks']
+        self._offsets = np.cumsum([0] + [c['n_records'] for c in self.chunks])
+
+    def __repr__(self):
+        return "<SnapshotArchive: %s (%i records, %i streams)>" % (self.path, len(self), len(self.streams))
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    @property
+    def hosts(self):
+        return sorted(set(host for host, chip in self.streams))
+
+    def _load_chunk(self, chunk):
+        """ Return (timestamps, data) of a chunk; uncompressed data is memory-mapped """
+        path = os.path.join(self.path, chunk['file'])
+        if chunk['timestamps'] is None:
+            with np.load(path) as npz:
+                return npz['timestamps'], npz['data']
+        timestamps = np.load(os.path.join(self.path, chunk['timestamps']))
+        return timestamps, np.load(path, mmap_mode='r')
+
+    def _load_valid(self, chunk):
+        """ Return the (n_records, n_streams) mask of valid entries of a chunk """
+        if not chunk.get('n_missing'):
+            return np.ones((chunk['n_records'], len(self.streams)), dtype='bool')
+        if chunk['timestamps'] is None:
+            with np.load(os.path.join(self.path, chunk['file'])) as npz:
+                return npz['valid']
+        return np.load(os.path.join(self.path, chunk['valid']))
+
+    @property
+    def timestamps(self):
+        """ Timestamps of all records """
+        if not self.chunks:
+            return np.zeros(0, dtype='float64')
+        return np.concatenate([self._load_chunk(c)[0] for c in self.chunks])
+
+    def select_streams(self, host=None, chip=None):
+        """ Return the indices of the streams matching a host and/or chip """
+        return [ii for ii, (h, c) in enumerate(self.streams)
+                if (host is None or h == host) and (chip is None or c == chip)]
+
+    def read(self, host=None, chip=None, t_start=None, t_stop=None, with_valid=False):
+        """ Read the records of some streams within a time range
+
+        Args:
+            host (str): only streams from this host, default all
+            chip (int): only streams from this chip, default all
+            t_start (float): only records captured at or after t_start
+            t_stop (float): only records captured at or before t_stop
+            with_valid (bool): also return the mask of valid entries
+
+        Returns:
+            (timestamps, data, streams): float64 timestamps of shape (n,), int8
+            data of shape (n, n_selected_streams, n_samples), and the
+            (host, chip) of each selected stream. Only the chunks that overlap
+            the time range are read. With with_valid, a fourth item: a bool
+            array of shape (n, n_selected_streams), False where a stream was
+            missing from its record (its data is zeros).
+        """
+        sel = self.select_streams(host, chip)
+        timestamps, data, valid = [], [], []
+        for chunk in self.chunks:
+            if t_start is not None and chunk['t_stop'] < t_start:
+                continue
+            if t_stop is not None and chunk['t_start'] > t_stop:
+                continue
+            ts, d = self._load_chunk(chunk)
+            keep = np.ones(len(ts), dtype='bool')
+            if t_start is not None:
+                keep &= ts >= t_start
+            if t_stop is not None:
+                keep &= ts <= t_stop
+            rows = np.where(keep)[0]
+            if len(rows) == 0:
+                continue
+            timestamps.append(ts[rows])
+            data.append(d[rows[0]:rows[-1] + 1][rows - rows[0]][:, sel])
+            if with_valid:
+                valid.append(self._load_valid(chunk)[rows][:, sel])
+
+        streams = [self.streams[ii] for ii in sel]
+        if not data:
+            result = (np.zeros(0, dtype='float64'),
+                      np.zeros((0, len(sel), self.n_samples or 0), dtype='int8'),
+                      streams)
+            valid = [np.zeros((0, len(sel)), dtype='bool')]
+        else:
+            result = np.concatenate(timestamps), np.concatenate(data), streams
+        if with_valid:
+            return result + (np.concatenate(valid),)
+        return result
+
+    def __getitem__(self, idx):
+        """ Return the data of record idx, shape (n_streams, n_samples) """
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("record %i out of range" % idx)
+        chunk_idx = int(np.searchsorted(self._offsets, idx, side='right')) - 1
+        ts, d = self._load_chunk(self.chunks[chunk_idx])
+        return np.asarray(d[idx - self._offsets[chunk_idx]])
@@ -11,15 +11,79 @@ this class, there may be occasion to access the ADC16 controller directly
 """
 
 import logging
+import os
+import random
+import socket
+import struct
+import threading
 import time
+from contextlib import contextmanager
 
 import casperfpga
+from katcp import Message
 
+from .katcp_pipeline import RequestWindow
 from .snap_adc import SnapAdc, GenericAdc
+from .snap_cache import bitstream_hash, board_fingerprint
+from .snap_profile import Profiler, InstrumentedTransport, NULL_PROFILER, profiled_phase
+from .snap_replay import RecordingTransport, ReplayTransport
+from .snap_upload import DIRECT_UPLOADER
 
 katcp_port = 7147
 
 
+class ClockEstimator(object):
+    """ Estimate the rate of a free-running counter from timestamped reads
+
+    Every read of the counter (e.g. sys_clkcounter) is passed to add_sample.
+    Once two reads are at least min_interval apart, the rate between them
+    becomes the current estimate, without sleeping.
+
+    Nothing else reads sys_clkcounter, so the samples come from
+    SnapBoard.fpga_clock_estimate(sample=True) calls. SnapAdc.calibrate
+    makes one at its start and one at its end, and SnapAdc.check_rms makes
+    one per call, so health polls keep the estimate fresh as long as they
+    are between min_interval and one counter wrap (~8.6 s at 500 MHz) apart.
+
+    Args:
+        min_interval (float): min. seconds between the samples of an estimate
+        max_rate (float): max. counter rate in Hz; samples further apart than
+                          one counter wrap at this rate are not compared
+        bits (int): counter width
+    """
+    def __init__(self, min_interval=0.5, max_rate=500e6, bits=32):
+        self.min_interval = min_interval
+        self.bits = bits
+        self.max_interval = 2**bits / float(max_rate)
+        self.mhz = None
+        self.t_estimate = None
+        self._ref = None
+
+    def __repr__(self):
+        mhz, age = self.estimate()
+        if mhz is None:
+            return "<ClockEstimator: no estimate>"
+        return "<ClockEstimator: %2.4f MHz, %2.1fs old>" % (mhz, age)
+
+    def add_sample(self, count, t):
+        """ Add a counter reading taken at time t """
+        if self._ref is None or t - self._ref[1] > self.max_interval:
+            self._ref = (count, t)
+            return
+        dt = t - self._ref[1]
+        if dt < self.min_interval:
+            return
+        self.mhz = ((count - self._ref[0]) % 2**self.bits) / dt / 1e6
+        self.t_estimate = t
+        self._ref = (count, t)
+
+    def estimate(self):
+        """ Return (MHz, age in seconds) of the last estimate, or (None, None) """
+        if self.mhz is None:
+            return None, None
+        return self.mhz, time.time() - self.t_estimate
+
+
 class SnapBoard(casperfpga.CasperFpga):
     """ Controller for a CASPER SNAP board.
 
@@ -29,6 +93,10 @@ class SnapBoard(casperfpga.CasperFpga):
                  uses_adc=True, verbose=False, **kwargs):
         super(SnapBoard, self).__init__(hostname, katcp_port, timeout)
         self.katcp_port = katcp_port
+        self.request_timeout = timeout
+        self.burst_window = 64      # Max. outstanding requests in a pipelined burst
+        self.clock = ClockEstimator()   # FPGA clock, from sys_clkcounter reads
+        self.profiler = NULL_PROFILER   # Replaced by a Profiler inside profile()
 
         if verbose == True:
             logging.basicConfig(level=logging.DEBUG)
@@ -42,34 +110,176 @@ class SnapBoard(casperfpga.CasperFpga):
             if time.time() - t0 > timeout:
                 break
                 
-        # Check if design has an ADC controller; if so, attach controller as self.adc
-        self.adc = None
+        # The ADC controller is attached as self.adc on first use, see _attach_adc
+        self._adc = None
+        self._adc_attached = False
+        self.adc_logger = None
         self.uses_adc = uses_adc
+        self.logger = logging.getLogger('SnapBoard')
+
+    def __repr__(self):
+
+        return "<SnapBoard host: %s port: %s>" % (self.host, self.katcp_port)
+
+    @property
+    def adc(self):
+        """ ADC controller, attached on first use """
+        if not self._adc_attached:
+            self.adc = self._attach_adc()
+        return self._adc
+
+    @adc.setter
+    def adc(self, adc):
+        self._adc = adc
+        self._adc_attached = True
+        if adc is not None and self.adc_logger is not None:
+            adc.logger = self.adc_logger
+
+    def _attach_adc(self):
+        """ Return SnapAdc if the design has an ADC16 controller, else a GenericAdc
+
+        Notes:
+            Checking for the controller costs a listdev, so it is put off until
+            the ADC is first used.
+        """
+        if not self.uses_adc:
+            return None
         # If design has an ADC, attach Generic ADC to add logging and basic functionality
-        if uses_adc:
-            self.adc = GenericAdc(self)
-            
+        adc = GenericAdc(self)
         if self.is_connected():
             try:
                 if self.is_adc16_based():
-                    self.adc = SnapAdc(self)
+                    adc = SnapAdc(self)
             except RuntimeError:
                 pass
-        self.logger = logging.getLogger('SnapBoard')
-
-    def __repr__(self):
-
-        return "<SnapBoard host: %s port: %s>" % (self.host, self.katcp_port)
+        return adc
     
-    def est_brd_clk(self):
+    def est_brd_clk(self, fresh=False):
         """Returns the approximate clock rate of the FPGA in MHz.
 
+        Args:
+            fresh (bool): Measure the clock now, which blocks for ~2 seconds.
+                          By default the cached estimate is returned, and a
+                          measurement is only made if there is none yet.
+
         Notes:
-            Deprecated in favor of estimate_fpga_clock()
+            Deprecated in favor of estimate_fpga_clock() and fpga_clock_estimate()
         """
+        if not fresh:
+            mhz, age = self.fpga_clock_estimate()
+            if mhz is not None:
+                return mhz
         return self.estimate_fpga_clock()
 
-    def program(self, boffile, gain=1, demux_mode=1, chips=('a', 'b', 'c')):
+    def read_uint(self, device_name, word_offset=0, **kwargs):
+        """ Read an unsigned integer; reads of sys_clkcounter also feed the clock estimate """
+        t0 = time.time()
+        value = super(SnapBoard, self).read_uint(device_name, word_offset, **kwargs)
+        if device_name == 'sys_clkcounter' and word_offset == 0:
+            self.clock.add_sample(value, (t0 + time.time()) / 2)
+        return value
+
+    def estimate_fpga_clock(self, interval=2.0):
+        """ Measure the FPGA clock rate in MHz, blocking for interval seconds
+
+        Also refreshes the cached estimate returned by fpga_clock_estimate().
+        """
+        self.read_uint('sys_clkcounter')
+        time.sleep(interval)
+        self.read_uint('sys_clkcounter')
+        return self.clock.mhz
+
+    def fpga_clock_estimate(self, sample=True):
+        """ Return the cached FPGA clock estimate without blocking
+
+        Args:
+            sample (bool): also read sys_clkcounter once (a single request),
+                           which updates the estimate if the last reading is
+                           old enough
+
+        Returns:
+            (clock_mhz, age): the estimate in MHz and its age in seconds, or
+            (None, None) until two counter reads far enough apart were seen
+        """
+        if sample:
+            try:
+                self.read_uint('sys_clkcounter')
+            except RuntimeError:
+                pass
+        return self.clock.estimate()
+
+    @contextmanager
+    def profile(self, profiler=None):
+        """ Count and time every request made inside the context
+
+        Args:
+            profiler (Profiler): Profiler to record into, e.g. to accumulate
+                                 over several sessions. A new one by default.
+
+        Yields:
+            the Profiler; see Profiler.report() and format_report()
+
+        Example:
+            with s.profile() as prof:
+                s.program('adc16_test.bof')
+            print(prof.format_report())
+        """
+        if profiler is None:
+            profiler = Profiler(self.host)
+        old_profiler, old_transport = self.profiler, self.transport
+        self.profiler = profiler
+        self.transport = InstrumentedTransport(old_transport, profiler)
+        try:
+            yield profiler
+        finally:
+            self.profiler, self.transport = old_profiler, old_transport
+
+    @contextmanager
+    def record(self, filename):
+        """ Record every KATCP request and reply made inside the context
+
+        Args:
+            filename (str): recording to write (gzipped JSON lines), see snap_replay
+
+        Example:
+            with s.record('snap01_program.katcp.gz'):
+                s.program('adc16_test.bof')
+        """
+        old_transport = self.transport
+        self.transport = RecordingTransport(old_transport, filename, host=self.host)
+        try:
+            yield self.transport
+        finally:
+            self.transport.close()
+            self.logger.info("Recorded %i requests to %s" % (self.transport.n_records, filename))
+            self.transport = old_transport
+
+    @contextmanager
+    def replay(self, filename, speed=1.0, strict=True):
+        """ Answer requests made inside the context from a recording, not the board
+
+        Args:
+            filename (str): recording made with record()
+            speed (float): 1.0 replays at the recorded latencies, 10.0 ten
+                           times faster, None without delay
+            strict (bool): require exactly the recorded requests. With False,
+                           snapshots are assembled from the recorded lane
+                           data, so changed calibration code can be replayed.
+
+        Notes:
+            The board does not need to be reachable.
+        """
+        old_transport = self.transport
+        self.transport = ReplayTransport(filename, speed=speed, strict=strict)
+        try:
+            yield self.transport
+        finally:
+            self.transport.close()
+            self.transport = old_transport
+
+    @profiled_phase('program')
+    def program(self, boffile, gain=1, demux_mode=1, chips=('a', 'b', 'c'), cal_cache=None,
+                bitstream_cache=None, force=False):
         """ Reprogram the FPGA with a given boffile AND calibrates
 
         Adds gain, demux_mode and chips params to katcp_wrapper's progdev
@@ -77,7 +287,15 @@ class SnapBoard(casperfpga.CasperFpga):
         Args:
             boffile (str): Name of boffile to program
             gain (int): ADC gain, from 1-32 (1, 2, 4, 8 recommended)
-        
+            cal_cache (CalibrationCache): Optional calibration cache. If given,
+                stored delay taps and bitslips for this host, bitstream and
+                demux mode are reapplied and verified instead of running a
+                full calibration, and the final calibration is stored back.
+            bitstream_cache (BitstreamCache): Optional bitstream cache. If the
+                board is still running boffile, the FPGA is not reprogrammed.
+            force (bool): Reprogram even if bitstream_cache says boffile is
+                already running.
+
         Notes:
             Overwrites the casperfpga program method, which has been reproduced
             as _program
@@ -86,27 +304,20 @@ class SnapBoard(casperfpga.CasperFpga):
         # Make a dictionary out of chips specified on command line.
         # mapping chip letters to numbers to facilitate writing to adc16_controller
         self.logger.info("Programming with %s - gain %i demux %i" % (boffile, gain, demux_mode))
-        self.transport.program(boffile)
-
-        if self.is_adc16_based():
-            self.logger.info("Design is ADC16 based. Calibration routines will run.")
-
-            # Check in case SnapAdc is already setup
-            if self.uses_adc:
-                if not isinstance(self.adc, SnapAdc):
-                    self.adc = SnapAdc(self)
-            self.fpga_set_demux(1)
-            self.adc.set_chip_select(chips)
-            self.adc.initialize()
-            self.adc.set_demux(demux_mode)
-            self.adc.set_gain(gain)
-            self.adc.power_cycle()
-            self.adc.calibrate()
+        bof_hash = bitstream_hash(boffile)
+        reprogram = force or not self._is_running(bitstream_cache, bof_hash)
+        if reprogram:
+            self.transport.program(boffile)
+            self._record_program(bitstream_cache, bof_hash, boffile)
+        self._setup_adc(boffile, gain, demux_mode, chips, cal_cache, reprogrammed=reprogram)
         self.logger.info("Programming complete.")
 
+    @profiled_phase('program')
     def upload_to_ram_and_program(self, filename, port=-1, timeout=10,
                                   wait_complete=True,
-                                  gain=1, demux_mode=1, chips=('a', 'b', 'c')):
+                                  gain=1, demux_mode=1, chips=('a', 'b', 'c'),
+                                  cal_cache=None, bitstream_cache=None, force=False,
+                                  uploader=None):
         """
         Upload an FPG file to RAM and then program the FPGA.
         :param filename: the file to upload
@@ -114,30 +325,242 @@ class SnapBoard(casperfpga.CasperFpga):
         :param timeout: how long to wait, seconds
         :param wait_complete: wait for the transaction to complete, return
         after upload if False
-        :return:
+        :param cal_cache: optional CalibrationCache, see program()
+        :param bitstream_cache: optional BitstreamCache. If the board is still
+        running filename, it is neither uploaded nor reprogrammed. If the
+        board stores a copy of filename (see BitstreamCache.put_stored), that
+        copy is programmed instead of uploading.
+        :param force: upload and program regardless of bitstream_cache
+        :param uploader: optional Uploader, to share the bitstream and the
+        network with other boards' uploads (see SnapManager.upload_and_program)
+        :return: UploadStats of the upload, None if there was no upload
         """
-        rv = self.transport.upload_to_ram_and_program(
-            filename, port, timeout, wait_complete)
+        bof_hash = bitstream_hash(filename)
+        stats = None
+        reprogram = force or not self._is_running(bitstream_cache, bof_hash)
+        if reprogram:
+            stored = None
+            if bitstream_cache is not None and not force:
+                stored = bitstream_cache.stored_name(self, self.host, bof_hash)
+            if stored is not None:
+                self.logger.info("%s stores %s as %s, programming it from there" % (self.host, filename, stored))
+                self.transport.program(stored)
+            else:
+                stats = self._upload_to_ram(filename, port, timeout, wait_complete,
+                                            uploader or DIRECT_UPLOADER)
+            if not wait_complete:
+                return stats
+            self._record_program(bitstream_cache, bof_hash, os.path.basename(filename))
         if filename[-3:] == 'fpg':
             self.get_system_information(filename)
 
-        if self.is_adc16_based():
-            self.logger.info("Design is ADC16 based. Calibration routines will run.")
-
-            # Check in case SnapAdc is already setup
-            if self.uses_adc:
-                if not isinstance(self.adc, SnapAdc):
-                    self.adc = SnapAdc(self)
-            self.fpga_set_demux(1)
-            self.adc.set_chip_select(chips)
-            self.adc.initialize()
-            self.adc.set_demux(demux_mode)
-            self.adc.set_gain(gain)
-            self.adc.power_cycle()
-            self.adc.calibrate()
+        self._setup_adc(filename, gain, demux_mode, chips, cal_cache, reprogrammed=reprogram)
         self.logger.info("Programming complete.")
 
-        return rv
+        return stats
+
+    def _upload_to_ram(self, filename, port, timeout, wait_complete, uploader):
+        """ Stream a bitstream to the board's progremote port and wait for it to program
+
+        Returns:
+            UploadStats, or None if the transport uploaded the file itself
+
+        Notes:
+            The file is sent in chunks by the uploader (see snap_upload), so
+            it is never read into memory. The uploader's transfer slot is
+            held from the progremote request until the file has been sent,
+            not while the FPGA programs. Transports that don't speak KATCP
+            fall back to their own upload_to_ram_and_program.
+            timeout applies to connecting, and to programming once the file
+            has been sent; the progremote request is given the expected
+            transfer time under the uploader's rate limit on top of it.
+        """
+        if not hasattr(self.transport, 'katcprequest'):
+            self.transport.upload_to_ram_and_program(filename, port, timeout, wait_complete)
+            return None
+        if port == -1:
+            port = random.randint(2000, 2500)
+        # Allow twice the expected transfer time, for slack in the rate limiting
+        request_timeout = timeout + 2 * uploader.transfer_time(os.path.getsize(filename))
+
+        errors = []
+
+        def _request():
+            try:
+                self.transport.katcprequest(name='progremote', request_timeout=request_timeout,
+                                            require_ok=True, request_args=(port,))
+            except Exception as e:
+                errors.append(e)
+
+        t_queued = time.time()
+        with uploader.transfer():
+            t0 = time.time()
+            if t0 - t_queued > 0.1:
+                self.logger.info("Waited %2.1fs for an upload slot" % (t0 - t_queued))
+            request_thread = threading.Thread(target=_request, name='progremote')
+            request_thread.daemon = True
+            request_thread.start()
+
+            upload_socket = None
+            while upload_socket is None:
+                try:
+                    upload_socket = socket.create_connection((self.host, port), timeout)
+                except socket.error:
+                    if errors or time.time() > t0 + timeout:
+                        err = "Could not connect to upload port %i on %s: %s" % (port, self.host, errors)
+                        self.logger.error(err)
+                        raise RuntimeError(err)
+                    time.sleep(0.05)
+            try:
+                stats = uploader.send(upload_socket, filename)
+            finally:
+                upload_socket.close()
+        self.profiler.record('upload.progremote', stats.seconds, stats.bytes, n_requests=0)
+        self.logger.info("Uploaded %s to %s: %s" % (filename, self.host, stats))
+        if not wait_complete:
+            return stats
+
+        t_sent = time.time()
+        request_thread.join(timeout)
+        if errors or request_thread.is_alive():
+            err = "Programming %s with %s failed: %s" % (self.host, filename, errors or 'timed out')
+            self.logger.error(err)
+            raise RuntimeError(err)
+        while not self._listdev_ok():
+            if time.time() > t_sent + timeout:
+                err = "%s seemed to upload to %s, but is not running" % (filename, self.host)
+                self.logger.error(err)
+                raise RuntimeError(err)
+            time.sleep(0.1)
+        return stats
+
+    def _listdev_ok(self):
+        """ Check if the FPGA lists its devices, i.e. has finished programming """
+        try:
+            return bool(self.transport.listdev())
+        except RuntimeError:
+            return False
+
+    def _is_running(self, bitstream_cache, bof_hash):
+        """ Check if bitstream_cache says the board is still running a bitstream """
+        if bitstream_cache is None or not bitstream_cache.is_running(self, self.host, bof_hash):
+            return False
+        self.logger.info("%s is still running bitstream %s, not reprogramming" % (self.host, bof_hash[:12]))
+        return True
+
+    def _record_program(self, bitstream_cache, bof_hash, name):
+        """ Store what the board was just programmed with in bitstream_cache """
+        if bitstream_cache is None:
+            return
+        bitstream_cache.put(self.host, bof_hash, name, board_fingerprint(self))
+        bitstream_cache.save()
+
+    def _setup_adc(self, boffile, gain, demux_mode, chips, cal_cache=None, reprogrammed=True):
+        """ Initialize and calibrate the ADCs after the FPGA has been programmed
+
+        If reprogrammed is False, the FPGA kept running, and so did its
+        ISERDES: the bitslips stored in cal_cache are taken as still applied.
+        Chips without a cache entry then have slips from an unknown base, so
+        their calibration is not stored.
+        """
+        if not self.is_adc16_based():
+            return
+        self.logger.info("Design is ADC16 based. Calibration routines will run.")
+
+        # Check in case SnapAdc is already setup
+        if self.uses_adc:
+            if not isinstance(self._adc, SnapAdc):
+                self.adc = SnapAdc(self)
+        self.adc.reset_cal_state()
+        self.fpga_set_demux(1)
+        self.adc.set_chip_select(chips)
+        self.adc.initialize()
+        self.adc.set_demux(demux_mode)
+        self.adc.set_gain(gain)
+        self.adc.power_cycle()
+
+        if cal_cache is None:
+            self.adc.calibrate()
+            return
+
+        bof_hash = bitstream_hash(boffile)
+        cal_state = {}
+        for chip, chip_num in self.adc.chips.items():
+            entry = cal_cache.get(self.host, bof_hash, chip, demux_mode)
+            if entry is not None:
+                cal_state[chip_num] = entry
+                if not reprogrammed:
+                    self.adc.bitslips[chip_num][:] = entry['bitslips']
+        self.adc.calibrate(cal_state=cal_state)
+
+        for chip, chip_num in self.adc.chips.items():
+            if not reprogrammed and chip_num not in cal_state:
+                self.logger.info("Not caching chip %s: its bitslips since programming are unknown" % chip)
+                continue
+            state = self.adc.cal_state[chip_num]
+            cal_cache.put(self.host, bof_hash, chip, demux_mode,
+                          state['taps'], state['bitslips'], state.get('margins'))
+        cal_cache.save()
+
+    def _katcp_burst(self, requests):
+        """ Send a list of KATCP requests back-to-back and wait for all replies
+
+        Requests are pipelined, with at most self.burst_window in flight, and
+        a single barrier at the end waits for the outstanding replies (see
+        katcp_pipeline.RequestWindow).
+
+        Args:
+            requests (list): list of (request_name, args) tuples
+
+        Returns:
+            replies (list): (reply, informs) for each request, in order
+
+        Notes:
+            Raises RuntimeError on the first request that failed or timed out.
+        """
+        window = RequestWindow(self.transport.callback_request, self.burst_window,
+                               self.request_timeout, self.host, self.logger)
+        return window.burst([Message.request(name, *args) for name, args in requests])
+
+    def write_int_burst(self, device_name, writes):
+        """ Blindwrite a sequence of integers to a register as a pipelined burst
+
+        Args:
+            device_name (str): name of register to write to
+            writes (list): list of (integer, word_offset) tuples, written in order
+
+        Notes:
+            All writes are sent without waiting for the individual replies, with
+            one barrier at the end. This turns N round-trips into ~1.
+        """
+        requests = []
+        for integer, word_offset in writes:
+            fmt = '>i' if integer < 0 else '>I'
+            data = struct.pack(fmt, integer)
+            requests.append(('write', (device_name, str(word_offset * 4), data)))
+
+        if hasattr(self.transport, 'callback_request'):
+            self._katcp_burst(requests)
+        else:
+            for name, (device_name, offset, data) in requests:
+                self.blindwrite(device_name, data, offset=int(offset))
+
+    def read_burst(self, device_names, size, offset=0):
+        """ Read the same byte range from several devices as a pipelined burst
+
+        Args:
+            device_names (list): names of devices to read from
+            size (int): number of bytes to read from each device
+            offset (int): byte offset to read from
+
+        Returns:
+            data (list): binary string read from each device, in order
+        """
+        if not hasattr(self.transport, 'callback_request'):
+            return [self.read(device_name, size, offset=offset) for device_name in device_names]
+
+        requests = [('read', (device_name, str(offset), str(size))) for device_name in device_names]
+        return [reply.arguments[1] for reply, informs in self._katcp_burst(requests)]
 
     def set_debug(self):
         """ Set logger levels to output debug info """
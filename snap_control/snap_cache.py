@@ -0,0 +1,241 @@
+"""
+# snap_cache.py
+
+On-disk cache of SERDES calibration results.
+
+Calibrating the ADC16 SERDES means sweeping delay taps and bitslipping every
+lane, which is slow. For a given board, bitstream and demux mode the result is
+usually the same from one reprogram to the next, so the chosen delay taps and
+bitslip counts are stored here, keyed by host, bitstream hash, chip and demux
+mode, and reapplied (then verified) on the next program.
+
+    ```
+    cache = CalibrationCache()
+    s.program('adc16_test.bof', cal_cache=cache)
+    ```
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.snap_control', 'cal_cache.json')
+DEFAULT_BITSTREAM_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.snap_control', 'bitstream_cache.json')
+
+# (path, size, mtime): hash, so a bitstream is only read once per process
+_HASH_CACHE = {}
+
+
+def bitstream_hash(boffile, chunk_size=2**20):
+    """ Return a hash identifying a bitstream
+
+    Args:
+        boffile (str): path to the bof/fpg file
+        chunk_size (int): bytes to hash at a time
+
+    Notes:
+        If boffile is not a local file (e.g. it names a bof already stored on
+        the board), the hash is computed from the file name instead.
+        Hashes of local files are remembered until the file changes (size or
+        modification time).
+    """
+    h = hashlib.sha1()
+    if os.path.isfile(boffile):
+        st = os.stat(boffile)
+        key = (os.path.abspath(boffile), st.st_size, st.st_mtime)
+        if key in _HASH_CACHE:
+            return _HASH_CACHE[key]
+        with open(boffile, 'rb') as fh:
+            chunk = fh.read(chunk_size)
+            while chunk:
+                h.update(chunk)
+                chunk = fh.read(chunk_size)
+        _HASH_CACHE[key] = h.hexdigest()
+        return _HASH_CACHE[key]
+    h.update(os.path.basename(boffile).encode('utf-8'))
+    return 'name-' + h.hexdigest()
+
+
+class _JsonCache(object):
+    """ Dict of entries, persisted as a JSON file
+
+    Args:
+        path (str): JSON file to store the cache in, default_path if None
+    """
+    default_path = None
+
+    def __init__(self, path=None):
+        self.path = path or self.default_path
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.entries = {}
+        self._lock = threading.RLock()     # boards may be handled from several threads
+        self.load()
+
+    def __repr__(self):
+        return "<%s: %s (%i entries)>" % (self.__class__.__name__, self.path, len(self.entries))
+
+    def load(self):
+        """ Load cache entries from disk, if the file exists """
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as fh:
+                self.entries = json.load(fh)
+        except ValueError:
+            self.logger.warning("Ignoring corrupt cache %s" % self.path)
+            self.entries = {}
+
+    def save(self):
+        """ Write cache entries to disk
+
+        Notes:
+            Writes to a temporary file first, so that an interrupted save
+            cannot leave a truncated cache behind.
+        """
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            with open(tmp_path, 'w') as fh:
+                json.dump(self.entries, fh, indent=1, sort_keys=True)
+            os.rename(tmp_path, self.path)
+
+
+class CalibrationCache(_JsonCache):
+    """ Persistent store of per-chip delay taps and bitslip counts
+
+    Args:
+        path (str): JSON file to store the cache in. Defaults to
+                    ~/.snap_control/cal_cache.json
+    """
+    default_path = DEFAULT_CACHE_PATH
+
+    @staticmethod
+    def key(host, bof_hash, chip, demux_mode):
+        """ Return the cache key for a host, bitstream, chip and demux mode """
+        return '%s|%s|%s|%i' % (host, bof_hash, chip, demux_mode)
+
+    def get(self, host, bof_hash, chip, demux_mode):
+        """ Return the cached entry for a chip, or None
+
+        The entry is a dict with 'taps' and 'bitslips' lists of 8 ints, one per
+        lane (1a, 1b, 2a ... 4b), plus the 'margins' and 'time' of calibration.
+        """
+        return self.entries.get(self.key(host, bof_hash, chip, demux_mode))
+
+    def put(self, host, bof_hash, chip, demux_mode, taps, bitslips, margins=None):
+        """ Store the calibration of a chip (call save() to write it to disk) """
+        entry = {'taps': [int(t) for t in taps],
+                 'bitslips': [int(b) for b in bitslips],
+                 'time': time.time()}
+        if margins is not None:
+            entry['margins'] = [int(m) for m in margins]
+        with self._lock:
+            self.entries[self.key(host, bof_hash, chip, demux_mode)] = entry
+
+    def invalidate(self, host, bof_hash=None):
+        """ Drop cache entries for a host, optionally only for one bitstream """
+        prefix = '%s|' % host if bof_hash is None else '%s|%s|' % (host, bof_hash)
+        with self._lock:
+            for k in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[k]
+
+
+def board_fingerprint(board):
+    """ Identify the design running on a board from board-side metadata
+
+    Args:
+        board: SnapBoard or FpgaClient
+
+    Returns:
+        dict with a hash of the listdev device names and, if the design has an
+        rcs block, its get_rcs() revision info; None if nothing is running
+    """
+    devices = sorted(str(d) for d in board.listdev())
+    if not devices:
+        return None
+    fingerprint = {'devices': hashlib.sha1('\n'.join(devices).encode('utf-8')).hexdigest()}
+    if 'rcs_app' in devices and hasattr(board, 'get_rcs'):
+        try:
+            fingerprint['rcs'] = board.get_rcs()
+        except (RuntimeError, KeyError):
+            pass
+    return fingerprint
+
+
+class BitstreamCache(_JsonCache):
+    """ Persistent record of the bitstream each board is running
+
+    Used to skip uploading and reprogramming a board that is still running
+    the requested image, e.g. when the control software is restarted.
+
+    Args:
+        path (str): JSON file to store the cache in. Defaults to
+                    ~/.snap_control/bitstream_cache.json
+
+    Notes:
+        An entry is only trusted if the board's fingerprint (see
+        board_fingerprint) still matches the one taken after programming, so
+        a board that was power cycled or reprogrammed by someone else is
+        programmed again. Designs with the same device names and no rcs
+        block cannot be told apart this way. Bitstreams stored on a board (as listed by listbof)
+        can be registered with put_stored, after which they are programmed
+        from the board's copy instead of being uploaded.
+    """
+    default_path = DEFAULT_BITSTREAM_CACHE_PATH
+
+    def get(self, host):
+        """ Return the entry for a host: {'hash', 'name', 'fingerprint', 'time', 'stored'}, or None """
+        return self.entries.get(host)
+
+    def put(self, host, bof_hash, name, fingerprint):
+        """ Record that a host was programmed (call save() to write it to disk) """
+        with self._lock:
+            stored = self.entries.get(host, {}).get('stored', {})
+            self.entries[host] = {'hash': bof_hash,
+                                  'name': name,
+                                  'fingerprint': fingerprint,
+                                  'time': time.time(),
+                                  'stored': stored}
+
+    def put_stored(self, host, name, bof_hash):
+        """ Record that a host stores a bitstream under name (as listed by listbof) """
+        with self._lock:
+            entry = self.entries.setdefault(host, {'hash': None, 'name': None, 'fingerprint': None,
+                                                   'time': time.time(), 'stored': {}})
+            entry['stored'][name] = bof_hash
+
+    def invalidate(self, host):
+        """ Forget what a host is running """
+        with self._lock:
+            if host in self.entries:
+                self.entries[host]['hash'] = None
+                self.entries[host]['fingerprint'] = None
+
+    def is_running(self, board, host, bof_hash):
+        """ Check if a board is still running the bitstream with this hash """
+        entry = self.get(host)
+        if entry is None or entry['hash'] != bof_hash or entry['fingerprint'] is None:
+            return False
+        try:
+            return board_fingerprint(board) == entry['fingerprint']
+        except RuntimeError:
+            return False
+
+    def stored_name(self, board, host, bof_hash):
+        """ Return the name under which a board stores this bitstream, or None """
+        entry = self.get(host)
+        if entry is None:
+            return None
+        names = [n for n, h in entry['stored'].items() if h == bof_hash]
+        if not names:
+            return None
+        listed = set(str(n) for n in board.listbof())
+        for name in names:
+            if name in listed:
+                return name
+        return None
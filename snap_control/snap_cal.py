@@ -0,0 +1,155 @@
+"""
+# snap_cal.py
+
+Vectorized analysis routines for HMCAD1511 SERDES calibration.
+
+The calibration routines in SnapAdc capture deskew/sync test patterns with the
+FPGA set to demux 4, in which case every 8 consecutive bytes of an
+adc16_wb_ram snapshot hold one sample from each of the 8 lanes of a chip:
+
+    1a 1b 2a 2b 3a 3b 4a 4b | 1a 1b 2a 2b ...
+
+A tap sweep is described by an error cube of shape (chips, 32 taps, 8 lanes),
+holding the number of samples per lane that did not match the test pattern.
+"""
+
+import numpy as np
+
+N_TAPS  = 32
+N_LANES = 8
+LANE_IDS = ['1a', '1b', '2a', '2b', '3a', '3b', '4a', '4b']
+
+DESKEW_VAL = 0x2a   # Deskew pattern reads as 0x2a = 42 when the lane is good
+SYNC_VAL   = 0x70   # Sync pattern reads as 0x70 when the lane is framed correctly
+
+
+def count_lane_errors(data, test_val):
+    """ Count per-lane pattern errors in demux-4 snapshot(s)
+
+    Args:
+        data (np.array): snapshot(s), shape (..., n_samples); n_samples must be
+                         a multiple of 8
+        test_val (int): expected value for every sample
+
+    Returns:
+        errors (np.array): int32 array of shape (..., 8), errors per lane
+    """
+    data = np.asarray(data)
+    lanes = data.reshape(data.shape[:-1] + (-1, N_LANES))
+    # Compare on the low byte so int8 and int64 snapshots behave the same
+    bad = (lanes.astype('int32') & 0xff) != (test_val & 0xff)
+    return bad.sum(axis=-2).astype('int32')
+
+
+def find_eyes(error_cube, cyclic=True):
+    """ Find the widest zero-error window for every lane of a tap sweep
+
+    Args:
+        error_cube (np.array): error counts, shape (..., n_taps, n_lanes),
+                               e.g. (chips, 32, 8)
+        cyclic (bool): Treat the tap axis as circular, so that a window may
+                       wrap around from the last tap back to tap 0.
+
+    Returns:
+        (best_taps, margins, widths): int arrays of shape (..., n_lanes).
+        best_taps is the centre of the widest zero-error window, margins the
+        number of good taps either side of it (the eye margin) and widths the
+        number of good taps in the window. Lanes without any good tap get
+        best_tap = -1, margin = -1 and width = 0.
+    """
+    error_cube = np.asarray(error_cube)
+    n_taps = error_cube.shape[-2]
+    # Move taps to the last axis and flatten the rest: shape (n, n_taps)
+    good = np.moveaxis(error_cube == 0, -2, -1)
+    out_shape = good.shape[:-1]
+    good = good.reshape(-1, n_taps)
+
+    if cyclic:
+        good = np.concatenate((good, good), axis=-1)
+    idx = np.arange(good.shape[-1])
+
+    # Length of the run of good taps ending at each position
+    last_bad = np.maximum.accumulate(np.where(good, -1, idx), axis=-1)
+    run_len  = np.minimum(idx - last_bad, n_taps)
+
+    end    = np.argmax(run_len, axis=-1)
+    widths = run_len[np.arange(run_len.shape[0]), end]
+    start  = end - widths + 1
+    margins   = (widths - 1) // 2
+    best_taps = (start + margins) % n_taps
+
+    no_eye = widths == 0
+    best_taps[no_eye] = -1
+    margins[no_eye]   = -1
+
+    return (best_taps.reshape(out_shape).astype('int32'),
+            margins.reshape(out_shape).astype('int32'),
+            widths.reshape(out_shape).astype('int32'))
+
+
+PATTERN_VALS = {'deskew': DESKEW_VAL,
+                'sync':   SYNC_VAL}
+
+
+def _rotl8(val, n):
+    """ Rotate an 8-bit value left by n bits """
+    n %= 8
+    return ((val << n) | (val >> (8 - n))) & 0xff
+
+
+def _rotations(val):
+    """ Return all 8-bit rotations of val, i.e. what a misframed lane can read """
+    return sorted(set(_rotl8(val, n) for n in range(8)))
+
+
+def sync_bitslips(data):
+    """ Work out how many bitslips each lane needs to frame the sync pattern
+
+    Each bitslip rotates the word a lane reads left by one bit, so a lane
+    reading SYNC_VAL rotated left by n needs (8 - n) % 8 bitslips.
+
+    Args:
+        data (np.array): demux-4 snapshot(s) of the sync pattern, shape (..., n_samples)
+
+    Returns:
+        n_slips (np.array): int32 array of shape (..., 8), bitslips per lane.
+        Lanes that do not read a steady rotation of the sync pattern get -1.
+    """
+    data = np.asarray(data)
+    lanes = data.reshape(data.shape[:-1] + (-1, N_LANES)).astype('int32') & 0xff
+    first = lanes[..., 0, :]
+    steady = np.all(lanes == first[..., np.newaxis, :], axis=-2)
+
+    lut = np.full(256, -1, dtype='int32')
+    for n in range(8):
+        lut[_rotl8(SYNC_VAL, n)] = (8 - n) % 8
+    n_slips = lut[first]
+    n_slips[~steady] = -1
+    return n_slips
+
+
+def pattern_fraction(data, pattern):
+    """ Return the fraction of samples that look like a given test pattern
+
+    Used to tell when a newly selected test pattern has reached the snapshot
+    RAMs. This works before calibration too: a lane that has not been
+    bitslipped into place reads a rotated version of the pattern.
+
+    Args:
+        data (np.array): demux-4 snapshot(s), shape (..., n_samples)
+        pattern (str): 'deskew', 'sync' or 'ramp'
+
+    Returns:
+        fraction (float): between 0 (no match) and 1 (every sample matches)
+    """
+    data = np.asarray(data).astype('int32') & 0xff
+    if pattern == 'ramp':
+        # Each lane of a ramp steps by the same non-zero amount every sample
+        lanes = data.reshape(data.shape[:-1] + (-1, N_LANES))
+        steps = np.diff(lanes, axis=-2) & 0xff
+        first = steps[..., :1, :]
+        return float(np.mean((steps == first) & (first != 0)))
+    elif pattern in PATTERN_VALS:
+        return float(np.mean(np.isin(data, _rotations(PATTERN_VALS[pattern]))))
+    else:
+        raise RuntimeError("No pattern check available for %s" % pattern)
@@ -1,4 +1,5 @@
 import snap_board
+from . import snap_cache
 import logging
 import sys
 
@@ -15,6 +16,8 @@ def cmd_tool(args=None):
                    help='KATCP port to use (default 7147)')
     p.add_argument('-c', '--chips', nargs='+', dest='chips', type=str, default='all',
                    help='Input chips you wish to calibrate. Default all chips:  a b c.')
+    p.add_argument('-C', '--cache', action='store_true', default=False,
+                   help='Reuse cached calibration for this board and bitstream if it verifies OK.')
     p.add_argument('-s', '--silent', action='store_true', default=False,
                    help='Silence all logging info.')
     p.add_argument('-v', '--verbose', action='store_true', default=False,
@@ -39,10 +42,15 @@ def cmd_tool(args=None):
     if not args.silent:
         print("Programming %s with %s" % (args.host, args.bof))
     
+    cal_cache = None
+    if args.cache:
+        cal_cache = snap_cache.CalibrationCache()
+
     s.program(boffile=args.bof, 
               chips=args.chips, 
               demux_mode=args.demux_mode, 
-              gain=args.gain)
+              gain=args.gain,
+              cal_cache=cal_cache)
     
     if not args.silent:
         print("DONE.")
@@ -6,12 +6,18 @@ Controller to issue commands to the snap boards
 """
 
 
-from .snap_adc import SnapAdc
 from .snap_board import SnapBoard
 from .snap_plot import demux_data
+from .snap_archive import SnapshotArchiveWriter
+from .snap_cache import bitstream_hash
+from .snap_upload import Uploader, UploadStats
 
 import logging
+import os
+import threading
+import time
 import numpy as np
+from contextlib import contextmanager
 from datetime import datetime
 
 try:
@@ -20,31 +26,166 @@ try:
 except:
     HAS_HKL = False
 
-from multiprocessing import JoinableQueue
+from multiprocessing.pool import ThreadPool
 
-from threading import Thread
+# Default seconds to wait for a command on each board. Programming and
+# calibrating a board takes well under this; a board that takes longer is
+# assumed dead, rather than stalling the whole fleet.
+DEFAULT_TIMEOUT = 120
 
 
-class SnapManager(object):
-    def __init__(self, board_list):
-        self.snap_boards = [SnapBoard(bl) for bl in board_list]
-        for s in self.snap_boards:
-             s.logger     = logging.getLogger(s.host)
-             if s.adc is None:
-                 s.adc = SnapAdc(self)
-             s.adc.logger = logging.getLogger(s.host + '-adc')
+class HostResult(object):
+    """ Outcome of a SnapManager command on one board
 
-        self.task_queue = JoinableQueue()
+    Exactly one of these holds: ok (value is set), exception is set, or
+    timed_out is True.
+    """
+    def __init__(self, host, value=None, exception=None, timed_out=False):
+        self.host      = host
+        self.value     = value
+        self.exception = exception
+        self.timed_out = timed_out
 
-    def _run(self, q, proc_id, fn_to_run, *args, **kwargs):
-        return_val = fn_to_run(*args, **kwargs)
-        q.put([proc_id, return_val])
-        q.task_done()
+    @property
+    def ok(self):
+        return self.exception is None and not self.timed_out
 
-    def _run_on_all(self, fn_to_run, *args, **kwargs):
-        q = JoinableQueue()
+    def __repr__(self):
+        if self.timed_out:
+            return "<HostResult %s: timed out>" % self.host
+        if self.exception is not None:
+            return "<HostResult %s: %r>" % (self.host, self.exception)
+        return "<HostResult %s: %r>" % (self.host, self.value)
+
+
+class FleetResult(dict):
+    """ Results of a SnapManager command, a dict of host: HostResult """
+    @property
+    def values_by_host(self):
+        """ dict of host: value for the boards that succeeded """
+        return dict((host, r.value) for host, r in self.items() if r.ok)
+
+    @property
+    def failed(self):
+        """ dict of host: HostResult for the boards that raised or timed out """
+        return dict((host, r) for host, r in self.items() if not r.ok)
+
+    def raise_for_errors(self):
+        """ Raise RuntimeError if any board raised or timed out """
+        if self.failed:
+            raise RuntimeError("Command failed on %s" % ', '.join(sorted(self.failed)))
+
+
+class SnapManager(object):
+    """ Issue commands to many SNAP boards at once
+
+    Args:
+        board_list (list): hostnames of the boards
+        timeout (float): default seconds to wait for a command on each board
+                         (DEFAULT_TIMEOUT); boards that take longer are
+                         reported as timed out. None waits forever.
+        max_workers (int): size of the worker thread pool, defaults to one
+                           thread per board (up to 64)
+        connect_timeout (float): seconds to wait for each board to connect
+        max_connections (int): max. number of boards to connect to at once
+
+    Notes:
+        Boards are connected concurrently. Boards that cannot be reached are
+        left out of snap_boards and listed in self.unreachable, with the
+        reason. The ADC controller of each board is attached on first use.
+        A command that timed out keeps running in the background, and later
+        commands on that board fail straight away, without taking a worker,
+        until it has finished.
+    """
+    def __init__(self, board_list, timeout=DEFAULT_TIMEOUT, max_workers=None,
+                 connect_timeout=3, max_connections=16):
+        self.timeout = timeout
+        self.logger = logging.getLogger('SnapManager')
+        self.unreachable = {}
+        self._board_locks = {}
+        self._archives = {}     # path: SnapshotArchiveWriter kept open by save_adc_snapshot
+        self._default_archive = None
+        self._running = {}      # host: name of a timed-out command that may still be running
+        self.snap_boards = self._connect_all(board_list, connect_timeout, max_connections)
+
+        if max_workers is None:
+            max_workers = max(1, min(len(self.snap_boards), 64))
+        # Long-lived pool, so repeated calls don't pay for thread startup
+        self.pool = ThreadPool(max_workers)
+
+    def _connect(self, host, connect_timeout):
+        """ Connect to one board, returning (SnapBoard or None, reason it is unreachable) """
+        try:
+            s = SnapBoard(host, timeout=connect_timeout)
+        except Exception as e:
+            return None, str(e)
+        if not s.is_connected():
+            try:
+                s.disconnect()
+            except Exception:
+                pass
+            return None, "not connected after %2.1fs" % connect_timeout
+        s.logger     = logging.getLogger(s.host)
+        s.adc_logger = logging.getLogger(s.host + '-adc')
+        return s, None
+
+    def _connect_all(self, board_list, connect_timeout, max_connections):
+        """ Connect to all boards, at most max_connections at a time """
+        if not board_list:
+            return []
+        pool = ThreadPool(max(1, min(len(board_list), max_connections)))
+        try:
+            connected = pool.map(lambda host: self._connect(host, connect_timeout), board_list)
+        finally:
+            pool.close()
+            pool.join()
+
+        snap_boards = []
+        for host, (s, reason) in zip(board_list, connected):
+            if s is None:
+                self.logger.warning("%s: unreachable (%s)" % (host, reason))
+                self.unreachable[host] = reason
+            else:
+                snap_boards.append(s)
+        self.logger.info("Connected to %i of %i boards" % (len(snap_boards), len(board_list)))
+        return snap_boards
+
+    def close(self):
+        """ Flush and close the archives opened by save_adc_snapshot, and shut down the worker pool """
+        self.close_archives()
+        self.pool.terminate()
+        self.pool.join()
+
+    def run_on_all(self, fn_to_run, args=(), kwargs=None, timeout=None):
+        """ Call a SnapBoard (or SnapAdc) method on every board at once
+
+        Args:
+            fn_to_run (str): method name, looked up on the board, then its adc
+            args (tuple): positional arguments for the method
+            kwargs (dict): keyword arguments for the method
+            timeout (float): seconds to wait for each board, defaults to
+                             self.timeout. A board's time starts when a worker
+                             starts its command, so time spent queued for a
+                             worker (with more boards than max_workers) does
+                             not count.
+
+        Returns:
+            FleetResult of host: HostResult. A board that raises or times out
+            does not hold up the others.
+
+        Notes:
+            A board that timed out keeps working on the command in the
+            background. Until it finishes, later commands on that board fail
+            with a RuntimeError instead of queueing behind it.
+        """
+        if kwargs is None:
+            kwargs = {}
+        if timeout is None:
+            timeout = self.timeout
+
+        results = FleetResult()
+        pending = []
         for s in self.snap_boards:
-            s_name = s.host
             try:
                 method = getattr(s, fn_to_run)
             except AttributeError:
@@ -52,32 +193,129 @@ class SnapManager(object):
                     method = getattr(s.adc, fn_to_run)
                 except AttributeError:
                     raise RuntimeError("Cannot find method %s" % fn_to_run)
+            if s.host in self._running:
+                err = "%s: not running %s, %s timed out and is still running" % (
+                    s.host, fn_to_run, self._running[s.host])
+                self.logger.error(err)
+                results[s.host] = HostResult(s.host, exception=RuntimeError(err))
+                continue
+            lock = self._board_locks.setdefault(s.host, threading.Lock())
+            started = []    # start time, appended by the worker
+            pending.append((s.host, started, self.pool.apply_async(
+                self._call_locked, (s.host, lock, started, method, args, kwargs))))
+
+        for host, started, async_result in pending:
+            if not self._wait_started(async_result, started, timeout):
+                self.logger.error("%s: %s timed out after %2.1fs, it is still running in the background"
+                                  % (host, fn_to_run, timeout))
+                self._running[host] = fn_to_run
+                results[host] = HostResult(host, timed_out=True)
+                continue
+            try:
+                results[host] = HostResult(host, value=async_result.get(0))
+            except Exception as e:
+                self.logger.error("%s: %s failed: %s" % (host, fn_to_run, e))
+                results[host] = HostResult(host, exception=e)
+        return results
+
+    @staticmethod
+    def _wait_started(async_result, started, timeout, poll_interval=0.1):
+        """ Wait for a command until timeout seconds after a worker started it
+
+        Returns:
+            True if the command finished, False if it timed out
+        """
+        while not async_result.ready():
+            if not started:
+                # Still queued for a worker
+                async_result.wait(poll_interval)
+            elif timeout is None:
+                # Always wait with a timeout: an untimed wait() cannot be interrupted in python 2
+                async_result.wait(1e9)
+            else:
+                remaining = started[0] + timeout - time.time()
+                if remaining <= 0:
+                    return False
+                async_result.wait(remaining)
+        return True
+
+    def _call_locked(self, host, lock, started, method, args, kwargs):
+        """ Run a command on one board, after any earlier command on that board
+
+        Appends the time the command starts to started.
+        """
+        with lock:
+            started.append(time.time())
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._running.pop(host, None)
+
+    def _run_on_all(self, fn_to_run, *args, **kwargs):
+        """ Run a command on all boards, returning {host: value} of the boards that succeeded
 
-            # Setup arguments and keyword args
-            all_args = [q, s_name, method]
-            if kwargs is None:
-                kwargs = {}
-            if args is not None:
-                for aa in args:
-                    all_args.append(aa)
-            t = Thread(target=self._run,
-                       name=s_name,
-                       args=all_args,
-                       kwargs=kwargs)
-            t.daemon = True
-            t.start()
-        q.join()
-
-        # Iterate through queue and
-        outdict = {}
-        for ii in range(0, len(self.snap_boards)):
-            d_key, d_out = q.get()
-            outdict[d_key] = d_out
-        return outdict
+        Boards that failed or timed out are left out (and logged by run_on_all).
+        Use run_on_all for the per-board outcome.
+        """
+        return self.run_on_all(fn_to_run, args, kwargs).values_by_host
 
     def program(self, boffile, gain=1, demux_mode=1):
         self._run_on_all('program', boffile, gain, demux_mode)
 
+    def upload_and_program(self, filename, gain=1, demux_mode=1, chips=('a', 'b', 'c'),
+                           max_transfers=8, max_rate=None, upload_timeout=10,
+                           cal_cache=None, bitstream_cache=None, timeout=None):
+        """ Upload a bitstream to every board, program and calibrate it
+
+        Args:
+            filename (str): bitstream to upload (see SnapBoard.upload_to_ram_and_program)
+            max_transfers (int): max. uploads in flight at once, None for no limit
+            max_rate (float): max. aggregate upload rate in bytes/s, None for
+                              no limit. Needs max_transfers.
+            upload_timeout (float): seconds each board has to accept its
+                                    upload, and to program once the file has
+                                    been sent. The (rate limited) transfer
+                                    itself does not count against it.
+            cal_cache (CalibrationCache): optional, see SnapBoard.program
+            bitstream_cache (BitstreamCache): optional, see SnapBoard.program
+            timeout (float): seconds to wait for each board, see run_on_all.
+                             Defaults to self.timeout plus twice the time the
+                             uploads take at max_rate, since a board may wait
+                             for the other boards' uploads.
+
+        Returns:
+            FleetResult of host: UploadStats, or None if the board did not
+            need an upload
+
+        Notes:
+            The bitstream is memory-mapped once and shared by all uploads.
+            Boards queue for one of max_transfers upload slots, and each board
+            initializes and calibrates its ADCs as soon as it has been
+            programmed, while the remaining boards are still uploading.
+        """
+        bitstream_hash(filename)        # hash once here, not in every worker
+        if timeout is None and self.timeout is not None and max_rate:
+            timeout = self.timeout + 2 * len(self.snap_boards) * os.path.getsize(filename) / float(max_rate)
+        uploader = Uploader(max_transfers, max_rate)
+        uploader.share(filename)
+        t0 = time.time()
+        results = self.run_on_all('upload_to_ram_and_program', (filename,),
+                                  {'timeout': upload_timeout, 'gain': gain,
+                                   'demux_mode': demux_mode, 'chips': chips,
+                                   'cal_cache': cal_cache, 'bitstream_cache': bitstream_cache,
+                                   'uploader': uploader},
+                                  timeout=timeout)
+        if any(r.timed_out for r in results.values()):
+            # Uploads may still be reading the mapping, leave it to the garbage collector
+            self.logger.warning("Not unmapping %s, uploads timed out" % filename)
+        else:
+            uploader.close()
+        uploads = [v for v in results.values_by_host.values() if isinstance(v, UploadStats)]
+        total = UploadStats(sum(u.bytes for u in uploads), time.time() - t0)
+        self.logger.info("Programmed %i of %i boards (%i uploads), %s" % (
+            len(results) - len(results.failed), len(results), len(uploads), total))
+        return results
+
     def recalibrate(self):
         self._run_on_all('calibrate')
 
@@ -129,6 +367,41 @@ class SnapManager(object):
             s = self.snap_boards[0]
             return s.estimate_fpga_clock()
 
+    def fpga_clock_estimate(self):
+        """ Return the cached (MHz, age) FPGA clock estimate of every board, without blocking """
+        return self._run_on_all('fpga_clock_estimate')
+
+    @contextmanager
+    def profile(self):
+        """ Profile every board inside the context, see SnapBoard.profile
+
+        Yields:
+            dict of hostname: Profiler
+        """
+        contexts = [(s.host, s.profile()) for s in self.snap_boards]
+        profilers = {}
+        try:
+            for host, context in contexts:
+                profilers[host] = context.__enter__()
+            yield profilers
+        finally:
+            for host, context in contexts[:len(profilers)]:
+                context.__exit__(None, None, None)
+
+    def _archive_writer(self, path):
+        """ Return the writer save_adc_snapshot keeps open for an archive directory """
+        if path not in self._archives:
+            metadata = {'hosts': dict((s.host, {'demux_mode': s.adc.demux_mode, 'gain': s.adc.gain})
+                                      for s in self.snap_boards if hasattr(s.adc, 'demux_mode'))}
+            self._archives[path] = SnapshotArchiveWriter(path, metadata=metadata)
+        return self._archives[path]
+
+    def close_archives(self):
+        """ Flush and close the archives opened by save_adc_snapshot """
+        for writer in self._archives.values():
+            writer.close()
+        self._archives = {}
+
     def check_rms(self):
         d = {}
         dd = self._run_on_all('check_rms')
@@ -148,23 +421,48 @@ class SnapManager(object):
         return d
 
     def check_calibration(self):
-        dd = self._run_on_all('check_calibration')
+        dd = self.run_on_all('check_calibration')
         for k in sorted(dd.keys()):
-            print dd[k]
-
-    def save_adc_snapshot(self, filename=None):
+            print(dd[k].value if dd[k].ok else dd[k])
+
+    def save_adc_snapshot(self, filename=None, archive=None):
+        """ Grab a snapshot from every board and save it
+
+        Args:
+            filename (str): hickle file to write, default adc_snapshot_<date>.hkl
+            archive (SnapshotArchiveWriter or str): If given, append the
+                snapshot to this archive (or archive directory) instead.
+                Also used, with a default name, if hickle is not installed.
+
+        Notes:
+            An archive given by path is opened once and kept open by the
+            manager, so that repeated calls (e.g. a monitoring loop) fill
+            whole chunks instead of writing one tiny chunk per call. Records
+            reach the disk a chunk at a time: call close_archives() (or
+            close()) when done. Alternatively, pass a SnapshotArchiveWriter
+            and manage it yourself.
+        """
+        t0 = time.time()
         d = self.grab_adc_snapshot()
 
-        if HAS_HKL:
-            print("Saving data...")
-
-            if filename is None:
-                now = datetime.now()
-                now_str = now.strftime("%Y-%m-%d-%H%M%S")
-                filename = 'adc_snapshot_%s.hkl' % now_str
-            hkl.dump(d, filename)
-            print("OK")
-        else:
-            print("Python hickle module not installed, cannot export data.")
-
-
+        if archive is None and not HAS_HKL:
+            if self._default_archive is None:
+                now_str = datetime.now().strftime("%Y-%m-%d-%H%M%S")
+                self._default_archive = 'adc_snapshot_%s' % now_str
+                print("Python hickle module not installed, saving to archive %s" % self._default_archive)
+            archive = self._default_archive
+
+        if archive is not None:
+            if not isinstance(archive, SnapshotArchiveWriter):
+                archive = self._archive_writer(archive)
+            archive.append(d, timestamp=t0)
+            return
+
+        print("Saving data...")
+
+        if filename is None:
+            now = datetime.now()
+            now_str = now.strftime("%Y-%m-%d-%H%M%S")
+            filename = 'adc_snapshot_%s.hkl' % now_str
+        hkl.dump(d, filename)
+        print("OK")
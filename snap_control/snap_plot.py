@@ -4,7 +4,6 @@
 Plotting scripts for SnapBoard ADC chip
 
 """
-import snap_board
 import os
 import numpy as np
 
@@ -15,44 +14,45 @@ except:
     pass
 
 def demux_data(snapshot, demux):
-    """ Demux and interleaves data for plotting """
-    input1_data = []
-    input2_data = []
-    input3_data = []
-    input4_data = []
+    """ Demux and interleaves data for plotting
+
+    Args:
+        snapshot (np.array): ADC snapshot(s), shape (..., n_samples), e.g.
+                             (samples,), (chips, samples) or (boards, chips, samples)
+        demux (int): ADC demux mode, 1, 2 or 4
+
+    Returns:
+        demux 1: (input1, input2, input3, input4)
+        demux 2: (input1, input3)
+        demux 4: input1
+        Each of shape (..., n_out). Demux 1 returns views into snapshot.
+
+    Notes:
+        Snapshots may be any length; a trailing partial frame (less than 4
+        samples in demux 1, 8 otherwise) is dropped.
+    """
+    snapshot = np.asarray(snapshot)
+    lead = snapshot.shape[:-1]
+    frame = 4 if demux == 1 else 8
+    n_frames = snapshot.shape[-1] // frame
+    frames = snapshot[..., :n_frames * frame]
 
     if demux == 1:
-        for i in range(0, 1024, 4):
-            input1_data.append(snapshot[i + 0])
-            input2_data.append(snapshot[i + 1])
-            input3_data.append(snapshot[i + 2])
-            input4_data.append(snapshot[i + 3])
-        return input1_data, input2_data, input3_data, input4_data
+        # Samples of input k sit at k, k+4, k+8 ...
+        frames = frames.reshape(lead + (n_frames, 4))
+        return tuple(frames[..., k] for k in range(4))
 
     elif demux == 2:
-        for i in range(0, 1024, 8):
-            input1_data.append(snapshot[i + 0])
-            input1_data.append(snapshot[i + 4])
-            input1_data.append(snapshot[i + 1])
-            input1_data.append(snapshot[i + 5])
-
-            input3_data.append(snapshot[i + 2])
-            input3_data.append(snapshot[i + 6])
-            input3_data.append(snapshot[i + 3])
-            input3_data.append(snapshot[i + 7])
+        # Each frame of 8 holds inputs 1 and 3 as [1a 1b 3a 3b 1c 1d 3c 3d]
+        frames = frames.reshape(lead + (n_frames, 2, 4))
+        input1_data = frames[..., 0:2].swapaxes(-1, -2).reshape(lead + (-1,))
+        input3_data = frames[..., 2:4].swapaxes(-1, -2).reshape(lead + (-1,))
         return input1_data, input3_data
 
     elif demux == 4:
-        for i in range(0, 1024, 8):
-            input1_data.append(snapshot[i + 0])
-            input1_data.append(snapshot[i + 2])
-            input1_data.append(snapshot[i + 4])
-            input1_data.append(snapshot[i + 6])
-            input1_data.append(snapshot[i + 1])
-            input1_data.append(snapshot[i + 3])
-            input1_data.append(snapshot[i + 5])
-            input1_data.append(snapshot[i + 7])
-        return input1_data
+        # Each frame of 8 holds input 1 as [a e b f c g d h]
+        frames = frames.reshape(lead + (n_frames, 4, 2))
+        return frames.swapaxes(-1, -2).reshape(lead + (-1,))
 
     else:
         raise RuntimeError("Weird demux factor, use 1, 2 or 4.")
@@ -72,6 +72,8 @@ def cmd_tool(args=None):
                    help='Faster plotting for remote connection')
     p.add_argument('-f', '--fft', dest='do_fft', action='store_true', default=False,
                    help='Plot ADC channel bandpass (i.e. take FFT^2 of snapshot data)')                   
+    p.add_argument('-N', '--integrations', dest='n_integrations', type=int, default=64,
+                   help='Number of snapshots to average for --fft (default 64)')
     p.add_argument('-T', '--deskewpattern', dest='pattern_deskew', action='store_true', default=False,
                    help='Plot test pattern (deskew). Value should be a constant 42.')
     #p.add_argument('-T', '--syncpattern', dest='pattern_sync', action='store_true', default=False,
@@ -93,7 +95,8 @@ def cmd_tool(args=None):
     import matplotlib.pyplot as plt
 
     # define an ADC16 class object and pass it keyword arguments
-    s = snap_board.SnapBoard(args.host, args.katcp_port)
+    from .snap_board import SnapBoard
+    s = SnapBoard(args.host, args.katcp_port)
     
     if args.pattern_deskew:
         s.adc.enable_pattern('deskew')
@@ -104,16 +107,22 @@ def cmd_tool(args=None):
 
     plt.figure('plot_chans', figsize=(8, 6))
     
+    if args.do_fft:
+        from .snap_spec import Spectrometer
+        spec = Spectrometer(demux_mode=args.demux_mode)
+        spectra = 10 * np.log10(spec.integrate(s.adc, args.n_integrations, chip_nums=(0, 1, 2)))
+    else:
+        snapshots = s.adc.capture((0, 1, 2))
+
     for chip_id in (0,1,2):
-        snapshot = s.adc.read_ram('adc16_wb_ram{0}'.format(chip_id))
+        if not args.do_fft:
+            snapshot = snapshots[chip_id]
         
         if args.demux_mode == 1:
-            d1, d2, d3, d4 = demux_data(snapshot, args.demux_mode)
             if args.do_fft:
-                d1 = np.fft.rfft(d1)
-                d2 = np.fft.rfft(d2)
-                d3 = np.fft.rfft(d3)
-                d4 = np.fft.rfft(d4)
+                d1, d2, d3, d4 = spectra[chip_id]
+            else:
+                d1, d2, d3, d4 = demux_data(snapshot, args.demux_mode)
             plt.subplot(3, 4, 1 + 4*chip_id)
             plt.plot(d1, c='#cc00cc')
             plt.title('Input 1 data chip %s' % chip_id)
@@ -128,10 +137,10 @@ def cmd_tool(args=None):
             plt.title('Input 4 data chip %s' % chip_id)
         
         elif args.demux_mode == 2:
-            d1, d3 = demux_data(snapshot, args.demux_mode)
             if args.do_fft:
-                d1 = np.fft.rfft(d1)
-                d3 = np.fft.rfft(d3)
+                d1, d3 = spectra[chip_id]
+            else:
+                d1, d3 = demux_data(snapshot, args.demux_mode)
             plt.subplot(3, 2, 1 + 2*chip_id)
             plt.plot(d1)
             plt.title('Input 1 data chip %s' % chip_id)
@@ -140,9 +149,10 @@ def cmd_tool(args=None):
             plt.title('Input 3 data chip %s' % chip_id)
         
         elif args.demux_mode == 4:
-            d1 = demux_data(snapshot, args.demux_mode)
             if args.do_fft:
-                d1 = np.fft.rfft(d1)
+                d1 = spectra[chip_id][0]
+            else:
+                d1 = demux_data(snapshot, args.demux_mode)
             plt.subplot(3, 1, 1 + chip_id)
             plt.plot(d1)
             plt.title('Input 1 data chip %s' % chip_id)
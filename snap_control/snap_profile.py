@@ -0,0 +1,313 @@
+"""
+# snap_profile.py
+
+Request counting and timing for SnapBoard and SnapAdc.
+
+A Profiler collects, for every operation, the number of calls, KATCP
+requests, bytes and a latency histogram. Samples are filed under the phase
+they ran in. Phases are named scopes that nest, so a deskew capture made by
+walk_taps during program() is filed under 'program/calibrate/walk_taps':
+
+    ```
+    with s.profile() as prof:
+        s.program('adc16_test.bof')
+    print(prof.format_report())
+    ```
+
+Operations are named by layer: 'katcp.<request>' for requests sent by the
+SnapBoard transport, and 'adc.<op>' for SnapAdc register writes and
+snapshot reads (one adc.write_burst is many katcp.write requests).
+"""
+
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency histogram bin edges: 1 us to 100 s, four bins per decade
+HIST_EDGES = [10 ** (ii / 4.0) for ii in range(-24, 9)]
+
+
+class LatencyHistogram(object):
+    """ Log-spaced histogram of latencies, in seconds
+
+    counts[0] holds samples below HIST_EDGES[0] and counts[-1] samples above
+    HIST_EDGES[-1].
+    """
+    def __init__(self):
+        self.counts = [0] * (len(HIST_EDGES) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def __repr__(self):
+        return "<LatencyHistogram: %i samples, mean %2.3f ms>" % (self.n, self.mean * 1e3)
+
+    def add(self, t):
+        self.counts[bisect.bisect_right(HIST_EDGES, t)] += 1
+        self.n += 1
+        self.total += t
+        self.max = max(self.max, t)
+
+    @property
+    def mean(self):
+        return self.total / self.n if self.n else 0.0
+
+    def percentile(self, q):
+        """ Return the upper bin edge below which q percent of samples fall """
+        if not self.n:
+            return 0.0
+        target = self.n * q / 100.0
+        cumulative = 0
+        for ii, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return HIST_EDGES[ii] if ii < len(HIST_EDGES) else self.max
+        return self.max
+
+
+class OpStats(object):
+    """ Calls, requests, bytes and latencies of one operation in one phase """
+    def __init__(self):
+        self.calls = 0
+        self.requests = 0
+        self.bytes = 0
+        self.latency = LatencyHistogram()
+
+    def add(self, elapsed, n_bytes, n_requests):
+        self.calls += 1
+        self.requests += n_requests
+        self.bytes += n_bytes
+        self.latency.add(elapsed)
+
+    def as_dict(self):
+        return {'calls': self.calls,
+                'requests': self.requests,
+                'bytes': self.bytes,
+                'time': self.latency.total,
+                'mean': self.latency.mean,
+                'p50': self.latency.percentile(50),
+                'p99': self.latency.percentile(99),
+                'max': self.latency.max}
+
+
+class Profiler(object):
+    """ Collects operation counts and latencies, filed by phase
+
+    Args:
+        name (str): label for the report, e.g. the hostname
+
+    Notes:
+        The phase stack is kept per thread. Operations on a thread that is not
+        inside any phase are filed under ''.
+    """
+    enabled = True
+
+    def __init__(self, name=''):
+        self.name = name
+        self.phases = {}        # path: [calls, wall time]
+        self.ops = {}           # (path, op): OpStats
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __repr__(self):
+        return "<Profiler %s: %i phases, %i requests>" % (
+            self.name, len(self.phases), sum(s.requests for s in self.ops.values()))
+
+    def current_phase(self):
+        """ Return the path of the phase this thread is in, e.g. 'program/calibrate' """
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else ''
+
+    @contextmanager
+    def phase(self, name):
+        """ Scope: operations inside are filed under this phase """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        path = stack[-1] + '/' + name if stack else name
+        stack.append(path)
+        t0 = time.time()
+        try:
+            yield path
+        finally:
+            elapsed = time.time() - t0
+            stack.pop()
+            with self._lock:
+                entry = self.phases.setdefault(path, [0, 0.0])
+                entry[0] += 1
+                entry[1] += elapsed
+
+    def record(self, op, elapsed, n_bytes=0, n_requests=1, phase=None):
+        """ Record one operation
+
+        Args:
+            op (str): operation name, e.g. 'katcp.read'
+            elapsed (float): latency in seconds
+            n_bytes (int): payload bytes sent and received
+            n_requests (int): KATCP requests the operation took
+            phase (str): phase path; defaults to this thread's current phase,
+                         pass it explicitly when recording from a callback
+        """
+        if phase is None:
+            phase = self.current_phase()
+        with self._lock:
+            key = (phase, op)
+            if key not in self.ops:
+                self.ops[key] = OpStats()
+            self.ops[key].add(elapsed, n_bytes, n_requests)
+
+    def report(self):
+        """ Return the per-phase report
+
+        Returns:
+            report (dict): phase path: {'calls': n, 'wall_time': s, 'ops':
+            {op: {'calls', 'requests', 'bytes', 'time', 'mean', 'p50', 'p99',
+            'max'}}}. wall_time includes nested phases, ops only those
+            recorded directly in the phase.
+        """
+        with self._lock:
+            report = dict((path, {'calls': calls, 'wall_time': wall, 'ops': {}})
+                          for path, (calls, wall) in self.phases.items())
+            for (path, op), stats in self.ops.items():
+                if path not in report:
+                    report[path] = {'calls': 0, 'wall_time': 0.0, 'ops': {}}
+                report[path]['ops'][op] = stats.as_dict()
+        return report
+
+    def totals(self):
+        """ Return {op: stats} summed over all phases """
+        totals = {}
+        with self._lock:
+            for (path, op), stats in self.ops.items():
+                t = totals.setdefault(op, {'calls': 0, 'requests': 0, 'bytes': 0, 'time': 0.0})
+                t['calls'] += stats.calls
+                t['requests'] += stats.requests
+                t['bytes'] += stats.bytes
+                t['time'] += stats.latency.total
+        return totals
+
+    def format_report(self):
+        """ Return the report as a printable table """
+        report = self.report()
+        lines = ["Profile %s" % self.name,
+                 "%-40s %6s %9s %9s %10s %9s %9s" % ('phase / op', 'calls', 'requests', 'bytes',
+                                                    'time (s)', 'p50 (ms)', 'p99 (ms)')]
+        for path in sorted(report):
+            entry = report[path]
+            depth = path.count('/') + 1 if path else 0
+            lines.append("%-40s %6i %9s %9s %10.3f" % (
+                '  ' * depth + (path.split('/')[-1] or '(no phase)'), entry['calls'], '', '',
+                entry['wall_time']))
+            for op in sorted(entry['ops']):
+                s = entry['ops'][op]
+                lines.append("%-40s %6i %9i %9i %10.3f %9.3f %9.3f" % (
+                    '  ' * (depth + 1) + op, s['calls'], s['requests'], s['bytes'],
+                    s['time'], s['p50'] * 1e3, s['p99'] * 1e3))
+        return '\n'.join(lines)
+
+
+class NullProfiler(object):
+    """ Stand-in Profiler that records nothing """
+    enabled = False
+
+    def __repr__(self):
+        return "<NullProfiler>"
+
+    def current_phase(self):
+        return ''
+
+    @contextmanager
+    def phase(self, name):
+        yield name
+
+    def record(self, op, elapsed, n_bytes=0, n_requests=1, phase=None):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def profiled_phase(name):
+    """ Decorator: run a method of an object with a .profiler in a named phase """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            with self.profiler.phase(name):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _arg_bytes(args):
+    return sum(len(a) for a in args if isinstance(a, (bytes, str)))
+
+
+class InstrumentedTransport(object):
+    """ Proxy for a casperfpga transport that records every request
+
+    Args:
+        transport: the transport to wrap (e.g. SnapBoard.transport)
+        profiler (Profiler): where to record
+
+    Notes:
+        Attributes other than the request methods pass straight through.
+        callback_request (pipelined bursts) is timed from send to reply.
+    """
+    # method: (index, name) of the argument holding the payload, for byte counts
+    _SIZE_ARGS = {'read': (1, 'size'), 'bulkread': (1, 'size'),
+                  'blindwrite': (1, 'data'), 'write': (1, 'data')}
+    _METHODS = ('read', 'bulkread', 'blindwrite', 'write', 'listdev', 'listbof',
+                'program', 'deprogram', 'upload_to_ram_and_program', 'katcprequest')
+
+    def __init__(self, transport, profiler):
+        self._transport = transport
+        self._profiler = profiler
+
+    def __repr__(self):
+        return "<InstrumentedTransport: %r>" % self._transport
+
+    def __getattr__(self, name):
+        attr = getattr(self._transport, name)
+        if name == 'callback_request':
+            return self._timed_callback_request(attr)
+        if name not in self._METHODS:
+            return attr
+
+        def _timed(*args, **kwargs):
+            t0 = time.time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                op = name
+                if name == 'katcprequest':
+                    op = kwargs.get('name', args[0] if args else 'request')
+                self._profiler.record('katcp.' + op, time.time() - t0,
+                                      self._payload_bytes(name, args, kwargs))
+        return _timed
+
+    def _payload_bytes(self, name, args, kwargs):
+        if name not in self._SIZE_ARGS:
+            return 0
+        idx, key = self._SIZE_ARGS[name]
+        value = kwargs.get(key, args[idx] if len(args) > idx else 0)
+        return value if isinstance(value, int) else len(value)
+
+    def _timed_callback_request(self, callback_request):
+        profiler = self._profiler
+
+        def _callback_request(msg, reply_cb=None, inform_cb=None, user_data=None, **kwargs):
+            phase = profiler.current_phase()
+            t0 = time.time()
+            n_sent = _arg_bytes(msg.arguments)
+
+            def _reply_cb(reply, *data):
+                profiler.record('katcp.' + msg.name, time.time() - t0,
+                                n_sent + _arg_bytes(reply.arguments), phase=phase)
+                if reply_cb is not None:
+                    reply_cb(reply, *data)
+
+            return callback_request(msg, reply_cb=_reply_cb, inform_cb=inform_cb,
+                                    user_data=user_data, **kwargs)
+        return _callback_request
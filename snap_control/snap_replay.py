@@ -0,0 +1,497 @@
+"""
+# snap_replay.py
+
+Record the KATCP traffic of a SnapBoard session, and replay it later without
+the board.
+
+Recording wraps the board's transport and writes every request, its reply
+and its timing to a gzipped file of JSON lines:
+
+    ```
+    with s.record('snap01_program.katcp.gz'):
+        s.program('adc16_test.bof')
+    ```
+
+Replaying swaps in a transport that answers from the file, at the recorded
+speed, faster, or with no delay at all:
+
+    ```
+    with s.replay('snap01_program.katcp.gz', speed=None):
+        s.program('adc16_test.bof')
+    ```
+
+A strict replay expects exactly the recorded sequence of requests, and raises
+ReplayMismatch on the first difference. With strict=False, changed
+calibration code can be run against recorded data. Writes are always
+accepted, and the adc16_controller state they set up (test pattern, delay
+taps and bitslips) is followed as in snap_sim. Each snapshot read is then
+assembled lane by lane from recorded snapshots taken in the same lane state.
+So a new walk_taps can revisit any tap the recorded sweep covered, including
+the glitches of a flaky board.
+
+Recordings should be replayed under the same major Python version, as that
+decides which strings are bytes.
+"""
+
+import base64
+import gzip
+import json
+import logging
+import sys
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy as np
+from katcp import Message
+
+from .snap_cal import N_LANES
+from .snap_sim import SimAdc16, N_CHIPS
+
+RECORD_VERSION = 2
+CONTROLLER = 'adc16_controller'
+RAM_PREFIX = 'adc16_wb_ram'
+
+# Transport methods that are recorded and replayed
+RECORDED_METHODS = ('read', 'bulkread', 'blindwrite', 'write', 'listdev', 'listbof',
+                    'program', 'deprogram', 'upload_to_ram_and_program', 'katcprequest')
+# Requests that change board state but return nothing of interest
+WRITE_METHODS = ('blindwrite', 'write', 'program', 'deprogram', 'upload_to_ram_and_program')
+
+
+class ReplayMismatch(RuntimeError):
+    """ A request that the recording cannot answer """
+    pass
+
+
+def _encode(obj):
+    """ Convert a value to JSON-able form
+
+    Every JSON object in the result is tagged with its type: base64 encoded
+    bytes, a KATCP reply or inform, or a dict. So a recorded dict can hold
+    any keys without being mistaken for bytes or a message.
+    """
+    if isinstance(obj, bytes):
+        return {'bytes': base64.b64encode(obj).decode('ascii')}
+    if isinstance(obj, Message):
+        inform = getattr(obj, 'mtype', None) == getattr(Message, 'INFORM', '#')
+        return {'message': {'name': obj.name, 'mtype': '#' if inform else '!',
+                            'args': [_encode(a) for a in obj.arguments]}}
+    if isinstance(obj, (list, tuple)):
+        return [_encode(o) for o in obj]
+    if isinstance(obj, dict):
+        return {'dict': dict((str(k), _encode(v)) for k, v in obj.items())}
+    if isinstance(obj, np.integer):
+        return int(obj)
+    return obj
+
+
+def _decode(obj):
+    """ Undo _encode """
+    if isinstance(obj, dict):
+        if len(obj) != 1:
+            raise RuntimeError("Not an encoded value: %r" % obj)
+        tag, value = list(obj.items())[0]
+        if tag == 'bytes':
+            return base64.b64decode(value.encode('ascii'))
+        if tag == 'message':
+            args = [_decode(a) for a in value['args']]
+            if value['mtype'] == '#':
+                return Message.inform(value['name'], *args)
+            return Message.reply(value['name'], *args)
+        if tag == 'dict':
+            return dict((k, _decode(v)) for k, v in value.items())
+        raise RuntimeError("Unknown encoded type %r" % tag)
+    if isinstance(obj, list):
+        return [_decode(o) for o in obj]
+    return obj
+
+
+def _request_key(op, args, kwargs=None):
+    """ Hashable identity of a request, to match replayed requests to recorded ones """
+    if op == 'callback_request':
+        msg = args[0]
+        return json.dumps([op, msg.name, _encode(list(msg.arguments))], sort_keys=True)
+    return json.dumps([op, _encode(list(args)), _encode(kwargs or {})], sort_keys=True)
+
+
+def _controller_words(device, offset, data):
+    """ Return the (word_offset, value) pairs of a write to adc16_controller """
+    if device != CONTROLLER or offset % 4 or len(data) % 4:
+        return []
+    return [(offset // 4 + ii, int(np.frombuffer(data[4 * ii:4 * ii + 4], dtype='>u4')[0]))
+            for ii in range(len(data) // 4)]
+
+
+class ControllerTracker(SimAdc16):
+    """ Follows the adc16_controller state from the writes seen on the wire
+
+    Decodes the SPI stream, delay strobes and bitslips like SimAdc16 does,
+    but a snap request only notes the lane state the snapshot is taken in.
+    Bitslips are tracked modulo 8 and relative to the start of the session.
+    """
+    def __init__(self):
+        SimAdc16.__init__(self, seed=0)
+        self.snap_state = None
+
+    def snapshot(self):
+        self.snap_state = {'patterns': [self.pattern(c) for c in range(N_CHIPS)],
+                           'taps': self.taps.tolist(),
+                           'slips': (self.slips % 8).tolist()}
+        self.n_snapshots += 1
+
+    def feed(self, op, args):
+        """ Update the state from a transport request """
+        if op in ('program', 'deprogram', 'upload_to_ram_and_program'):
+            self.reset()
+            return
+        if op == 'callback_request':
+            msg = args[0]
+            if msg.name != 'write':
+                return
+            device, offset, data = msg.arguments[:3]
+            words = _controller_words(_as_str(device), int(offset), data)
+        elif op in ('blindwrite', 'write'):
+            device, data = args[0], args[1]
+            offset = args[2] if len(args) > 2 else 0
+            words = _controller_words(_as_str(device), int(offset), data)
+        else:
+            return
+        for word_offset, value in words:
+            if word_offset < 4:
+                self.write_word(word_offset, value)
+
+
+def _as_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) and not isinstance(value, str) else value
+
+
+def _ram_read(op, args):
+    """ Return (chip_num, offset, size) if a request reads a snapshot RAM, else None """
+    if op == 'callback_request':
+        msg = args[0]
+        if msg.name != 'read':
+            return None
+        device, offset, size = [_as_str(a) for a in msg.arguments[:3]]
+    elif op in ('read', 'bulkread'):
+        device, size = args[0], args[1]
+        offset = args[2] if len(args) > 2 else 0
+    else:
+        return None
+    if not device.startswith(RAM_PREFIX):
+        return None
+    return int(device[len(RAM_PREFIX):]), int(offset), int(size)
+
+
+class RecordingTransport(object):
+    """ Proxy for a casperfpga transport that records every request to a file
+
+    Args:
+        transport: the transport to wrap (e.g. SnapBoard.transport)
+        filename (str): recording to write, gzipped JSON lines
+        host (str): board name stored in the header
+
+    Notes:
+        Call close() to finish the file. Snapshot reads are stored along with
+        the lane state they were captured in, see ControllerTracker.
+    """
+    def __init__(self, transport, filename, host=None):
+        self._transport = transport
+        self.filename = filename
+        self.n_records = 0
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._tracker = ControllerTracker()
+        self._fh = gzip.open(filename, 'wb')
+        self.t0 = time.time()
+        self._write({'version': RECORD_VERSION, 'host': host, 't0': self.t0,
+                     'python': sys.version_info[0],
+                     'pipelined': hasattr(transport, 'callback_request')})
+
+    def __repr__(self):
+        return "<RecordingTransport: %s (%i records)>" % (self.filename, self.n_records)
+
+    def _write(self, record):
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        with self._lock:
+            if self._fh is not None:
+                self._fh.write(line)
+
+    def _next_seq(self):
+        """ Number requests as they are sent, as pipelined replies are recorded as they arrive """
+        with self._lock:
+            self._seq += 1
+            return self._seq
+
+    def _record(self, seq, op, args, kwargs, t_start, t_stop, result=None, error=None, state=None):
+        record = {'seq': seq, 'op': op, 't': t_start - self.t0, 'dt': t_stop - t_start,
+                  'args': _encode(list(args)), 'kwargs': _encode(kwargs)}
+        if error is not None:
+            record['error'] = error
+        else:
+            record['result'] = _encode(result)
+        if state is not None:
+            record['state'] = state
+        self._write(record)
+        self.n_records += 1
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+    def __getattr__(self, name):
+        attr = getattr(self._transport, name)
+        if name == 'callback_request':
+            return self._recorded_callback_request(attr)
+        if name not in RECORDED_METHODS:
+            return attr
+
+        def _recorded(*args, **kwargs):
+            self._tracker.feed(name, args)
+            state = self._tracker.snap_state if _ram_read(name, args) else None
+            seq = self._next_seq()
+            t0 = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                self._record(seq, name, args, kwargs, t0, time.time(), error=str(e))
+                raise
+            self._record(seq, name, args, kwargs, t0, time.time(), result=result, state=state)
+            return result
+        return _recorded
+
+    def _recorded_callback_request(self, callback_request):
+        def _callback_request(msg, reply_cb=None, inform_cb=None, user_data=None, **kwargs):
+            self._tracker.feed('callback_request', (msg,))
+            state = self._tracker.snap_state if _ram_read('callback_request', (msg,)) else None
+            informs = []
+            seq = self._next_seq()
+            t0 = time.time()
+
+            def _inform_cb(inform, *data):
+                informs.append(inform)
+                if inform_cb is not None:
+                    inform_cb(inform, *data)
+
+            def _reply_cb(reply, *data):
+                self._record(seq, 'callback_request', (msg,), {}, t0, time.time(),
+                             result={'reply': reply, 'informs': informs}, state=state)
+                if reply_cb is not None:
+                    reply_cb(reply, *data)
+
+            return callback_request(msg, reply_cb=_reply_cb, inform_cb=_inform_cb,
+                                    user_data=user_data, **kwargs)
+        return _callback_request
+
+
+def load_recording(filename):
+    """ Read a recording
+
+    Returns:
+        (header, records): the header dict and the list of request records
+    """
+    with gzip.open(filename, 'rb') as fh:
+        lines = [json.loads(line.decode('utf-8')) for line in fh if line.strip()]
+    if not lines or lines[0].get('version') != RECORD_VERSION:
+        raise RuntimeError("%s is not a KATCP recording (version %s)" % (filename, RECORD_VERSION))
+    return lines[0], sorted(lines[1:], key=lambda record: record['seq'])
+
+
+class ReplayTransport(object):
+    """ casperfpga transport that answers requests from a recording
+
+    Args:
+        filename (str): recording made by RecordingTransport
+        speed (float): replay speed relative to the recording, e.g. 1.0 for
+                       the recorded latencies or 10.0 for ten times faster.
+                       None or 0 replies without delay.
+        strict (bool): If True, requests must match the recording one for one.
+                       If False, writes are always accepted and reads are
+                       answered from the recording by request, with snapshot
+                       RAM reads assembled lane by lane (see module notes).
+
+    Notes:
+        Replies to pipelined callback_requests are delivered in order, each
+        no earlier than its recorded latency after it was sent.
+        callback_request is only offered if the recorded transport had it, so
+        a session that fell back to single requests does the same on replay.
+    """
+    def __init__(self, filename, speed=1.0, strict=True):
+        self.filename = filename
+        self.speed = speed
+        self.strict = strict
+        self.logger = logging.getLogger('ReplayTransport')
+        self.header, self.records = load_recording(filename)
+        if self.header.get('python') != sys.version_info[0]:
+            self.logger.warning("%s was recorded under Python %s" % (filename, self.header.get('python')))
+        self.position = 0               # next record, in strict mode
+        self.n_replayed = 0
+        self._lock = threading.Lock()
+        self._tracker = ControllerTracker()
+        self._by_key = {}               # request key: list of records, in order
+        self._key_pos = {}
+        self._lanes = {}                # (chip, lane, pattern, tap, slip): [lane data]
+        self._lane_pos = {}
+        self._latency = {}              # op: recorded latencies
+        for record in self.records:
+            self._index(record)
+        self._replies = queue.Queue()
+        self._last_due = 0.0
+        self._thread = threading.Thread(target=self._deliver_loop, name='ReplayTransport')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __repr__(self):
+        return "<ReplayTransport: %s (%i/%i replayed)>" % (self.filename, self.n_replayed, len(self.records))
+
+    def _index(self, record):
+        op = record['op']
+        args = _decode(record['args'])
+        if op == 'callback_request':
+            args = [Message.request(args[0].name, *args[0].arguments)]
+        record['_args'] = args
+        record['_key'] = _request_key(op, args, _decode(record['kwargs']))
+        self._by_key.setdefault(record['_key'], []).append(record)
+        self._latency.setdefault(op, []).append(record['dt'])
+
+        ram = _ram_read(op, args)
+        state = record.get('state')
+        if ram is None or state is None or 'error' in record:
+            return
+        chip_num, offset, size = ram
+        result = _decode(record['result'])
+        data = result['reply'].arguments[1] if op == 'callback_request' else result
+        if offset or size % N_LANES:
+            return
+        lanes = np.frombuffer(data, dtype='uint8').reshape(-1, N_LANES)
+        for lane in range(N_LANES):
+            key = (chip_num, lane, state['patterns'][chip_num],
+                   state['taps'][chip_num][lane], state['slips'][chip_num][lane])
+            self._lanes.setdefault(key, []).append(lanes[:, lane].copy())
+
+    def close(self):
+        self._replies.put((0.0, None, None))
+
+    def is_connected(self):
+        return True
+
+    def _delay(self, dt):
+        if not self.speed:
+            return 0.0
+        return dt / float(self.speed)
+
+    def _match(self, op, args, kwargs):
+        """ Return the record answering a request, or None to synthesize a reply """
+        key = _request_key(op, args, kwargs)
+        with self._lock:
+            if self.strict:
+                if self.position >= len(self.records):
+                    raise ReplayMismatch("Recording %s ended, but got %s %s" % (self.filename, op, args[:2]))
+                record = self.records[self.position]
+                if record['_key'] != key:
+                    raise ReplayMismatch("Request %i does not match the recording: expected %s %s, got %s %s"
+                                         % (self.position, record['op'], record['_args'][:2], op, args[:2]))
+                self.position += 1
+                return record
+            records = self._by_key.get(key)
+            if not records:
+                return None
+            pos = self._key_pos.get(key, 0)
+            self._key_pos[key] = pos + 1
+            # Once the recorded replies run out, keep repeating the last one
+            return records[min(pos, len(records) - 1)]
+
+    def _ram_data(self, chip_num, size):
+        """ Assemble a snapshot from recorded lanes in the current lane state """
+        state = self._tracker.snap_state
+        if state is None:
+            return None
+        n_rows = size // N_LANES
+        lanes = []
+        for lane in range(N_LANES):
+            key = (chip_num, lane, state['patterns'][chip_num],
+                   state['taps'][chip_num][lane], state['slips'][chip_num][lane])
+            recorded = [d for d in self._lanes.get(key, []) if len(d) >= n_rows]
+            if not recorded:
+                return None
+            pos = self._lane_pos.get(key, 0)
+            self._lane_pos[key] = pos + 1
+            lanes.append(recorded[pos % len(recorded)][:n_rows])
+        return np.stack(lanes, axis=1).tobytes()
+
+    def _answer(self, op, args, kwargs):
+        """ Return (record or None, result) for a request """
+        self._tracker.feed(op, args)
+        record = None
+        if not self.strict:
+            ram = _ram_read(op, args)
+            if ram is not None and ram[1] == 0 and ram[2] % N_LANES == 0:
+                data = self._ram_data(ram[0], ram[2])
+                if data is not None:
+                    self.n_replayed += 1
+                    latency = self._latency.get(op, [0.0])
+                    return {'dt': float(np.median(latency))}, self._ram_result(op, args, data)
+        record = self._match(op, args, kwargs)
+        self.n_replayed += 1
+        if record is None:
+            if op in WRITE_METHODS or (op == 'callback_request' and args[0].name == 'write'):
+                latency = self._latency.get(op, [0.0])
+                result = Message.reply(args[0].name, Message.OK) if op == 'callback_request' else None
+                return {'dt': float(np.median(latency))}, result
+            raise ReplayMismatch("No recorded reply to %s %s" % (op, args[:2]))
+        if 'error' in record:
+            return record, None
+        return record, _decode(record['result'])
+
+    def _ram_result(self, op, args, data):
+        if op == 'callback_request':
+            return Message.reply('read', Message.OK, data)
+        return data
+
+    def __getattr__(self, name):
+        if name == 'callback_request' and self.header.get('pipelined'):
+            return self._callback_request
+        if name not in RECORDED_METHODS:
+            raise AttributeError(name)
+
+        def _replayed(*args, **kwargs):
+            record, result = self._answer(name, args, kwargs)
+            time.sleep(self._delay(record['dt']))
+            if 'error' in record:
+                raise RuntimeError(record['error'])
+            return result
+        return _replayed
+
+    def _callback_request(self, msg, reply_cb=None, inform_cb=None, user_data=None, **kwargs):
+        record, result = self._answer('callback_request', (msg,), {})
+        data = tuple(user_data or ())
+        if 'error' in record:
+            result = {'reply': Message.reply(msg.name, 'fail', record['error']), 'informs': []}
+        elif isinstance(result, Message):
+            result = {'reply': result, 'informs': []}
+        with self._lock:
+            self._last_due = max(time.time() + self._delay(record['dt']), self._last_due)
+            due = self._last_due
+        self._replies.put((due, (reply_cb, inform_cb), (result, data)))
+
+    def _deliver_loop(self):
+        while True:
+            due, callbacks, payload = self._replies.get()
+            if callbacks is None:
+                return
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            reply_cb, inform_cb = callbacks
+            result, data = payload
+            if inform_cb is not None:
+                for inform in result['informs']:
+                    inform_cb(inform, *data)
+            if reply_cb is not None:
+                reply_cb(result['reply'], *data)
@@ -0,0 +1,675 @@
+"""
+# snap_sim.py
+
+A simulated SNAP board, served over KATCP, for developing and benchmarking
+without hardware.
+
+SimSnapServer speaks enough of the tcpborphserver protocol for SnapBoard
+(via casperfpga), FpgaClient and AsyncKatcpClient: listdev, listbof, progdev,
+progremote, read, bulkread, write, status and watchdog. Behind it, SimAdc16 models the
+adc16_controller and the three HMCAD1511 chips:
+
+    * The bit-banged 3-wire SPI stream in word 0 is decoded into the
+      register state of each chip.
+    * The snap request, bitslip and delay strobe bits of words 1-3 act on
+      the snapshot RAMs and on the individual lanes.
+    * adc16_wb_ram0..2 hold ramp, deskew, sync, custom or noise data, as
+      selected by the chip registers. Each lane has a random line phase, so
+      it reads garbage at the edge of its eye and rotated bits until it has
+      been bitslipped into frame, and SnapAdc.calibrate has real work to do.
+
+A LatencyModel delays every reply to mimic a board on the network:
+
+    ```
+    server = SimSnapServer(port=7147, latency=LatencyModel(rtt=0.5e-3))
+    server.start()
+    s = SnapBoard('localhost')
+    s.program('adc16_test.bof')
+    print(server.request_counts)
+    ```
+
+or from the command line, `snap_sim -n 4 --rtt 0.5` serves four boards on
+127.0.0.1-4, and `snap_sim --benchmark` times programming, calibration and
+snapshots against a simulated board.
+"""
+
+from __future__ import print_function
+
+import collections
+import hashlib
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy as np
+
+from .katcp_codec import format_message, parse_message
+from .snap_adc import AdcRegisterFile, generate_adc_map
+from .snap_cal import N_LANES, DESKEW_VAL, SYNC_VAL
+
+N_CHIPS = 3
+SNAP_REQ = 0x00010000
+ADC16_RESET = 0x00100000
+SCLK = 0x200
+SDA_SHIFT = 8
+
+
+def rotl8(data, n):
+    """ Rotate the bits of uint8 data left by n (array, broadcast against data) """
+    data = np.asarray(data, dtype='uint16')
+    n = np.asarray(n) % 8
+    return (((data << n) | (data >> (8 - n))) & 0xff).astype('uint8')
+
+
+class SimAdc16(object):
+    """ Model of the adc16_controller and the three HMCAD1511 chips behind it
+
+    Args:
+        seed (int): seed for the lane phases and the sample data
+        eye_period (int): delay taps per bit period of a lane
+        eye_edge (int): taps either side of a bit transition that read garbage
+        noise_rms (float): RMS, in ADC counts, of the sampled noise
+        ram_size (int): bytes per adc16_wb_ram snapshot
+
+    Notes:
+        Lane k of a chip carries bytes k, k+8, k+16 ... of the snapshot, as
+        in demux 4 (see snap_cal). The tap set on a lane picks where in the
+        bit period it samples: within eye_edge taps of a transition the lane
+        reads random bytes. The bit rotation of a lane advances by one for
+        each bit period of delay and for each bitslip, and data is only in
+        frame when the total rotation is a multiple of 8.
+    """
+    def __init__(self, seed=1, eye_period=13, eye_edge=2, noise_rms=20.0, ram_size=1024):
+        rng = random.Random(seed)
+        self.eye_period = eye_period
+        self.eye_edge = eye_edge
+        self.noise_rms = noise_rms
+        self.ram_size = ram_size
+        self.random = np.random.RandomState(seed)
+        # Line phase of each lane, in taps, and the bit rotation of its frame
+        self.phase = np.array([[rng.randint(0, 2 * eye_period) for lane in range(N_LANES)]
+                               for chip_num in range(N_CHIPS)])
+        self.frame = np.array([[2 * rng.randint(0, 3) for lane in range(N_LANES)]
+                               for chip_num in range(N_CHIPS)])
+        self.adc_map = generate_adc_map()
+        self.registers = [AdcRegisterFile(self.adc_map) for chip_num in range(N_CHIPS)]
+        self.lock = threading.RLock()
+        self.reset()
+
+    def __repr__(self):
+        return "<SimAdc16: %i snapshots, %i SPI writes>" % (self.n_snapshots, self.n_spi_writes)
+
+    def reset(self):
+        """ Return to the state after the FPGA has been programmed """
+        with self.lock:
+            self.words = [0] * 4
+            self.fpga_demux = 1
+            self.taps = np.zeros((N_CHIPS, N_LANES), dtype='int32')
+            self.slips = np.zeros((N_CHIPS, N_LANES), dtype='int32')
+            self.rams = [bytes(bytearray(self.ram_size))] * N_CHIPS
+            for regfile in self.registers:
+                regfile.reset()
+            self._spi_bits = []
+            self._spi_cs = 0
+            self.n_snapshots = 0
+            self.n_spi_writes = 0
+
+    def field(self, chip_num, name):
+        """ Return the value of a named HMCAD1511 register field of a chip """
+        r = self.adc_map[name]
+        return (self.registers[chip_num].words.get(r.addr, 0) >> r.offset) & (2**r.width - 1)
+
+    def pattern(self, chip_num):
+        """ Return the data source selected on a chip: ramp, deskew, sync, custom1, dual or noise """
+        test_pat = self.field(chip_num, 'en_ramp')
+        if test_pat & 0b100:
+            return 'ramp'
+        if test_pat & 0b010:
+            return 'dual'
+        if test_pat & 0b001:
+            return 'custom1'
+        pat = self.field(chip_num, 'pat_deskew')
+        if pat == 0b01:
+            return 'deskew'
+        if pat == 0b10:
+            return 'sync'
+        return 'noise'
+
+    def read_word(self, word_offset):
+        """ Read a controller word; word 0 returns the clock locked status """
+        if word_offset == 0:
+            return (0b11 << 24) | (N_CHIPS << 20) | (self.words[0] & 0x3ff)
+        return self.words[word_offset]
+
+    def write_word(self, word_offset, value):
+        """ Write a controller word, acting on the bits that changed """
+        with self.lock:
+            old = self.words[word_offset]
+            self.words[word_offset] = value
+            rise = value & ~old
+            if word_offset == 0:
+                self._spi(value, rise)
+            elif word_offset == 1:
+                if value & (1 << 26):
+                    self.fpga_demux = 1 << ((value >> 24) & 0b11)
+                if rise & ADC16_RESET:
+                    self.taps[:] = 0
+                    self.slips[:] = 0
+                if rise & SNAP_REQ:
+                    self.snapshot()
+                channel = (value >> 5) & 0x7
+                for chip_num in range(N_CHIPS):
+                    if (rise >> (8 + chip_num)) & 1:
+                        self.slips[chip_num, channel] += 1
+            elif word_offset in (2, 3):
+                tap = self.words[1] & 0x1f
+                for chip_num in range(N_CHIPS):
+                    for chan in range(4):
+                        if (rise >> (chip_num * 4 + chan)) & 1:
+                            self.taps[chip_num, 2 * chan + word_offset - 2] = tap
+
+    def _spi(self, value, rise):
+        """ Clock the 3-wire interface: SDA is sampled on SCLK rising edges
+        while a chip select is high, and a 24-bit word ends with all chip
+        selects low. """
+        chip_select = value & 0xff
+        if chip_select:
+            self._spi_cs = chip_select
+            if rise & SCLK:
+                self._spi_bits.append((value >> SDA_SHIFT) & 1)
+            return
+        if len(self._spi_bits) == 24:
+            word = 0
+            for bit in self._spi_bits:
+                word = (word << 1) | bit
+            self.n_spi_writes += 1
+            for chip_num in range(N_CHIPS):
+                if (self._spi_cs >> chip_num) & 1:
+                    self.registers[chip_num].update(word >> 16, word & 0xffff)
+        self._spi_bits = []
+        self._spi_cs = 0
+
+    def lane_errors(self, chip_num):
+        """ Return (bad, rotation) per lane: lanes sampling at the edge of the
+        eye, and the bit rotation of each lane's data """
+        delay = self.taps[chip_num] + self.phase[chip_num]
+        periods, frac = np.divmod(delay, self.eye_period)
+        bad = (frac < self.eye_edge) | (frac >= self.eye_period - self.eye_edge)
+        return bad, (periods + self.slips[chip_num] + self.frame[chip_num]) % 8
+
+    def _samples(self, chip_num):
+        """ The bytes a chip sends before they pass through the SERDES """
+        pattern = self.pattern(chip_num)
+        n = self.ram_size
+        if pattern == 'ramp':
+            return (np.arange(n) & 0xff).astype('uint8')
+        if pattern == 'custom1':
+            return np.full(n, self.field(chip_num, 'bits_custom1'), dtype='uint8')
+        if pattern == 'dual':
+            data = np.full(n, self.field(chip_num, 'bits_custom1'), dtype='uint8')
+            data[1::2] = self.field(chip_num, 'bits_custom2')
+            return data
+        if pattern == 'sync':
+            return np.full(n, SYNC_VAL, dtype='uint8')
+        if pattern == 'deskew':
+            return np.full(n, DESKEW_VAL, dtype='uint8')
+        if self.field(chip_num, 'pd') or self.field(chip_num, 'sleep'):
+            return np.zeros(n, dtype='uint8')
+        noise = np.round(self.random.normal(0, self.noise_rms, n))
+        return np.clip(noise, -128, 127).astype('int8').view('uint8')
+
+    def snapshot(self):
+        """ Capture new data into all snapshot RAMs """
+        rams = []
+        for chip_num in range(N_CHIPS):
+            data = self._samples(chip_num).reshape(-1, N_LANES)
+            bad, rotation = self.lane_errors(chip_num)
+            if self.pattern(chip_num) == 'deskew':
+                # Alternating bits only show the parity of the rotation
+                data = np.where(rotation % 2, rotl8(DESKEW_VAL, 1), DESKEW_VAL).astype('uint8')
+                data = np.tile(data, (self.ram_size // N_LANES, 1))
+            else:
+                data = rotl8(data, rotation)
+            garbage = self.random.randint(0, 256, data.shape).astype('uint8')
+            data = np.where(bad, garbage, data)
+            rams.append(data.tobytes())
+        self.rams = rams
+        self.n_snapshots += 1
+
+
+class SimSnapBoard(object):
+    """ Register space of a simulated SNAP board
+
+    Args:
+        adc (SimAdc16): ADC model, created with the given seed if None
+        boffiles (list): bitstreams that listbof reports and progdev accepts
+        fpga_clock (float): FPGA clock in Hz, as counted by sys_clkcounter
+        devices (dict): extra device name: size in bytes, plain memory
+        seed (int): seed for a default ADC model
+    """
+    def __init__(self, adc=None, boffiles=('adc16_test.bof',), fpga_clock=250e6,
+                 devices=None, seed=1):
+        self.adc = adc if adc is not None else SimAdc16(seed)
+        self.boffiles = list(boffiles)
+        self.fpga_clock = fpga_clock
+        self.extra_devices = dict(devices or {})
+        self.programmed = None
+        self.t_programmed = time.time()
+        self.memory = {}
+
+    def __repr__(self):
+        return "<SimSnapBoard: %s>" % (self.programmed or 'not programmed')
+
+    @property
+    def devices(self):
+        """ Device name: size in bytes, of the programmed design """
+        if self.programmed is None:
+            return {}
+        devices = {'adc16_controller': 16, 'sys_clkcounter': 4}
+        for chip_num in range(N_CHIPS):
+            devices['adc16_wb_ram%i' % chip_num] = self.adc.ram_size
+        devices.update(self.extra_devices)
+        return devices
+
+    def program(self, boffile=None):
+        """ Program (or with None, deprogram) the FPGA """
+        if boffile is not None and boffile not in self.boffiles:
+            raise RuntimeError("No such bitstream: %s" % boffile)
+        self.programmed = boffile
+        self.t_programmed = time.time()
+        self.memory = dict((name, bytearray(size)) for name, size in self.extra_devices.items())
+        self.adc.reset()
+
+    def program_image(self, image):
+        """ Program the FPGA with an uploaded bitstream (the bytes are not checked) """
+        self.program(None)
+        self.programmed = 'upload-%s' % hashlib.sha1(image).hexdigest()[:8]
+
+    def _check_range(self, device, offset, size):
+        devices = self.devices
+        if device not in devices:
+            raise RuntimeError("Unknown device %s" % device)
+        if offset < 0 or size < 0 or offset + size > devices[device]:
+            raise RuntimeError("Access to %s at %i+%i is out of range" % (device, offset, size))
+
+    def read(self, device, offset, size):
+        """ Read size bytes from a device """
+        self._check_range(device, offset, size)
+        if device == 'sys_clkcounter':
+            count = int((time.time() - self.t_programmed) * self.fpga_clock) & 0xffffffff
+            data = struct.pack('>I', count)
+        elif device == 'adc16_controller':
+            data = b''.join(struct.pack('>I', self.adc.read_word(ii)) for ii in range(4))
+        elif device.startswith('adc16_wb_ram'):
+            data = self.adc.rams[int(device[len('adc16_wb_ram'):])]
+        else:
+            data = bytes(self.memory[device])
+        return data[offset:offset + size]
+
+    def write(self, device, offset, data):
+        """ Write bytes to a device; the controller takes whole words """
+        self._check_range(device, offset, len(data))
+        if device == 'adc16_controller':
+            if offset % 4 or len(data) % 4:
+                raise RuntimeError("adc16_controller writes must be word aligned")
+            for ii in range(len(data) // 4):
+                value, = struct.unpack('>I', data[4 * ii:4 * ii + 4])
+                self.adc.write_word(offset // 4 + ii, value)
+        elif device in self.memory:
+            self.memory[device][offset:offset + len(data)] = data
+        else:
+            raise RuntimeError("Device %s is read-only" % device)
+
+
+class LatencyModel(object):
+    """ When the reply to a request reaches the client
+
+    Args:
+        rtt (float): network round trip time, in seconds
+        service_time (float): seconds the board spends on each request.
+                              Requests from all connections are served one
+                              at a time, like tcpborphserver does.
+        bandwidth (float): bytes/s for request and reply payloads, None for
+                           unlimited
+        jitter (float): standard deviation, in seconds, of gaussian jitter
+                        added to the round trip
+
+    Notes:
+        Replies are delayed, not the server: a client that pipelines its
+        requests pays the round trip once, as it would on a real network.
+    """
+    def __init__(self, rtt=0.0, service_time=0.0, bandwidth=None, jitter=0.0):
+        self.rtt = rtt
+        self.service_time = service_time
+        self.bandwidth = bandwidth
+        self.jitter = jitter
+
+    def __repr__(self):
+        return "<LatencyModel: rtt %2.3f ms, service %2.3f ms>" % (self.rtt * 1e3, self.service_time * 1e3)
+
+    def service(self, n_bytes):
+        """ Time the board is busy with a request carrying n_bytes of payload """
+        t = self.service_time
+        if self.bandwidth:
+            t += float(n_bytes) / self.bandwidth
+        return t
+
+    def network(self):
+        """ One-way network delay """
+        delay = self.rtt / 2.0
+        if self.jitter:
+            delay += abs(random.gauss(0, self.jitter)) / 2.0
+        return delay
+
+
+class _KatcpHandler(socketserver.StreamRequestHandler):
+    """ One client connection: requests are read and answered in order, and
+    each reply is held back until the latency model says it has arrived """
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self._replies = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='SimSnapWriter')
+        self._writer.daemon = True
+        self._writer.start()
+        self._last_due = 0.0
+        for key, value in (('katcp-protocol', '5.0-MI'),
+                           ('katcp-library', 'snap_sim'),
+                           ('katcp-device', 'snap_sim')):
+            self._replies.put((0.0, format_message('#', 'version-connect', (key, value))))
+
+    def _write_loop(self):
+        while True:
+            due, data = self._replies.get()
+            if data is None:
+                return
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except (IOError, OSError):
+                return
+
+    def handle(self):
+        server = self.server
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            t_sent = time.time()
+            try:
+                msg = parse_message(line)
+            except RuntimeError as e:
+                server.logger.warning(str(e))
+                continue
+            if msg is None or msg[0] != '?':
+                continue
+            mtype, name, mid, args = msg
+            informs, reply = server.handle_request(name, args)
+
+            lines = [format_message('#', name, inform, mid) for inform in informs]
+            lines.append(format_message('!', name, reply, mid))
+            data = b''.join(lines)
+            due = server.schedule(t_sent, len(line) + len(data))
+            self._last_due = max(due, self._last_due)
+            self._replies.put((self._last_due, data))
+
+    def finish(self):
+        self._replies.put((0.0, None))
+        self._writer.join(1.0)
+        socketserver.StreamRequestHandler.finish(self)
+
+
+class SimSnapServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """ KATCP server for a simulated SNAP board
+
+    Args:
+        board (SimSnapBoard): the simulated board, a default one if None
+        host (str): address to listen on
+        port (int): port to listen on, 0 for any free port
+        latency (LatencyModel): reply timing, default no delay
+
+    Notes:
+        request_counts counts the requests served, by name.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, board=None, host='127.0.0.1', port=7147, latency=None):
+        self.board = board if board is not None else SimSnapBoard()
+        self.latency = latency if latency is not None else LatencyModel()
+        self.request_counts = collections.Counter()
+        self.logger = logging.getLogger('SimSnapServer')
+        self._lock = threading.Lock()
+        self._busy_until = 0.0
+        self._thread = None
+        socketserver.TCPServer.__init__(self, (host, port), _KatcpHandler)
+
+    def __repr__(self):
+        return "<SimSnapServer %s:%i %s>" % (self.host, self.port, self.board)
+
+    @property
+    def host(self):
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """ Serve in a background thread """
+        self._thread = threading.Thread(target=self.serve_forever, name='SimSnapServer')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop serving and close the listening socket """
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+    def schedule(self, t_sent, n_bytes):
+        """ Return when the reply to a request sent at t_sent reaches the client """
+        latency = self.latency
+        with self._lock:
+            start = max(t_sent + latency.network(), self._busy_until)
+            self._busy_until = start + latency.service(n_bytes)
+            return self._busy_until + latency.network()
+
+    def handle_request(self, name, args):
+        """ Serve one request
+
+        Returns:
+            (informs, reply): lists of arguments of the informs and the reply
+        """
+        with self._lock:
+            self.request_counts[name] += 1
+        handler = getattr(self, '_request_' + name.replace('-', '_'), None)
+        if handler is None:
+            return [], ['invalid', 'unknown request %s' % name]
+        try:
+            with self.board.adc.lock:
+                return handler(*args)
+        except (RuntimeError, TypeError, ValueError) as e:
+            return [], ['fail', str(e)]
+
+    def _request_watchdog(self):
+        return [], ['ok']
+
+    def _request_status(self):
+        if self.board.programmed is None:
+            return [], ['fail', 'FPGA not programmed']
+        return [], ['ok', 'FPGA programmed']
+
+    def _request_listdev(self, *args):
+        names = sorted(self.board.devices)
+        return [[n] for n in names], ['ok', len(names)]
+
+    def _request_listbof(self):
+        return [[b] for b in self.board.boffiles], ['ok', len(self.board.boffiles)]
+
+    def _request_progdev(self, boffile=None):
+        if boffile is not None:
+            boffile = boffile.decode('utf-8')
+        self.board.program(boffile)
+        return [], ['ok']
+
+    def _request_progremote(self, port, timeout=10.0):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            listener.bind((self.host, int(port)))
+            listener.listen(1)
+            listener.settimeout(float(timeout))
+            conn, addr = listener.accept()
+        except socket.error as e:
+            raise RuntimeError("progremote on port %s: %s" % (port, e))
+        finally:
+            listener.close()
+        chunks = []
+        try:
+            conn.settimeout(float(timeout))
+            chunk = conn.recv(2**16)
+            while chunk:
+                chunks.append(chunk)
+                chunk = conn.recv(2**16)
+        except socket.error as e:
+            raise RuntimeError("progremote upload: %s" % e)
+        finally:
+            conn.close()
+        self.board.program_image(b''.join(chunks))
+        return [], ['ok']
+
+    def _request_read(self, device, offset, size):
+        return [], ['ok', self.board.read(device.decode('utf-8'), int(offset), int(size))]
+
+    def _request_bulkread(self, device, offset, size, chunk_size=1024):
+        data = self.board.read(device.decode('utf-8'), int(offset), int(size))
+        informs = [[data[ii:ii + chunk_size]] for ii in range(0, len(data), chunk_size)]
+        return informs, ['ok', len(data)]
+
+    def _request_write(self, device, offset, data):
+        self.board.write(device.decode('utf-8'), int(offset), data)
+        return [], ['ok']
+
+
+def start_servers(n_boards, host_fmt='127.0.0.%i', port=7147, latency=None, seed=0):
+    """ Start simulated boards on consecutive loopback addresses
+
+    Args:
+        n_boards (int): number of boards
+        host_fmt (str): address of board ii (counting from 1), e.g. the
+                        default 127.0.0.1, 127.0.0.2 ... which all reach
+                        the loopback interface on Linux
+        port (int): KATCP port of every board
+        latency (LatencyModel): shared by all boards
+        seed (int): seed of the first board's lanes; board ii gets seed + ii
+
+    Returns:
+        servers (list): running SimSnapServers
+    """
+    servers = []
+    for ii in range(n_boards):
+        board = SimSnapBoard(seed=seed + ii)
+        servers.append(SimSnapServer(board, host_fmt % (ii + 1), port, latency).start())
+    return servers
+
+
+def benchmark(host='127.0.0.1', port=7147, boffile='adc16_test.bof', n_snapshots=32,
+              demux_mode=1, gain=1):
+    """ Time programming, ADC setup and snapshots on one board
+
+    Returns:
+        timings (dict): seconds taken by program (progdev, initialize and
+                        calibrate), initialize, calibrate and snapshot (one
+                        grab_adc_snapshot, averaged over n_snapshots)
+    """
+    from .snap_board import SnapBoard
+
+    s = SnapBoard(host, katcp_port=port)
+    timings = {}
+    t0 = time.time()
+    s.program(boffile, gain=gain, demux_mode=demux_mode)
+    timings['program'] = time.time() - t0
+
+    t0 = time.time()
+    s.adc.initialize(demux_mode=demux_mode, gain=gain)
+    timings['initialize'] = time.time() - t0
+
+    t0 = time.time()
+    s.adc.calibrate()
+    timings['calibrate'] = time.time() - t0
+
+    t0 = time.time()
+    for ii in range(n_snapshots):
+        s.adc.grab_adc_snapshot()
+    timings['snapshot'] = (time.time() - t0) / n_snapshots
+    return timings
+
+
+def cmd_tool(args=None):
+    from argparse import ArgumentParser
+    p = ArgumentParser(description='snap_sim [OPTIONS]')
+    p.add_argument('-n', '--n_boards', dest='n_boards', type=int, default=1,
+                   help='Number of boards to simulate, on 127.0.0.1, 127.0.0.2 ... (default 1)')
+    p.add_argument('-k', '--katcp_port', dest='katcp_port', type=int, default=7147,
+                   help='KATCP port to serve on (default 7147)')
+    p.add_argument('-r', '--rtt', dest='rtt', type=float, default=0.0,
+                   help='Network round trip time, in ms (default 0)')
+    p.add_argument('-t', '--service_time', dest='service_time', type=float, default=0.0,
+                   help='Board time per request, in ms (default 0)')
+    p.add_argument('-j', '--jitter', dest='jitter', type=float, default=0.0,
+                   help='RMS jitter of the round trip, in ms (default 0)')
+    p.add_argument('-w', '--bandwidth', dest='bandwidth', type=float, default=None,
+                   help='Payload bandwidth, in MB/s (default unlimited)')
+    p.add_argument('-s', '--seed', dest='seed', type=int, default=0,
+                   help='Seed for the simulated lane phases (default 0)')
+    p.add_argument('-b', '--benchmark', action='store_true', default=False,
+                   help='Time program, initialize, calibrate and snapshots on the first board, then exit.')
+    args = p.parse_args(args)
+
+    logging.basicConfig(level=logging.WARNING)
+    latency = LatencyModel(rtt=args.rtt * 1e-3, service_time=args.service_time * 1e-3,
+                           bandwidth=args.bandwidth * 1e6 if args.bandwidth else None,
+                           jitter=args.jitter * 1e-3)
+    servers = start_servers(args.n_boards, port=args.katcp_port, latency=latency, seed=args.seed)
+    for server in servers:
+        print("Serving %s" % server)
+
+    try:
+        if args.benchmark:
+            timings = benchmark(servers[0].host, servers[0].port)
+            for key in ('program', 'initialize', 'calibrate', 'snapshot'):
+                print("%-12s %8.3f s" % (key, timings[key]))
+            counts = servers[0].request_counts
+            print("Requests: %s" % ', '.join('%s %i' % kv for kv in sorted(counts.items())))
+        else:
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.stop()
+
+
+if __name__ == '__main__':
+    cmd_tool()
@@ -0,0 +1,175 @@
+"""
+# snap_spec.py
+
+Accumulating spectrometer for ADC snapshots.
+
+Snapshots are demuxed into their ADC inputs, windowed, and Fourier
+transformed in one batched rfft across all chips and inputs. The power
+spectra are folded into a float32 running average, so raw snapshots do not
+need to be kept:
+
+    ```
+    spec = Spectrometer(demux_mode=1)
+    spec.integrate(s.adc, n_snapshots=1024)
+    spec.spectrum            # shape (n_chips, 4, 129) for demux 1
+    ```
+"""
+
+import numpy as np
+
+from .snap_plot import demux_data
+
+N_INPUTS = {1: 4, 2: 2, 4: 1}
+
+
+def demux_inputs(snapshots, demux):
+    """ Demux snapshots into an array of inputs
+
+    Args:
+        snapshots (np.array): shape (..., n_samples)
+        demux (int): ADC demux mode, 1, 2 or 4
+
+    Returns:
+        data (np.array): shape (..., n_inputs, n_samples // n_inputs), inputs
+        ordered as returned by demux_data
+    """
+    inputs = demux_data(snapshots, demux)
+    if demux == 4:
+        inputs = (inputs,)
+    return np.stack(inputs, axis=-2)
+
+
+class Spectrometer(object):
+    """ Running average of windowed power spectra of ADC inputs
+
+    Args:
+        demux_mode (int): ADC demux mode, 1, 2 or 4
+        n_fft (int): FFT length. Defaults to the whole demuxed snapshot; if
+                     shorter, each snapshot is split into n_fft segments.
+        window (str): numpy window function name ('hanning', 'hamming',
+                      'blackman', 'bartlett'), or None for no window
+        n_integrations (int): Number of snapshots per integration. When an
+                              integration completes, the spectrum is copied to
+                              last_spectrum and accumulation starts again.
+                              A batch that straddles the end of an
+                              integration is split, so every integration
+                              holds exactly n_integrations snapshots.
+                              Default None: accumulate until reset().
+    """
+    def __init__(self, demux_mode=1, n_fft=None, window='hanning', n_integrations=None):
+        if demux_mode not in N_INPUTS:
+            raise RuntimeError("Weird demux factor, use 1, 2 or 4.")
+        self.demux_mode = demux_mode
+        self.n_fft = n_fft
+        self.window_name = window
+        self.n_integrations = n_integrations
+        self._window = None
+        self.spectrum = None
+        self.last_spectrum = None
+        self.count = 0
+        self._n_fft_used = n_fft
+
+    def __repr__(self):
+        return "<Spectrometer: demux %i, %i snapshots integrated>" % (self.demux_mode, self.count)
+
+    def reset(self):
+        """ Discard the running average """
+        self.spectrum = None
+        self.count = 0
+
+    def _get_window(self, n_fft):
+        if self._window is None or len(self._window) != n_fft:
+            if self.window_name is None:
+                self._window = np.ones(n_fft, dtype='float32')
+            else:
+                self._window = getattr(np, self.window_name)(n_fft).astype('float32')
+        return self._window
+
+    def power(self, snapshots):
+        """ Return the mean power spectrum of a batch of snapshots
+
+        Args:
+            snapshots (np.array): shape (..., n_chips, n_samples), e.g. one
+                                  capture (n_chips, n_samples) or a batch from
+                                  SnapAdc.stream (batch, n_chips, n_samples)
+
+        Returns:
+            (power, n): float32 power of shape (n_chips, n_inputs, n_fft // 2 + 1),
+            averaged over the n snapshots in the batch
+        """
+        snapshots = np.asarray(snapshots)
+        n_chips, n_samples = snapshots.shape[-2:]
+        snapshots = snapshots.reshape(-1, n_chips, n_samples)
+        n = snapshots.shape[0]
+
+        data = demux_inputs(snapshots, self.demux_mode)
+        n_per_input = data.shape[-1]
+        n_fft = self.n_fft or n_per_input
+        self._n_fft_used = n_fft
+        n_seg = n_per_input // n_fft
+        if n_seg == 0:
+            raise RuntimeError("n_fft (%i) is longer than the demuxed snapshot (%i)" % (n_fft, n_per_input))
+        # (batch, chips, inputs, segments, n_fft)
+        data = data[..., :n_seg * n_fft].reshape(data.shape[:-1] + (n_seg, n_fft))
+
+        spec = np.fft.rfft(data * self._get_window(n_fft), axis=-1)
+        power = spec.real ** 2 + spec.imag ** 2
+        return power.mean(axis=(0, 3)).astype('float32'), n
+
+    def _accumulate(self, snapshots):
+        power, n = self.power(snapshots)
+        if self.spectrum is None:
+            self.spectrum = power
+            self.count = n
+        else:
+            self.count += n
+            self.spectrum += (power - self.spectrum) * np.float32(float(n) / self.count)
+
+    def add(self, snapshots):
+        """ Add a batch of snapshots to the running average
+
+        Returns:
+            True if this completed an integration of n_integrations snapshots
+        """
+        snapshots = np.asarray(snapshots)
+        snapshots = snapshots.reshape((-1,) + snapshots.shape[-2:])
+        completed = False
+        while self.n_integrations is not None and self.count + len(snapshots) >= self.n_integrations:
+            n_first = self.n_integrations - self.count
+            self._accumulate(snapshots[:n_first])
+            self.last_spectrum = self.spectrum
+            self.reset()
+            snapshots = snapshots[n_first:]
+            completed = True
+        if len(snapshots):
+            self._accumulate(snapshots)
+        return completed
+
+    def integrate(self, adc, n_snapshots, batch_size=16, chip_nums=None):
+        """ Capture and integrate n_snapshots snapshots from an ADC
+
+        Captures are streamed (see SnapAdc.stream), so the FFTs of one batch
+        run while the next batch is captured. If batch_size does not divide
+        n_snapshots, the surplus of the last batch is discarded.
+
+        Returns:
+            spectrum (np.array): the running average after integrating
+        """
+        batch_size = min(batch_size, n_snapshots)
+        n_batches = -(-n_snapshots // batch_size)
+        with adc.stream(chip_nums=chip_nums, batch_size=batch_size, max_batches=n_batches) as stream:
+            remaining = n_snapshots
+            for timestamps, data in stream:
+                self.add(data[:remaining])
+                remaining -= len(data)
+        return self.spectrum if self.spectrum is not None else self.last_spectrum
+
+    def frequencies(self, sample_rate):
+        """ Return the frequency of each channel
+
+        Args:
+            sample_rate (float): sample rate of each input (e.g. in MHz)
+        """
+        if self._n_fft_used is None:
+            raise RuntimeError("n_fft unknown until a snapshot has been added")
+        return np.fft.rfftfreq(self._n_fft_used, 1.0 / sample_rate)
@@ -0,0 +1,206 @@
+"""
+# snap_stream.py
+
+Continuous ADC snapshot capture with background prefetch.
+
+A CaptureStream triggers and reads snapshots on a background thread while
+the consumer works on the previous batch. Batches are handed over through a
+bounded queue, which provides backpressure:
+
+    ```
+    with s.adc.stream(batch_size=16) as stream:
+        for timestamps, data in stream:
+            process(data)          # data.shape = (16, n_chips, 1024)
+            if done:
+                break
+    print(stream.stats())
+    ```
+
+The SnapAdc must not be used for anything else while it is streaming.
+"""
+
+import logging
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy as np
+
+_END = object()
+
+
+class CaptureStream(object):
+    """ Iterable of (timestamps, data) snapshot batches, captured in the background
+
+    Args:
+        adc (SnapAdc): ADC controller to capture from
+        chip_nums (list): chip numbers to capture, defaults to all enabled chips
+        n_samples (int): samples (bytes) per chip per snapshot
+        batch_size (int): snapshots per batch
+        queue_size (int): max. batches waiting for the consumer (2: double buffered)
+        drop (bool): If True, the capture thread never waits for the consumer:
+                     when the queue is full the oldest batch is dropped (and
+                     counted) to make room. If False (default), capture pauses
+                     until the consumer catches up.
+        max_batches (int): stop after this many batches, default run until stop()
+
+    Notes:
+        timestamps is a float64 array of shape (batch_size,), the time each
+        snapshot was triggered; data is an int8 array of shape
+        (batch_size, n_chips, n_samples).
+    """
+    def __init__(self, adc, chip_nums=None, n_samples=1024, batch_size=1,
+                 queue_size=2, drop=False, max_batches=None):
+        self.adc = adc
+        if chip_nums is None:
+            chip_nums = sorted(adc.chips.values())
+        self.chip_nums = list(chip_nums)
+        self.n_samples = n_samples
+        self.batch_size = batch_size
+        self.drop = drop
+        self.max_batches = max_batches
+        self.logger = logging.getLogger('CaptureStream')
+
+        self.queue = queue.Queue(queue_size)
+        self.captured = 0       # snapshots captured
+        self.delivered = 0      # snapshots handed to the consumer
+        self.dropped = 0        # snapshots dropped because the consumer fell behind
+        self.t_start = None
+        self.t_stop = None
+        self._error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='CaptureStream')
+        self._thread.daemon = True
+
+    def __repr__(self):
+        return "<CaptureStream: %i captured, %i dropped, %2.1f snapshots/s>" % (
+            self.captured, self.dropped, self.snapshots_per_second)
+
+    def start(self):
+        """ Start the capture thread """
+        self.t_start = time.time()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop capturing and wait for the capture thread to finish
+
+        Batches not yet consumed are dropped. A consumer iterating in another
+        thread gets the end marker and stops.
+        """
+        self._stop.set()
+        while self._thread.is_alive():
+            self._drain()
+            self._thread.join(0.01)
+        self._drain()
+        self._put_end()
+        if self.t_stop is None:
+            self.t_stop = time.time()
+        self.logger.info(str(self))
+
+    def _drain(self):
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _put(self, item):
+        """ Hand an item to the consumer, waiting for room unless stopped """
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _put_end(self):
+        """ Hand the end marker to the consumer, dropping batches to make room if need be """
+        while True:
+            try:
+                self.queue.put_nowait(_END)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _capture_batch(self):
+        timestamps = np.empty(self.batch_size, dtype='float64')
+        data = np.empty((self.batch_size, len(self.chip_nums), self.n_samples), dtype='int8')
+        for ii in range(self.batch_size):
+            timestamps[ii] = time.time()
+            data[ii] = self.adc.capture(self.chip_nums, self.n_samples)
+        return timestamps, data
+
+    def _run(self):
+        n_batches = 0
+        try:
+            while not self._stop.is_set():
+                if self.max_batches is not None and n_batches >= self.max_batches:
+                    break
+                batch = self._capture_batch()
+                n_batches += 1
+                self.captured += self.batch_size
+                if not self.drop:
+                    if not self._put(batch):
+                        break
+                    continue
+                while True:
+                    try:
+                        self.queue.put_nowait(batch)
+                        break
+                    except queue.Full:
+                        try:
+                            self.queue.get_nowait()
+                            self.dropped += self.batch_size
+                        except queue.Empty:
+                            pass
+        except Exception as e:
+            self.logger.error("Capture failed: %s" % e)
+            self._error = e
+        finally:
+            self.t_stop = time.time()
+            if not self._put(_END):
+                self._put_end()
+
+    def __iter__(self):
+        if self.t_start is None:
+            self.start()
+        while True:
+            item = self.queue.get()
+            if item is _END:
+                if self._error is not None:
+                    raise self._error
+                return
+            self.delivered += len(item[0])
+            yield item
+
+    def __enter__(self):
+        if self.t_start is None:
+            self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def snapshots_per_second(self):
+        """ Achieved capture rate """
+        if self.t_start is None:
+            return 0.0
+        elapsed = (self.t_stop or time.time()) - self.t_start
+        return self.captured / elapsed if elapsed > 0 else 0.0
+
+    def stats(self):
+        """ Return a dict of capture statistics """
+        return {'captured': self.captured,
+                'delivered': self.delivered,
+                'dropped': self.dropped,
+                'snapshots_per_second': self.snapshots_per_second}
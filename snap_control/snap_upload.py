@@ -0,0 +1,244 @@
+"""
+# snap_upload.py
+
+Streaming of bitstream files to a board's upload port.
+
+Files are sent in chunks straight from disk (with socket.sendfile where the
+platform has it), rather than being read into memory and sent in one call,
+and the achieved throughput is reported:
+
+    ```
+    stats = send_file(sock, 'adc16_test.fpg')
+    print(stats)        # <UploadStats: 11.2 MB in 1.03 s, 10.9 MB/s>
+    ```
+
+When many boards are programmed at once, an Uploader shares one read-only
+mapping of the bitstream between the uploads, and caps the number of
+transfers in flight and their aggregate rate, so the uploads don't swamp the
+control network and time out.
+"""
+
+import mmap
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+CHUNK_SIZE = 2**20
+
+
+class UploadStats(object):
+    """ Size and duration of an upload """
+    def __init__(self, n_bytes, seconds):
+        self.bytes = n_bytes
+        self.seconds = seconds
+
+    def __repr__(self):
+        return "<UploadStats: %2.1f MB in %2.2f s, %2.1f MB/s>" % (
+            self.bytes / 1e6, self.seconds, self.mb_per_s)
+
+    @property
+    def mb_per_s(self):
+        return self.bytes / 1e6 / self.seconds if self.seconds > 0 else 0.0
+
+
+def send_file(sock, filename, chunk_size=CHUNK_SIZE):
+    """ Stream a file to a connected socket
+
+    Args:
+        sock (socket.socket): connected socket
+        filename (str): file to send
+        chunk_size (int): bytes per send when sendfile is not available
+
+    Returns:
+        UploadStats
+    """
+    t0 = time.time()
+    n_bytes = os.path.getsize(filename)
+    with open(filename, 'rb') as fh:
+        if hasattr(sock, 'sendfile'):
+            sent = sock.sendfile(fh)
+        else:
+            sent = 0
+            chunk = fh.read(chunk_size)
+            while chunk:
+                sock.sendall(chunk)
+                sent += len(chunk)
+                chunk = fh.read(chunk_size)
+    if sent != n_bytes:
+        raise RuntimeError("Sent %i of %i bytes of %s" % (sent, n_bytes, filename))
+    return UploadStats(sent, time.time() - t0)
+
+
+def send_buffer(sock, data, chunk_size=CHUNK_SIZE, rate_limiter=None):
+    """ Send a buffer (e.g. a SharedBitstream's mmap) to a connected socket in chunks
+
+    Args:
+        sock (socket.socket): connected socket
+        data: bytes, bytearray or mmap
+        chunk_size (int): bytes per send
+        rate_limiter (TokenBucket): if given, each chunk waits for its tokens
+
+    Returns:
+        UploadStats
+    """
+    t0 = time.time()
+    try:
+        view = memoryview(data)
+    except TypeError:
+        view = data     # python 2 mmap: slices are copied, one chunk at a time
+    n_bytes = len(data)
+    try:
+        for start in range(0, n_bytes, chunk_size):
+            chunk = view[start:start + chunk_size]
+            if rate_limiter is not None:
+                rate_limiter.consume(len(chunk))
+            sock.sendall(chunk)
+            chunk = None
+    finally:
+        # Drop the views right away, or the mmap cannot be closed
+        chunk = view = None
+    return UploadStats(n_bytes, time.time() - t0)
+
+
+class TokenBucket(object):
+    """ Limit the aggregate rate of several threads
+
+    Args:
+        rate (float): tokens (bytes) per second
+        burst (float): max. tokens that can build up while idle, default
+                       0.1 s worth
+
+    Notes:
+        consume() takes its tokens right away, going into debt if need be,
+        and then sleeps until the debt has been paid off. Callers are thus
+        served in the order they arrive, and the long-run rate never exceeds
+        rate.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else 0.1 * self.rate
+        self.tokens = self.burst
+        self._t = time.time()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<TokenBucket: %2.1f MB/s>" % (self.rate / 1e6)
+
+    def consume(self, n):
+        """ Take n tokens, sleeping until the bucket can pay for them """
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self._t) * self.rate)
+            self._t = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SharedBitstream(object):
+    """ Read-only memory map of a bitstream, shared by concurrent uploads
+
+    Args:
+        filename (str): bitstream file
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fh:
+            self.data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __repr__(self):
+        return "<SharedBitstream: %s, %2.1f MB>" % (self.filename, len(self) / 1e6)
+
+    def __len__(self):
+        return len(self.data)
+
+    def close(self):
+        self.data.close()
+
+
+class Uploader(object):
+    """ Send bitstreams to boards, sharing the network between concurrent uploads
+
+    Args:
+        max_transfers (int): max. uploads in flight, None for no limit
+        max_rate (float): max. aggregate upload rate in bytes/s, None for no
+                          limit. Needs max_transfers, so each upload's share
+                          of the rate (and hence its timeout) is known.
+        chunk_size (int): bytes per send
+
+    Notes:
+        Files registered with share(), and all files when max_rate is set,
+        are memory-mapped once and sent from the mapping; others are streamed
+        from disk by send_file.
+        Hold transfer() around each upload, from the upload request until the
+        file has been sent, to take one of the max_transfers slots.
+    """
+    def __init__(self, max_transfers=None, max_rate=None, chunk_size=CHUNK_SIZE):
+        if max_rate and not max_transfers:
+            raise RuntimeError("A max_rate needs a max_transfers limit too")
+        self.max_transfers = max_transfers
+        self.max_rate = max_rate
+        self.chunk_size = chunk_size
+        self.rate_limiter = TokenBucket(max_rate) if max_rate else None
+        self._slots = threading.BoundedSemaphore(max_transfers) if max_transfers else None
+        self._shared = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Uploader: %s transfers, %s, %i shared files>" % (
+            self.max_transfers or 'unlimited', self.rate_limiter or 'no rate limit', len(self._shared))
+
+    def share(self, filename):
+        """ Memory-map a file for all uploads of it; returns the SharedBitstream """
+        key = os.path.abspath(filename)
+        with self._lock:
+            if key not in self._shared:
+                self._shared[key] = SharedBitstream(filename)
+            return self._shared[key]
+
+    def close(self):
+        """ Unmap the shared files
+
+        Files still being sent by an upload are left for the garbage collector.
+        """
+        with self._lock:
+            for bitstream in self._shared.values():
+                try:
+                    bitstream.close()
+                except BufferError:
+                    pass
+            self._shared = {}
+
+    @contextmanager
+    def transfer(self):
+        """ Scope of one upload: waits for one of the max_transfers slots """
+        if self._slots is None:
+            yield
+            return
+        self._slots.acquire()
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def transfer_time(self, n_bytes):
+        """ Return the seconds an upload of n_bytes is expected to take under the rate limit
+
+        Assumes all max_transfers slots are busy and share max_rate equally;
+        0 without a rate limit.
+        """
+        if self.rate_limiter is None:
+            return 0.0
+        return n_bytes / (self.rate_limiter.rate / self.max_transfers)
+
+    def send(self, sock, filename):
+        """ Send a file to a connected socket, returns UploadStats """
+        if self.rate_limiter is None and os.path.abspath(filename) not in self._shared:
+            return send_file(sock, filename, self.chunk_size)
+        return send_buffer(sock, self.share(filename).data, self.chunk_size, self.rate_limiter)
+
+
+# No limits, files streamed from disk
+DIRECT_UPLOADER = Uploader()
@@ -0,0 +1,33 @@
+"""
+Shared fixtures for the snap_control tests.
+
+Board-level tests run against SimSnapServer, so no hardware is needed, but
+they do need casperfpga for SnapBoard and are skipped without it. test_snap.py
+is a script for a live board, and is not collected; nor, on Python 2, are the
+tests of the Python 3 only katcp_async.
+"""
+
+import sys
+
+import pytest
+
+collect_ignore = ['test_snap.py']
+if sys.version_info[0] < 3:
+    collect_ignore.append('test_katcp_async.py')
+
+
+@pytest.fixture
+def sim_server():
+    """ A simulated SNAP board, served over KATCP on a free port """
+    from snap_control.snap_sim import SimSnapServer
+    server = SimSnapServer(port=0).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def snap(sim_server):
+    """ A SnapBoard connected to sim_server """
+    pytest.importorskip('casperfpga')
+    from snap_control.snap_board import SnapBoard
+    return SnapBoard(sim_server.host, katcp_port=sim_server.port)
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('casperfpga')
+
+from snap_control import katcp_async
+from snap_control.katcp_async import AsyncKatcpClient, AsyncSnapManager
+
+BOF = 'adc16_test.bof'
+
+
+def test_async_manager(sim_server):
+    async def main():
+        mgr = AsyncSnapManager([sim_server.host], katcp_port=sim_server.port)
+        await mgr.connect()
+        try:
+            await mgr.program(BOF)
+            rms = await mgr.check_rms()
+            await mgr.recalibrate()
+        finally:
+            await mgr.close()
+        return rms
+
+    rms = asyncio.run(main())
+    assert sim_server.board.programmed == BOF
+    assert sorted(rms) == ['%s-%i' % (sim_server.host, chip) for chip in range(3)]
+    assert all(v > 0 for v in rms.values())
+    for chip in range(3):
+        bad, rotation = sim_server.board.adc.lane_errors(chip)
+        assert not bad.any()
+        assert (rotation == 0).all()
+
+
+def test_client_survives_bad_lines_and_closes(monkeypatch):
+    monkeypatch.setattr(katcp_async, 'READ_LIMIT', 1024)
+
+    async def board(reader, writer):
+        await reader.readline()
+        writer.write(b'not katcp\n')
+        writer.write(b'#log ' + b'x' * 4096 + b'\n')
+        writer.write(b'!watchdog[1] ok\n')
+        await writer.drain()
+        # Hang up on the second request
+        await reader.readline()
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(board, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        client = AsyncKatcpClient('127.0.0.1', port, timeout=2.0)
+        await client.connect()
+        try:
+            reply, informs = await client.request('watchdog')
+            assert reply == [b'ok']
+            with pytest.raises(RuntimeError, match='closed'):
+                await client.request('watchdog')
+            assert not client.is_connected()
+            with pytest.raises(RuntimeError, match='Not connected'):
+                await client.request('watchdog')
+        finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(main())
@@ -0,0 +1,144 @@
+import threading
+import time
+
+import pytest
+
+from snap_control.katcp_pipeline import RequestWindow
+
+
+class FakeMessage(object):
+    """ Just enough of katcp.Message """
+    def __init__(self, mtype, name, *args):
+        self.mtype = mtype
+        self.name = name
+        self.arguments = list(args)
+
+    def reply_ok(self):
+        return self.mtype == '!' and self.arguments[:1] == ['ok']
+
+    def __repr__(self):
+        return '%s%s %s' % (self.mtype, self.name, self.arguments)
+
+
+class FakeClient(object):
+    """ callback_request that replies from another thread after delay seconds
+
+    Reads return the device name as data, 'fail' requests fail, and requests
+    named in self.silent never get a reply until answer_silent() is called.
+    """
+    def __init__(self, delay=0.005):
+        self.delay = delay
+        self.silent = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.sent = []
+        self._held = []
+        self._lock = threading.Lock()
+
+    def callback_request(self, msg, reply_cb=None, inform_cb=None, user_data=None, timeout=None):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.sent.append(msg.name)
+        if msg.name in self.silent:
+            self._held.append((msg, reply_cb, inform_cb, user_data))
+            return
+        t = threading.Thread(target=self._answer, args=(msg, reply_cb, inform_cb, user_data))
+        t.daemon = True
+        t.start()
+
+    def _answer(self, msg, reply_cb, inform_cb, user_data, delay=None):
+        time.sleep(self.delay if delay is None else delay)
+        with self._lock:
+            self.in_flight -= 1
+        inform_cb(FakeMessage('#', msg.name, 'informed'), *user_data)
+        if msg.name == 'fail':
+            reply_cb(FakeMessage('!', msg.name, 'fail', 'no such device'), *user_data)
+        else:
+            reply_cb(FakeMessage('!', msg.name, 'ok', *msg.arguments[:1]), *user_data)
+
+    def answer_silent(self):
+        held, self._held = self._held, []
+        for args in held:
+            self._answer(*args, delay=0)
+
+
+def _requests(name, n):
+    return [FakeMessage('?', name, 'dev%i' % ii, '0', '4') for ii in range(n)]
+
+
+def test_burst_stays_in_window():
+    client = FakeClient()
+    window = RequestWindow(client.callback_request, window=4, timeout=2.0)
+    replies = window.burst(_requests('read', 40))
+    assert client.max_in_flight == 4
+    assert [reply.arguments[1] for reply, informs in replies] == ['dev%i' % ii for ii in range(40)]
+    assert all(len(informs) == 1 for reply, informs in replies)
+    assert window._in_flight == 0
+
+
+def test_burst_fails_on_error_reply():
+    client = FakeClient()
+    window = RequestWindow(client.callback_request, window=4, timeout=2.0)
+    with pytest.raises(RuntimeError, match='no such device'):
+        window.burst(_requests('read', 3) + _requests('fail', 1))
+    assert window._in_flight == 0
+
+
+def test_timeout_frees_slot_and_drops_late_reply():
+    client = FakeClient()
+    client.silent.add('hang')
+    window = RequestWindow(client.callback_request, window=2, timeout=0.2)
+    future = window.send(FakeMessage('?', 'hang'))
+    window.send(FakeMessage('?', 'read', 'dev0'))
+    with pytest.raises(RuntimeError, match='Timed out'):
+        window.flush()
+    assert window._in_flight == 0
+
+    client.answer_silent()
+    assert future.reply is None
+    with pytest.raises(RuntimeError, match='Timed out'):
+        future.result()
+    assert window._in_flight == 0
+
+
+def test_full_window_times_out():
+    client = FakeClient()
+    client.silent.add('hang')
+    window = RequestWindow(client.callback_request, window=1, timeout=0.1)
+    window.send(FakeMessage('?', 'hang'))
+    with pytest.raises(RuntimeError, match='free pipeline slot'):
+        window.send(FakeMessage('?', 'read', 'dev0'))
+
+
+def test_send_and_flush_from_threads():
+    client = FakeClient(delay=0.001)
+    window = RequestWindow(client.callback_request, window=8, timeout=2.0)
+    futures = []
+
+    def _send(jj):
+        for ii in range(50):
+            futures.append(window.send(FakeMessage('?', 'read', '%i-%i' % (jj, ii)),
+                                       parse=lambda reply, informs: reply.arguments[1]))
+
+    threads = [threading.Thread(target=_send, args=(jj,)) for jj in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    window.flush()
+    assert client.max_in_flight <= 8
+    assert sorted(f.result() for f in futures) == sorted('%i-%i' % (jj, ii) for jj in range(4) for ii in range(50))
+    assert window._pending == []
+
+
+def test_burst_does_not_wait_for_sent_requests():
+    client = FakeClient()
+    client.silent.add('hang')
+    window = RequestWindow(client.callback_request, window=4, timeout=2.0)
+    window.send(FakeMessage('?', 'hang'))
+    t0 = time.time()
+    window.burst(_requests('read', 4))
+    assert time.time() - t0 < 1.0
+    client.answer_silent()
+    window.flush()
@@ -0,0 +1,111 @@
+import threading
+import time
+
+import pytest
+
+katcp = pytest.importorskip('katcp')
+
+from snap_control.katcp_wrapper import FpgaClient
+
+
+class FakeBoard(object):
+    """ Records callback_requests, and answers them when asked to """
+    def __init__(self):
+        self.held = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def callback_request(self, msg, reply_cb=None, inform_cb=None, user_data=None, timeout=None):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.held.append((msg, reply_cb, inform_cb, user_data))
+
+    def answer(self, index, *args):
+        msg, reply_cb, inform_cb, user_data = self.held[index]
+        with self._lock:
+            self.in_flight -= 1
+        reply_cb(katcp.Message.reply(msg.name, katcp.Message.OK, *args), *user_data)
+
+    def answer_all_from_thread(self, delay=0.005):
+        """ Keep answering new requests, in order, until stop is set """
+        stop = threading.Event()
+
+        def _run():
+            answered = 0
+            while not stop.is_set():
+                if answered < len(self.held):
+                    time.sleep(delay)
+                    self.answer(answered, self.held[answered][0].arguments[0])
+                    answered += 1
+                else:
+                    time.sleep(0.001)
+        t = threading.Thread(target=_run)
+        t.daemon = True
+        t.start()
+        return stop
+
+
+@pytest.fixture
+def client():
+    # Nothing listens on port 1: the fake board stands in for the connection
+    client = FpgaClient('127.0.0.1', port=1, timeout=0.3)
+    board = FakeBoard()
+    client.callback_request = board.callback_request
+    client._pipeline.callback_request = board.callback_request
+    client.board = board
+    yield client
+    client.stop()
+
+
+def test_pipelined_requests_stay_in_window(client):
+    client.pipeline_window = 3
+    client._pipeline.timeout = 2.0
+    stop = client.board.answer_all_from_thread()
+    try:
+        data = client.read_burst(['dev%i' % ii for ii in range(20)], 4)
+    finally:
+        stop.set()
+    assert client.board.max_in_flight == 3
+    assert [d.decode() if isinstance(d, bytes) else d for d in data] == ['dev%i' % ii for ii in range(20)]
+
+
+def test_nb_requests_evicted_when_table_full(client):
+    client._nb_max_requests = 4
+    requests = [client._nb_request('watchdog') for ii in range(6)]
+    assert len(client._nb_requests) == 4
+    for req in requests[:2]:
+        with pytest.raises(RuntimeError, match='evicted'):
+            req['future'].result()
+
+    # A late reply to an evicted request is dropped
+    client.board.answer(0)
+    assert requests[0]['future'].reply is None
+
+    client.board.answer(5)
+    reply, informs = requests[5]['future'].result()
+    assert reply.reply_ok()
+
+
+def test_nb_expired_requests(client):
+    replied = client._nb_request('watchdog')
+    silent = client._nb_request('watchdog')
+    client.board.answer(0)
+    time.sleep(0.4)
+    assert client._nb_expire_requests() == [silent['future']]
+    assert not client._nb_requests
+
+    # The replied request is kept until its result is read, once
+    reply, informs = client._nb_get_request_result(replied['id'])
+    assert reply.reply_ok()
+    with pytest.raises(RuntimeError):
+        client._nb_get_request_result(replied['id'])
+
+    # The expired one failed, and its late reply is dropped
+    with pytest.raises(RuntimeError, match='Timed out'):
+        silent['future'].result()
+    client.board.answer(1)
+    assert silent['future'].reply is None
+    with pytest.raises(RuntimeError):
+        client._nb_get_request_result(silent['id'])
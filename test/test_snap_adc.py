@@ -0,0 +1,67 @@
+import struct
+
+import pytest
+
+from snap_control.snap_adc import SnapAdc
+from snap_control.snap_sim import SimSnapBoard
+
+
+class SimHost(object):
+    """ Just enough of a SnapBoard for SnapAdc register writes, on a SimSnapBoard """
+    host = 'sim'
+
+    def __init__(self, board):
+        self.board = board
+
+    def write_int(self, device_name, integer, blindwrite=False, word_offset=0):
+        self.board.write(device_name, word_offset * 4, struct.pack('>I', integer))
+
+
+@pytest.fixture
+def sim_board():
+    board = SimSnapBoard()
+    board.program('adc16_test.bof')
+    return board
+
+
+@pytest.mark.parametrize('chips, chip_select', [
+    ('a', 0b001), (['a'], 0b001), ('b', 0b010), (['b'], 0b010), ('c', 0b100), (['c'], 0b100),
+    (['a', 'b'], 0b011), (['b', 'c'], 0b110), (['a', 'b', 'c'], 0b111), ('all', 0b111)])
+def test_set_chip_select(chips, chip_select):
+    adc = SnapAdc(None)
+    adc.set_chip_select(chips)
+    assert adc.chip_select == chip_select
+    assert sorted(adc.chips.values()) == [n for n in range(3) if (chip_select >> n) & 1]
+
+
+def test_shadow_follows_chip_select(sim_board):
+    adc = SnapAdc(SimHost(sim_board))
+    sim_adc = sim_board.adc
+
+    adc.set_chip_select(['a', 'b'])
+    adc.write_register('bits_custom1', 0x5a)
+    assert [sim_adc.field(n, 'bits_custom1') for n in range(3)] == [0x5a, 0x5a, 0]
+
+    # Chip c was not written, so the same value must still be sent to it
+    adc.set_chip_select(['c'])
+    adc.write_register('bits_custom1', 0x5a)
+    assert [sim_adc.field(n, 'bits_custom1') for n in range(3)] == [0x5a, 0x5a, 0x5a]
+
+    # Now every chip holds it, and rewriting it is skipped
+    n_writes = sim_adc.n_spi_writes
+    adc.set_chip_select(['a', 'b', 'c'])
+    adc.write_register('bits_custom1', 0x5a)
+    assert sim_adc.n_spi_writes == n_writes
+
+
+def test_aborted_transaction_resets_shadow(sim_board):
+    adc = SnapAdc(SimHost(sim_board))
+    adc.set_chip_select(['b'])
+    with pytest.raises(ZeroDivisionError):
+        with adc.spi_transaction():
+            adc.write_register('bits_custom1', 0x33)
+            1 / 0
+    assert sim_board.adc.field(1, 'bits_custom1') == 0
+
+    adc.write_register('bits_custom1', 0x33)
+    assert sim_board.adc.field(1, 'bits_custom1') == 0x33
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from snap_control.snap_archive import SnapshotArchiveWriter, SnapshotArchive
+
+HOSTS = ['snap01', 'snap02']
+
+
+def _record(ii, hosts=HOSTS, n_samples=64):
+    """ grab_adc_snapshot-style dict; every sample of record ii is ii + chip """
+    return dict(('%s-%i' % (host, chip), np.full(n_samples, ii + chip, dtype='int8'))
+                for host in hosts for chip in range(3))
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_archive_round_trip(tmpdir, compress):
+    path = str(tmpdir.join('archive'))
+    with SnapshotArchiveWriter(path, chunk_size=4, compress=compress,
+                               metadata={'demux_mode': 1}) as writer:
+        for ii in range(10):
+            writer.append(_record(ii), timestamp=100.0 + ii)
+
+    archive = SnapshotArchive(path)
+    assert len(archive) == 10
+    assert len(archive.chunks) == 3
+    assert archive.hosts == HOSTS
+    assert archive.n_samples == 64
+    assert archive.metadata == {'demux_mode': 1}
+    assert np.array_equal(archive.timestamps, 100.0 + np.arange(10))
+
+    timestamps, data, streams = archive.read()
+    assert data.shape == (10, 6, 64)
+    assert data.dtype == np.int8
+    assert streams == [(host, chip) for host in HOSTS for chip in range(3)]
+    assert np.array_equal(data[:, :, 0], np.arange(10)[:, None] + [0, 1, 2, 0, 1, 2])
+
+    assert np.array_equal(archive[5], data[5])
+    assert np.array_equal(archive[-1], data[9])
+    with pytest.raises(IndexError):
+        archive[10]
+
+
+def test_archive_select(tmpdir):
+    path = str(tmpdir.join('archive'))
+    with SnapshotArchiveWriter(path, chunk_size=4) as writer:
+        for ii in range(10):
+            writer.append(_record(ii), timestamp=100.0 + ii)
+
+    archive = SnapshotArchive(path)
+    timestamps, data, streams = archive.read(host='snap02', chip=1, t_start=103, t_stop=106)
+    assert streams == [('snap02', 1)]
+    assert timestamps.tolist() == [103.0, 104.0, 105.0, 106.0]
+    assert data[:, 0, 0].tolist() == [4, 5, 6, 7]
+
+    timestamps, data, streams = archive.read(chip=2, t_start=200)
+    assert data.shape == (0, 2, 64)
+
+
+def test_archive_append_batch_and_reopen(tmpdir):
+    path = str(tmpdir.join('archive'))
+    streams = [('snap01', 0), ('snap01', 1)]
+    with SnapshotArchiveWriter(path, streams=streams, chunk_size=8) as writer:
+        writer.append(np.ones((5, 2, 32)), timestamp=np.arange(5.0))
+    with SnapshotArchiveWriter(path, chunk_size=8) as writer:
+        writer.append(np.full((2, 32), 2), timestamp=5.0)
+
+    with pytest.raises(RuntimeError):
+        SnapshotArchiveWriter(path, streams=[('snap02', 0)])
+    with pytest.raises(RuntimeError):
+        SnapshotArchiveWriter(path).append(np.zeros((3, 32)))
+
+    archive = SnapshotArchive(path)
+    assert len(archive) == 6
+    timestamps, data, streams = archive.read()
+    assert data[:, 0, 0].tolist() == [1, 1, 1, 1, 1, 2]
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_archive_missing_streams(tmpdir, compress):
+    path = str(tmpdir.join('archive'))
+    with SnapshotArchiveWriter(path, chunk_size=4, compress=compress) as writer:
+        writer.append(_record(1), timestamp=1.0)
+        writer.append(_record(2, hosts=['snap01']), timestamp=2.0)
+        writer.append(_record(3), timestamp=3.0)
+        with pytest.raises(RuntimeError):
+            writer.append({'snap03-0': np.zeros(64, dtype='int8')})
+
+    archive = SnapshotArchive(path)
+    timestamps, data, streams, valid = archive.read(with_valid=True)
+    assert valid.tolist() == [[True] * 6, [True] * 3 + [False] * 3, [True] * 6]
+    assert (data[1, 3:] == 0).all()
+    assert (data[1, :3, 0] == [2, 3, 4]).all()
+
+    timestamps, data, streams, valid = archive.read(host='snap02', t_start=2, with_valid=True)
+    assert valid.tolist() == [[False] * 3, [True] * 3]
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+pytest.importorskip('casperfpga')
+
+from snap_control.snap_board import ClockEstimator
+
+RATE = 250e6
+
+
+def _count(t, start=0):
+    """ 32-bit counter at RATE, t seconds after it read start """
+    return int(start + t * RATE) % 2**32
+
+
+def test_clock_estimate():
+    t0 = time.time() - 1.0
+    clock = ClockEstimator(min_interval=0.5)
+    clock.add_sample(_count(0), t0)
+    assert clock.estimate() == (None, None)
+
+    # Too close to the reference: ignored, and the reference is kept
+    clock.add_sample(_count(0.2), t0 + 0.2)
+    assert clock.estimate() == (None, None)
+
+    clock.add_sample(_count(0.6), t0 + 0.6)
+    mhz, age = clock.estimate()
+    assert mhz == pytest.approx(RATE / 1e6)
+    assert 0.35 < age < 1.0
+
+
+def test_clock_estimate_across_wrap():
+    t0 = 1000.0
+    start = 2**32 - 1000
+    clock = ClockEstimator(min_interval=0.5)
+    clock.add_sample(_count(0, start), t0)
+    assert _count(1.0, start) < start
+    clock.add_sample(_count(1.0, start), t0 + 1.0)
+    assert clock.mhz == pytest.approx(RATE / 1e6)
+
+
+def test_clock_samples_too_far_apart():
+    # More than one wrap at max_rate apart: the count may have wrapped
+    # several times, so the later sample only becomes the new reference
+    t0 = 1000.0
+    clock = ClockEstimator(min_interval=0.5, max_rate=500e6)
+    clock.add_sample(_count(0), t0)
+    clock.add_sample(_count(10.0), t0 + 10.0)
+    assert clock.mhz is None
+    clock.add_sample(_count(11.0), t0 + 11.0)
+    assert clock.mhz == pytest.approx(RATE / 1e6)
+
+
+def test_fpga_clock_estimate(sim_server, snap):
+    snap.program('adc16_test.bof')
+    snap.clock = ClockEstimator(min_interval=0.2)
+    assert snap.fpga_clock_estimate() == (None, None)
+    time.sleep(0.1)
+    # Still closer than min_interval to the first read
+    assert snap.fpga_clock_estimate() == (None, None)
+    time.sleep(0.2)
+    mhz, age = snap.fpga_clock_estimate()
+    assert mhz == pytest.approx(sim_server.board.fpga_clock / 1e6, rel=0.02)
+    assert age < 0.1
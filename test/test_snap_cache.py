@@ -0,0 +1,113 @@
+import os
+
+from snap_control.snap_cache import (CalibrationCache, BitstreamCache, bitstream_hash,
+                                     board_fingerprint)
+
+
+class FakeBoard(object):
+    """ Just enough of a SnapBoard for board_fingerprint and stored_name """
+    def __init__(self, devices=('adc16_controller', 'sys_clkcounter'), bofs=()):
+        self.devices = list(devices)
+        self.bofs = list(bofs)
+
+    def listdev(self):
+        return self.devices
+
+    def listbof(self):
+        return self.bofs
+
+
+def test_bitstream_hash(tmpdir):
+    path = str(tmpdir.join('adc16.fpg'))
+    with open(path, 'wb') as fh:
+        fh.write(b'\x00' * 3000)
+    h = bitstream_hash(path, chunk_size=1024)
+    assert h == bitstream_hash(path)
+    with open(path, 'ab') as fh:
+        fh.write(b'\x01')
+    assert bitstream_hash(path) != h
+
+    # Names of bitstreams stored on the board are hashed by name
+    assert bitstream_hash('adc16_test.bof').startswith('name-')
+    assert bitstream_hash('/some/dir/adc16_test.bof') == bitstream_hash('adc16_test.bof')
+
+
+def test_calibration_cache_round_trip(tmpdir):
+    path = str(tmpdir.join('sub', 'cal_cache.json'))
+    cache = CalibrationCache(path)
+    assert cache.get('snap01', 'abc', 'a', 1) is None
+    cache.put('snap01', 'abc', 'a', 1, range(8), [0, 1, 2, 3, 4, 5, 6, 7], margins=[4] * 8)
+    cache.put('snap01', 'abc', 'b', 1, [3] * 8, [0] * 8)
+    cache.put('snap02', 'abc', 'a', 1, [5] * 8, [1] * 8)
+    cache.save()
+    assert not os.path.exists(path + '.tmp')
+
+    loaded = CalibrationCache(path)
+    entry = loaded.get('snap01', 'abc', 'a', 1)
+    assert entry['taps'] == list(range(8))
+    assert entry['bitslips'] == [0, 1, 2, 3, 4, 5, 6, 7]
+    assert entry['margins'] == [4] * 8
+    assert 'margins' not in loaded.get('snap01', 'abc', 'b', 1)
+    assert loaded.get('snap01', 'abc', 'a', 2) is None
+    assert loaded.get('snap01', 'def', 'a', 1) is None
+
+    loaded.invalidate('snap01')
+    assert loaded.get('snap01', 'abc', 'b', 1) is None
+    assert loaded.get('snap02', 'abc', 'a', 1) is not None
+
+
+def test_calibration_cache_invalidate_bitstream(tmpdir):
+    cache = CalibrationCache(str(tmpdir.join('cal_cache.json')))
+    cache.put('snap01', 'abc', 'a', 1, [0] * 8, [0] * 8)
+    cache.put('snap01', 'def', 'a', 1, [0] * 8, [0] * 8)
+    cache.invalidate('snap01', 'abc')
+    assert cache.get('snap01', 'abc', 'a', 1) is None
+    assert cache.get('snap01', 'def', 'a', 1) is not None
+
+
+def test_calibration_cache_corrupt(tmpdir):
+    path = str(tmpdir.join('cal_cache.json'))
+    with open(path, 'w') as fh:
+        fh.write('{"truncated": ')
+    cache = CalibrationCache(path)
+    assert cache.entries == {}
+
+
+def test_bitstream_cache_round_trip(tmpdir):
+    path = str(tmpdir.join('bitstream_cache.json'))
+    board = FakeBoard()
+    cache = BitstreamCache(path)
+    cache.put_stored('snap01', 'adc16_test.bof', 'abc')
+    cache.put('snap01', 'abc', 'adc16_test.fpg', board_fingerprint(board))
+    cache.save()
+
+    loaded = BitstreamCache(path)
+    entry = loaded.get('snap01')
+    assert entry['hash'] == 'abc'
+    assert entry['name'] == 'adc16_test.fpg'
+    assert entry['stored'] == {'adc16_test.bof': 'abc'}
+    assert loaded.is_running(board, 'snap01', 'abc')
+    assert not loaded.is_running(board, 'snap01', 'def')
+    assert not loaded.is_running(board, 'snap02', 'abc')
+
+
+def test_bitstream_cache_fingerprint_changed(tmpdir):
+    board = FakeBoard()
+    cache = BitstreamCache(str(tmpdir.join('bitstream_cache.json')))
+    cache.put('snap01', 'abc', 'adc16_test.fpg', board_fingerprint(board))
+
+    # Reprogrammed with another design, or power cycled
+    assert not cache.is_running(FakeBoard(devices=['other_design']), 'snap01', 'abc')
+    assert not cache.is_running(FakeBoard(devices=[]), 'snap01', 'abc')
+
+    cache.invalidate('snap01')
+    assert not cache.is_running(board, 'snap01', 'abc')
+
+
+def test_bitstream_cache_stored_name(tmpdir):
+    cache = BitstreamCache(str(tmpdir.join('bitstream_cache.json')))
+    cache.put_stored('snap01', 'adc16_test.bof', 'abc')
+    assert cache.stored_name(FakeBoard(bofs=['adc16_test.bof']), 'snap01', 'abc') == 'adc16_test.bof'
+    assert cache.stored_name(FakeBoard(bofs=[]), 'snap01', 'abc') is None
+    assert cache.stored_name(FakeBoard(bofs=['adc16_test.bof']), 'snap01', 'def') is None
+    assert cache.stored_name(FakeBoard(bofs=['adc16_test.bof']), 'snap02', 'abc') is None
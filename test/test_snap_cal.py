@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from snap_control.snap_cal import (N_TAPS, N_LANES, DESKEW_VAL, SYNC_VAL, count_lane_errors,
+                                   find_eyes, pattern_fraction, sync_bitslips)
+
+
+def _rotl8(val, n):
+    return ((val << n) | (val >> (8 - n))) & 0xff
+
+
+def _cube(good_taps):
+    """ Error cube of shape (32, 8), zero errors at good_taps[lane] """
+    cube = np.full((N_TAPS, N_LANES), 5, dtype='int32')
+    for lane, taps in enumerate(good_taps):
+        cube[list(taps), lane] = 0
+    return cube
+
+
+def test_find_eyes_widest_window():
+    good = [range(4, 15)] * N_LANES
+    good[1] = list(range(2, 5)) + list(range(10, 17))    # 3 taps, then 7 taps
+    best, margins, widths = find_eyes(_cube(good))
+    assert best.tolist() == [9, 13] + [9] * 6
+    assert margins.tolist() == [5, 3] + [5] * 6
+    assert widths.tolist() == [11, 7] + [11] * 6
+
+
+def test_find_eyes_wraps_around():
+    good = [list(range(28, 32)) + list(range(0, 3))] * N_LANES
+    best, margins, widths = find_eyes(_cube(good))
+    assert widths.tolist() == [7] * N_LANES
+    assert best.tolist() == [31] * N_LANES
+
+    best, margins, widths = find_eyes(_cube(good), cyclic=False)
+    assert widths.tolist() == [4] * N_LANES
+    assert best.tolist() == [29] * N_LANES
+
+
+def test_find_eyes_no_eye():
+    good = [range(10, 20)] * N_LANES
+    good[7] = []
+    best, margins, widths = find_eyes(_cube(good))
+    assert (best[7], margins[7], widths[7]) == (-1, -1, 0)
+    assert widths[0] == 10
+
+
+def test_find_eyes_all_good():
+    best, margins, widths = find_eyes(np.zeros((N_TAPS, N_LANES)))
+    assert widths.tolist() == [N_TAPS] * N_LANES
+    assert margins.tolist() == [15] * N_LANES
+
+
+def test_find_eyes_batched():
+    cubes = np.stack([_cube([range(ii, ii + 9)] * N_LANES) for ii in range(3)])
+    best, margins, widths = find_eyes(cubes)
+    assert best.shape == (3, N_LANES)
+    for ii in range(3):
+        b, m, w = find_eyes(cubes[ii])
+        assert np.array_equal(best[ii], b)
+        assert np.array_equal(margins[ii], m)
+        assert np.array_equal(widths[ii], w)
+
+
+def test_count_lane_errors():
+    data = np.full(1024, DESKEW_VAL, dtype='int8')
+    data[3::8][:5] = 0
+    data[6] = 1
+    errs = count_lane_errors(data, DESKEW_VAL)
+    assert errs.tolist() == [0, 0, 0, 5, 0, 0, 1, 0]
+    assert count_lane_errors(np.stack([data, data]), DESKEW_VAL).shape == (2, N_LANES)
+
+
+def test_pattern_fraction():
+    deskew = np.full(1024, DESKEW_VAL, dtype='int8')
+    assert pattern_fraction(deskew, 'deskew') == 1.0
+    assert pattern_fraction(deskew, 'sync') == 0.0
+
+    # Lanes that have not been bitslipped yet read rotations of the pattern
+    sync = np.tile([_rotl8(SYNC_VAL, n) for n in range(8)], 128).astype('uint8')
+    assert pattern_fraction(sync, 'sync') == 1.0
+
+    noise = np.random.RandomState(0).randint(-128, 128, 1024)
+    assert pattern_fraction(noise, 'deskew') < 0.1
+
+    half = deskew.copy()
+    half[512:] = 0
+    assert pattern_fraction(half, 'deskew') == 0.5
+
+
+def test_pattern_fraction_ramp():
+    ramp = (np.arange(1024) & 0xff).astype('uint8').view('int8')
+    assert pattern_fraction(ramp, 'ramp') == 1.0
+    assert pattern_fraction(np.zeros(1024, dtype='int8'), 'ramp') == 0.0
+
+
+def test_pattern_fraction_unknown():
+    with pytest.raises(RuntimeError):
+        pattern_fraction(np.zeros(1024), 'custom1')
+
+
+def test_sync_bitslips():
+    lanes = np.array([_rotl8(SYNC_VAL, n) for n in range(8)])
+    data = np.tile(lanes, 128).astype('uint8').view('int8')
+    n_slips = sync_bitslips(data)
+    assert n_slips.tolist() == [0, 7, 6, 5, 4, 3, 2, 1]
+
+    # Every lane, once slipped by the amount found, reads SYNC_VAL
+    assert [_rotl8(int(v), int(n)) for v, n in zip(lanes, n_slips)] == [SYNC_VAL] * N_LANES
+
+
+def test_sync_bitslips_unsteady():
+    data = np.full((3, 1024), SYNC_VAL, dtype='int8')
+    data[1, 2 + 8 * 10] = 0x0f
+    data[2, 5] = 0x00
+    n_slips = sync_bitslips(data)
+    assert n_slips.shape == (3, N_LANES)
+    assert n_slips[0].tolist() == [0] * N_LANES
+    assert n_slips[1].tolist() == [0, 0, -1, 0, 0, 0, 0, 0]
+    assert n_slips[2].tolist() == [0, 0, 0, 0, 0, -1, 0, 0]
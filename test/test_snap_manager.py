@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+pytest.importorskip('casperfpga')
+
+from snap_control.snap_manager import SnapManager
+
+
+class SleepyBoard(object):
+    """ Stand-in for a connected SnapBoard whose command takes delay seconds """
+    def __init__(self, host, delay):
+        self.host = host
+        self.delay = delay
+        self.n_calls = 0
+
+    def work(self):
+        self.n_calls += 1
+        time.sleep(self.delay)
+        return self.host
+
+
+def make_manager(boards, timeout, max_workers):
+    mgr = SnapManager([], timeout=timeout, max_workers=max_workers)
+    mgr.snap_boards = boards
+    return mgr
+
+
+def test_queued_boards_do_not_time_out():
+    # 8 boards on 2 workers run in 4 waves, longer than the per-board timeout
+    boards = [SleepyBoard('snap%02i' % ii, 0.2) for ii in range(8)]
+    mgr = make_manager(boards, timeout=0.5, max_workers=2)
+    try:
+        t0 = time.time()
+        results = mgr.run_on_all('work')
+        assert time.time() - t0 > 0.75
+        assert results.values_by_host == dict((b.host, b.host) for b in boards)
+        assert not mgr._running
+    finally:
+        mgr.close()
+
+
+def test_timed_out_board_fails_fast():
+    slow = SleepyBoard('slow', 1.0)
+    boards = [slow, SleepyBoard('fast', 0.01)]
+    mgr = make_manager(boards, timeout=0.3, max_workers=2)
+    try:
+        results = mgr.run_on_all('work')
+        assert results['slow'].timed_out
+        assert results['fast'].ok
+
+        # slow is still busy: the next command fails without waiting for it
+        t0 = time.time()
+        results = mgr.run_on_all('work')
+        assert time.time() - t0 < 0.3
+        assert isinstance(results['slow'].exception, RuntimeError)
+        assert results['fast'].ok
+        assert slow.n_calls == 1
+
+        time.sleep(1.0)
+        results = mgr.run_on_all('work', timeout=2.0)
+        assert results['slow'].ok
+        assert slow.n_calls == 2
+    finally:
+        mgr.close()
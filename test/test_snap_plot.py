@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from snap_control.snap_plot import demux_data
+
+
+def _demux_data_loops(snapshot, demux):
+    """ The original loop implementation of demux_data, for 1024-sample snapshots """
+    input1_data = []
+    input2_data = []
+    input3_data = []
+    input4_data = []
+
+    if demux == 1:
+        for i in range(0, 1024, 4):
+            input1_data.append(snapshot[i + 0])
+            input2_data.append(snapshot[i + 1])
+            input3_data.append(snapshot[i + 2])
+            input4_data.append(snapshot[i + 3])
+        return input1_data, input2_data, input3_data, input4_data
+
+    elif demux == 2:
+        for i in range(0, 1024, 8):
+            input1_data.append(snapshot[i + 0])
+            input1_data.append(snapshot[i + 4])
+            input1_data.append(snapshot[i + 1])
+            input1_data.append(snapshot[i + 5])
+
+            input3_data.append(snapshot[i + 2])
+            input3_data.append(snapshot[i + 6])
+            input3_data.append(snapshot[i + 3])
+            input3_data.append(snapshot[i + 7])
+        return input1_data, input3_data
+
+    elif demux == 4:
+        for i in range(0, 1024, 8):
+            input1_data.append(snapshot[i + 0])
+            input1_data.append(snapshot[i + 2])
+            input1_data.append(snapshot[i + 4])
+            input1_data.append(snapshot[i + 6])
+            input1_data.append(snapshot[i + 1])
+            input1_data.append(snapshot[i + 3])
+            input1_data.append(snapshot[i + 5])
+            input1_data.append(snapshot[i + 7])
+        return input1_data
+
+
+@pytest.fixture
+def snapshots():
+    return np.random.RandomState(0).randint(-128, 128, (3, 1024)).astype('int8')
+
+
+@pytest.mark.parametrize('demux', [1, 2, 4])
+def test_demux_data_matches_loops(snapshots, demux):
+    for snapshot in snapshots:
+        expected = _demux_data_loops(snapshot, demux)
+        result = demux_data(snapshot, demux)
+        if demux == 4:
+            expected, result = [expected], [result]
+        assert len(result) == len(expected)
+        for r, e in zip(result, expected):
+            assert np.array_equal(r, e)
+
+
+@pytest.mark.parametrize('demux', [1, 2, 4])
+def test_demux_data_batched(snapshots, demux):
+    result = demux_data(snapshots, demux)
+    if demux == 4:
+        result = [result]
+    for ii, snapshot in enumerate(snapshots):
+        expected = demux_data(snapshot, demux)
+        if demux == 4:
+            expected = [expected]
+        for r, e in zip(result, expected):
+            assert np.array_equal(r[ii], e)
+
+
+def test_demux_data_partial_frame():
+    snapshot = np.arange(1030)
+    input1 = demux_data(snapshot, 4)
+    assert len(input1) == 1024
+    assert np.array_equal(input1, demux_data(snapshot[:1024], 4))
+    assert len(demux_data(snapshot, 1)[0]) == 257
+
+
+def test_demux_data_bad_mode(snapshots):
+    with pytest.raises(RuntimeError):
+        demux_data(snapshots[0], 3)
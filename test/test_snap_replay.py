@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+pytest.importorskip('katcp')
+
+from katcp import Message
+
+from snap_control.snap_replay import _encode, _decode, ReplayMismatch
+
+BOF = 'adc16_test.bof'
+
+
+def _same(a, b):
+    if isinstance(a, Message):
+        return (isinstance(b, Message) and a.name == b.name and a.arguments == b.arguments
+                and getattr(a, 'mtype', None) == getattr(b, 'mtype', None))
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(_same(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict):
+        return sorted(a) == sorted(b) and all(_same(a[k], b[k]) for k in a)
+    return a == b
+
+
+@pytest.mark.parametrize('value', [
+    b'\x00\xff raw', [b'a', 1, 'text', None, 2.5],
+    {'b': 'not bytes'}, {'msg': 'not a message', 'args': []},
+    {'bytes': 'tag-like key'}, {'dict': {'b': b'nested'}},
+    {'reply': Message.reply('read', Message.OK, b'\x01\x02'),
+     'informs': [Message.inform('read', b'\x03')]},
+])
+def test_encode_round_trip(value):
+    encoded = json.loads(json.dumps(_encode(value)))
+    assert _same(_decode(encoded), value)
+
+
+def test_decode_rejects_untagged():
+    with pytest.raises(RuntimeError):
+        _decode({'b': 'AAAA'})
+
+
+def test_profile_record_replay(sim_server, snap, tmpdir):
+    path = str(tmpdir.join('program.katcp.gz'))
+    with snap.profile() as prof:
+        with snap.record(path) as recording:
+            snap.program(BOF)
+    assert recording.n_records > 0
+    assert 'program' in prof.report()
+    # Every transport request was recorded
+    totals = prof.totals()
+    assert sum(totals[op]['calls'] for op in totals if op.startswith('katcp.')) == recording.n_records
+
+    # The board is not needed to replay
+    sim_server.stop()
+    with snap.replay(path, speed=None, strict=True) as replay:
+        snap.program(BOF)
+    assert replay.position == len(replay.records) == recording.n_records
+    assert replay.n_replayed == recording.n_records
+
+    # Strictly, a different session does not match
+    with pytest.raises(ReplayMismatch):
+        with snap.replay(path, speed=None, strict=True):
+            snap.program(BOF, demux_mode=2)
@@ -0,0 +1,110 @@
+import os
+
+import numpy as np
+import pytest
+
+from snap_control.snap_cache import CalibrationCache, BitstreamCache
+
+BOF = 'adc16_test.bof'
+
+
+def assert_calibrated(sim_adc, chip_nums=(0, 1, 2)):
+    """ Every lane samples inside its eye and is framed """
+    for chip_num in chip_nums:
+        bad, rotation = sim_adc.lane_errors(chip_num)
+        assert not bad.any(), "chip %i lanes at the edge of the eye: %s" % (chip_num, bad)
+        assert (rotation == 0).all(), "chip %i lanes out of frame: %s" % (chip_num, rotation)
+
+
+def test_program_calibrates(sim_server, snap):
+    snap.program(BOF)
+    assert sim_server.board.programmed == BOF
+    assert_calibrated(sim_server.board.adc)
+
+    # Test patterns are cleared again, and all 1024 samples come back per chip
+    snapshot = snap.adc.grab_adc_snapshot()
+    assert len(snapshot) == 3
+    for data in snapshot.values():
+        assert len(data) == 1024
+        assert not np.all(data == 42)
+
+
+def test_calibrate(sim_server, snap):
+    snap.program(BOF)
+    sim_adc = sim_server.board.adc
+    sim_adc.taps[:] = 0
+    sim_adc.slips[:] = 0
+    snap.adc.reset_cal_state()
+    snap.adc.calibrate()
+    assert_calibrated(sim_adc)
+    assert sorted(snap.adc.cal_state.keys()) == [0, 1, 2]
+    for chip_num in range(3):
+        assert (snap.adc.cal_state[chip_num]['margins'] >= 0).all()
+
+
+def test_sync_chips(sim_server, snap):
+    snap.program(BOF)
+    sim_adc = sim_server.board.adc
+    sim_adc.slips[1] += np.arange(8)
+    sim_adc.slips[2] += 3
+
+    snap.fpga_set_demux(4)
+    snap.adc.sync_chips([1, 2])
+    snap.fpga_set_demux(snap.adc.demux_mode)
+    assert_calibrated(sim_adc)
+
+
+def test_program_bad_bof(sim_server, snap):
+    with pytest.raises(RuntimeError):
+        snap.program('no_such.bof')
+
+
+def test_program_with_cal_cache(sim_server, snap, tmpdir):
+    cal_cache = CalibrationCache(str(tmpdir.join('cal_cache.json')))
+    snap.program(BOF, cal_cache=cal_cache)
+    assert_calibrated(sim_server.board.adc)
+    n_full = sim_server.request_counts['write'] + sim_server.request_counts['read']
+
+    # Warm start: cached taps and bitslips are reapplied and verified, not swept
+    cal_cache = CalibrationCache(cal_cache.path)
+    assert len(cal_cache.entries) == 3
+    snap.program(BOF, cal_cache=cal_cache)
+    assert_calibrated(sim_server.board.adc)
+    n_cached = sim_server.request_counts['write'] + sim_server.request_counts['read'] - n_full
+    assert n_cached < n_full
+
+
+def test_program_with_stale_cal_cache(sim_server, snap, tmpdir):
+    cal_cache = CalibrationCache(str(tmpdir.join('cal_cache.json')))
+    snap.program(BOF, cal_cache=cal_cache)
+
+    # A stale entry for chip b fails verification and chip b is recalibrated
+    entry = dict(cal_cache.entries)
+    for key in entry:
+        if key.split('|')[2] == 'b':
+            cal_cache.entries[key]['taps'] = [(t + 6) % 32 for t in entry[key]['taps']]
+    snap.program(BOF, cal_cache=cal_cache)
+    assert_calibrated(sim_server.board.adc)
+
+
+def test_upload_with_bitstream_cache(sim_server, snap, tmpdir):
+    image = str(tmpdir.join('adc16_test.bin'))
+    with open(image, 'wb') as fh:
+        fh.write(os.urandom(2**20 + 123))
+    bitstream_cache = BitstreamCache(str(tmpdir.join('bitstream_cache.json')))
+
+    stats = snap.upload_to_ram_and_program(image, bitstream_cache=bitstream_cache)
+    assert stats.bytes == 2**20 + 123
+    assert sim_server.board.programmed.startswith('upload-')
+    assert sim_server.request_counts['progremote'] == 1
+    assert_calibrated(sim_server.board.adc)
+
+    # Still running the image: neither uploaded nor reprogrammed
+    t_programmed = sim_server.board.t_programmed
+    assert snap.upload_to_ram_and_program(image, bitstream_cache=bitstream_cache) is None
+    assert sim_server.request_counts['progremote'] == 1
+    assert sim_server.board.t_programmed == t_programmed
+
+    stats = snap.upload_to_ram_and_program(image, bitstream_cache=bitstream_cache, force=True)
+    assert stats is not None
+    assert sim_server.request_counts['progremote'] == 2
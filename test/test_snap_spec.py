@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from snap_control.snap_spec import Spectrometer, N_INPUTS
+
+
+def _snapshots(n, n_chips=3, n_samples=1024, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.randint(-128, 128, size=(n, n_chips, n_samples)).astype('int8')
+
+
+@pytest.mark.parametrize('demux', [1, 2, 4])
+@pytest.mark.parametrize('n_fft', [None, 64])
+def test_shapes_and_frequencies(demux, n_fft):
+    spec = Spectrometer(demux_mode=demux, n_fft=n_fft)
+    spec.add(_snapshots(2))
+    n_fft = n_fft or 1024 // N_INPUTS[demux]
+    assert spec.spectrum.shape == (3, N_INPUTS[demux], n_fft // 2 + 1)
+    assert spec.spectrum.dtype == np.float32
+
+    freqs = spec.frequencies(250.0)
+    assert len(freqs) == n_fft // 2 + 1
+    assert freqs[0] == 0
+    assert freqs[-1] == 125.0
+
+
+def test_tone_lands_in_its_channel():
+    spec = Spectrometer(demux_mode=4)
+    t = np.arange(1024)
+    snapshot = (100 * np.sin(2 * np.pi * 64 * t / 1024.0)).astype('int8')
+    spec.add(np.tile(snapshot, (1, 3, 1)))
+    assert (spec.spectrum[:, 0].argmax(axis=-1) == 64).all()
+
+
+def test_running_mean_is_batch_average():
+    batches = [_snapshots(n, seed=ii) for ii, n in enumerate([4, 4, 4])]
+    spec = Spectrometer(demux_mode=2)
+    for batch in batches:
+        spec.add(batch)
+    assert spec.count == 12
+    expected = np.mean([spec.power(b)[0] for b in batches], axis=0)
+    assert np.allclose(spec.spectrum, expected, rtol=1e-5)
+
+    # Unequal batches are weighted by their number of snapshots
+    batches = [_snapshots(n, seed=ii) for ii, n in enumerate([5, 1, 3])]
+    spec.reset()
+    for batch in batches:
+        spec.add(batch)
+    assert spec.count == 9
+    assert np.allclose(spec.spectrum, spec.power(np.concatenate(batches))[0], rtol=1e-5)
+
+
+def test_integrations_hold_exactly_n_snapshots():
+    snapshots = _snapshots(12)
+    spec = Spectrometer(demux_mode=1, n_integrations=5)
+    assert not spec.add(snapshots[:4])
+    assert spec.add(snapshots[4:8])
+    assert np.allclose(spec.last_spectrum, spec.power(snapshots[:5])[0], rtol=1e-5)
+    assert spec.count == 3
+
+    assert spec.add(snapshots[8:12])
+    assert np.allclose(spec.last_spectrum, spec.power(snapshots[5:10])[0], rtol=1e-5)
+    assert spec.count == 2
+    assert np.allclose(spec.spectrum, spec.power(snapshots[10:])[0], rtol=1e-5)
+
+
+def test_bad_demux():
+    with pytest.raises(RuntimeError):
+        Spectrometer(demux_mode=3)
+
+
+def test_integrate(sim_server, snap):
+    snap.program('adc16_test.bof')
+    spec = Spectrometer(demux_mode=snap.adc.demux_mode)
+    spectrum = spec.integrate(snap.adc, n_snapshots=10, batch_size=4)
+    assert spec.count == 10
+    assert spectrum.shape == (3, 4, 129)
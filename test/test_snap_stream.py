@@ -0,0 +1,103 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+BOF = 'adc16_test.bof'
+
+
+@pytest.fixture
+def adc(sim_server, snap):
+    snap.program(BOF)
+    return snap.adc
+
+
+def test_stream_batches(adc):
+    with adc.stream(batch_size=4, max_batches=3) as stream:
+        batches = list(stream)
+    assert len(batches) == 3
+    for timestamps, data in batches:
+        assert timestamps.shape == (4,)
+        assert data.shape == (4, 3, 1024)
+        assert data.dtype == np.int8
+    timestamps = np.concatenate([t for t, d in batches])
+    assert (np.diff(timestamps) > 0).all()
+
+    stats = stream.stats()
+    assert stats['captured'] == stats['delivered'] == 12
+    assert stats['dropped'] == 0
+    assert stats['snapshots_per_second'] > 0
+
+
+def test_stream_backpressure(adc):
+    # Without drop, capture pauses once the queue is full
+    with adc.stream(queue_size=2) as stream:
+        for ii, (timestamps, data) in enumerate(stream):
+            time.sleep(0.1)
+            if ii == 3:
+                break
+    stats = stream.stats()
+    assert stats['delivered'] == 4
+    assert stats['dropped'] == 0
+    # Four delivered, two queued, one being captured
+    assert stats['captured'] <= 7
+
+
+def test_stream_drops_for_slow_consumer(adc):
+    with adc.stream(queue_size=1, drop=True) as stream:
+        for ii, (timestamps, data) in enumerate(stream):
+            time.sleep(0.2)
+            if ii == 2:
+                break
+    stats = stream.stats()
+    assert stats['delivered'] == 3
+    assert stats['dropped'] > 0
+    assert stats['captured'] >= stats['delivered'] + stats['dropped']
+
+
+def test_stop_ends_consumer_in_other_thread(adc):
+    stream = adc.stream(queue_size=1).start()
+    batches = []
+
+    def _consume():
+        for batch in stream:
+            batches.append(batch)
+            time.sleep(0.05)
+
+    consumer = threading.Thread(target=_consume)
+    consumer.start()
+    time.sleep(0.3)
+    stream.stop()
+    consumer.join(2.0)
+    assert not consumer.is_alive()
+    assert batches
+
+
+def test_stop_with_full_queue(adc):
+    # Nobody consumes: stop() must not block on the full queue, and leaves
+    # just the end marker behind
+    stream = adc.stream(queue_size=1).start()
+    while stream.queue.qsize() < 1:
+        time.sleep(0.01)
+    stream.stop()
+    assert list(stream) == []
+
+
+def test_capture_error_ends_stream(adc, monkeypatch):
+    capture = adc.capture
+    calls = []
+
+    def _capture(*args):
+        calls.append(1)
+        if len(calls) > 2:
+            raise RuntimeError("board went away")
+        return capture(*args)
+    monkeypatch.setattr(adc, 'capture', _capture)
+
+    stream = adc.stream()
+    with pytest.raises(RuntimeError, match='board went away'):
+        for batch in stream:
+            pass
+    assert stream.stats()['delivered'] == 2
+    stream.stop()
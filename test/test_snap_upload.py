@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+
+from snap_control.snap_upload import Uploader, TokenBucket
+
+
+class CountingUploader(Uploader):
+    """ Uploader that records the most uploads it had in flight at once """
+    def __init__(self, *args, **kwargs):
+        super(CountingUploader, self).__init__(*args, **kwargs)
+        self.active = 0
+        self.max_active = 0
+        self._count_lock = threading.Lock()
+
+    def send(self, sock, filename):
+        with self._count_lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            return super(CountingUploader, self).send(sock, filename)
+        finally:
+            with self._count_lock:
+                self.active -= 1
+
+
+def test_rate_limit_needs_transfer_limit():
+    with pytest.raises(RuntimeError):
+        Uploader(max_rate=1e6)
+    assert Uploader().transfer_time(1e6) == 0.0
+    assert Uploader(max_transfers=4, max_rate=8e6).transfer_time(2e6) == 1.0
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(1e6, burst=0)
+    t0 = time.time()
+    for ii in range(5):
+        bucket.consume(1e5)
+    assert 0.45 < time.time() - t0 < 1.0
+
+
+def test_transfer_slots():
+    uploader = Uploader(max_transfers=2)
+    active = []
+    max_active = []
+    lock = threading.Lock()
+
+    def _upload():
+        with uploader.transfer():
+            with lock:
+                active.append(1)
+                max_active.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.pop()
+
+    threads = [threading.Thread(target=_upload) for ii in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert max(max_active) == 2
+
+
+def test_fleet_upload_rate_and_slot_limited(tmpdir, monkeypatch):
+    pytest.importorskip('casperfpga')
+    from snap_control import snap_manager
+    from snap_control.snap_board import SnapBoard
+    from snap_control.snap_sim import start_servers
+
+    image = str(tmpdir.join('image.bin'))
+    with open(image, 'wb') as fh:
+        fh.write(b'\xa5' * 2**20)
+
+    uploaders = []
+
+    def _uploader(*args, **kwargs):
+        uploaders.append(CountingUploader(*args, **kwargs))
+        return uploaders[-1]
+    monkeypatch.setattr(snap_manager, 'Uploader', _uploader)
+
+    servers = start_servers(4, port=0)
+    mgr = snap_manager.SnapManager([], timeout=10, max_workers=4)
+    try:
+        mgr.snap_boards = [SnapBoard(s.host, katcp_port=s.port) for s in servers]
+        # Each of the two slots gets 2 MB/s, so every upload takes ~0.5 s,
+        # longer than upload_timeout: the transfer must not count against it
+        t0 = time.time()
+        results = mgr.upload_and_program(image, max_transfers=2, max_rate=4e6,
+                                         upload_timeout=0.2)
+        elapsed = time.time() - t0
+        results.raise_for_errors()
+        assert all(s.board.programmed.startswith('upload-') for s in servers)
+        assert uploaders[0].max_active == 2
+        # 4 MB in total at 4 MB/s, less the bucket's initial burst
+        assert elapsed > 0.8
+    finally:
+        mgr.close()
+        for s in servers:
+            s.stop()